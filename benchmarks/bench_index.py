@@ -0,0 +1,47 @@
+"""
+Measures the build time, load time, query latency and recall of the title/author similarity index
+python -m benchmarks.bench_index [reference pairs CSV]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import utils_blocking as bl
+import utils_index as ix
+import utils_storage as st
+
+
+def main(reference_pairs=None, ks=(5, 10, 20)):
+    table_a = st.read_table(st.table_path('table_a_cleaned'), st.TABLE_A)
+    table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+    path = os.path.join(tempfile.mkdtemp(prefix='index_'), ix.INDEX_PATH)
+    start = time.perf_counter()
+    index = ix.SimilarityIndex.build(table_b)
+    build_seconds = time.perf_counter() - start
+    index.save(path)
+    start = time.perf_counter()
+    index = ix.SimilarityIndex.load(path)
+    load_seconds = time.perf_counter() - start
+    print(f"{len(table_b)} records, {len(index.vocabulary)} q-grams, {os.path.getsize(path) / 2 ** 20:.2f} MiB, "
+          f"build {build_seconds:.3f} s, load {load_seconds * 1000:.1f} ms")
+    latencies = []
+    for title, author in zip(table_a['title'].tolist(), table_a['author'].tolist()):
+        start = time.perf_counter()
+        index.query(title, author, 10)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    print(f"query latency over {len(latencies)} queries: mean {latencies.mean():.3f} ms, "
+          f"p50 {np.percentile(latencies, 50):.3f} ms, p99 {np.percentile(latencies, 99):.3f} ms")
+    if reference_pairs is not None:
+        reference_pairs = st.read_table(reference_pairs, st.TABLE_C)
+    for k in ks:
+        candidates = index.top_k(table_a, k)
+        report = bl.blocking_report(candidates, table_a, table_b, reference_pairs)
+        print(f"k={k}: {report}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
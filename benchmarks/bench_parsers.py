@@ -0,0 +1,43 @@
+"""
+Compares the records/sec of the BeautifulSoup and the lxml extraction engine of utils_openlibrary
+python -m benchmarks.bench_parsers [directory with saved book pages]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import utils_openlibrary as ol
+from benchmarks import synthetic
+
+
+def bench_engine(pages, engine, repeat=3):
+    """Parses all pages with engine and returns the best records/sec of repeat runs"""
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in pages:
+            ol.parse_book(content, engine)
+        best = max(best, len(pages) / (time.perf_counter() - start))
+    return best
+
+
+def main(directory=None, num_pages=500):
+    if directory is None:
+        directory = synthetic.write_openlibrary_pages(tempfile.mkdtemp(prefix='openlibrary_pages_'), num_pages)
+    pages = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.html'):
+            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+                pages.append(f.read())
+    mismatches = sum(ol.parse_book(content, 'bs4') != ol.parse_book(content, 'lxml') for content in pages)
+    print(f"{len(pages)} pages from {directory}, records differing between engines: {mismatches}")
+    results = {engine: bench_engine(pages, engine) for engine in ['bs4', 'lxml']}
+    for engine, records_per_second in results.items():
+        print(f"{engine:>5}: {records_per_second:10.1f} records/sec")
+    print(f"speedup: {results['lxml'] / results['bs4']:.1f}x")
+    return results
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
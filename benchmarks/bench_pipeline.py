@@ -0,0 +1,227 @@
+"""
+Benchmark suite of the pipeline stages: crawling (against a local mock server serving a fixed corpus of
+synthetic pages), parsing, cleaning, blocking and scoring (on synthetic catalogs of increasing size).
+Every run is appended to benchmarks/results.jsonl with the commit it ran on and compared with the last
+run of another commit. Blocking dominates the run time of large catalogs, it can be switched from the
+default blocking pipeline to the similarity index blocker (utils_index) to compare both
+python -m benchmarks.bench_pipeline [catalog sizes, default 1000,10000] [number of pages] [blocker: default or index]
+"""
+import contextlib
+import functools
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import utils_blocking as bl
+import utils_cleaning_analysis as ca
+import utils_crawler as cr
+import utils_gutenberg as gb
+import utils_index as ix
+import utils_matching as um
+import utils_metrics as mt
+import utils_openlibrary as ol
+import utils_storage as st
+from benchmarks import synthetic
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+
+class _Server(ThreadingHTTPServer):
+    request_queue_size = 128  # the default backlog of 5 drops connections of concurrent crawls
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)  # simulated network round trip
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def mock_server(directory, latency=0.0):
+    """Serves directory on a free localhost port, every response is delayed by latency seconds"""
+    handler = type('Handler', (_Handler,), {'latency': latency})
+    server = _Server(('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def measure(name, rows, func, rows_out=None):
+    """
+    Runs func as a utils_metrics stage with its output silenced
+    :param rows_out: function computing the number of output rows from the result of func
+    :return: (result of func, measurements: seconds, rows/sec, latency per row, RSS growth and peak RSS)
+    """
+    with mt.stage(name, rows_in=rows) as s:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        s.rows_out = rows_out(result) if rows_out else None
+    record = mt.report()['stages'][-1]
+    seconds = record['seconds']
+    return result, {
+        'stage': name,
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None,
+        'latency_ms': seconds / rows * 1000 if rows else None,
+        'rss_delta_mb': (record['rss_after_mb'] - record['rss_before_mb']) if record['rss_before_mb'] else None,
+        'peak_rss_mb': record['peak_rss_mb'],
+    }
+
+
+def bench_crawl(corpus, output_directory, concurrency=8, latency=0.005):
+    """Crawls the book pages of both sites of the corpus from the mock server"""
+    results = []
+    with mock_server(corpus, latency) as base_url:
+        for site, link_class in [('gutenberg', 'link'), ('openlibrary', 'results')]:
+            jobs = []
+            search_directory = os.path.join(corpus, site, 'search')
+            for filename in sorted(os.listdir(search_directory)):
+                with open(os.path.join(search_directory, filename), encoding='utf-8') as f:
+                    for link in re.findall(f'class="{link_class}" href="([^"]+)"', f.read()):
+                        jobs.append((f"{base_url}/{site}{link}",
+                                     os.path.join(output_directory, site, f"{link.split('/')[-1]}.html")))
+            mt.reset()
+            _, result = measure(f'crawl/{site}', len(jobs), lambda: cr.crawl(
+                jobs, concurrency=concurrency, rate=1000.0, burst=concurrency, max_retries=0, progress_every=0),
+                lambda report: report['pages'] - report['failed'])
+            histogram = mt.report()['histograms'].get('http_latency', {})
+            result.update(request_latency_ms=(histogram.get('mean') or 0) * 1000,
+                          max_request_latency_ms=histogram.get('max', 0) * 1000,
+                          concurrency=concurrency, server_latency_ms=latency * 1000)
+            results.append(result)
+    return results
+
+
+def bench_parse(pages_directory, output_directory):
+    """Parses the crawled book pages with the parsers of both sites"""
+    results = []
+    gutenberg_pages = os.path.join(pages_directory, 'gutenberg')
+    openlibrary_pages = os.path.join(pages_directory, 'openlibrary')
+    for name, directory, parse in [
+            ('parse/gutenberg', gutenberg_pages, lambda output: gb.process_books_gutenberg(gutenberg_pages, output)),
+            ('parse/openlibrary_bs4', openlibrary_pages, lambda output: ol.process_books(openlibrary_pages, output)),
+            ('parse/openlibrary_lxml', openlibrary_pages,
+             lambda output: ol.process_books(openlibrary_pages, output, engine='lxml'))]:
+        output = os.path.join(output_directory, st.table_path(name.replace('/', '_')))
+        results.append(measure(name, len(os.listdir(directory)), functools.partial(parse, output))[1])
+    return results
+
+
+def pair_recall(pairs, gold):
+    """Fraction of the gold pairs found in pairs"""
+    found = gold.merge(pairs[['ltable_ID', 'rtable_ID']].astype({'ltable_ID': str, 'rtable_ID': 'int64'}),
+                       on=['ltable_ID', 'rtable_ID'])
+    return len(found) / len(gold) if len(gold) else None
+
+
+def bench_catalog(directory, num_rows, blockers=None):
+    """
+    Cleans, blocks and scores a synthetic catalog of num_rows records per table
+    :param blockers: blocking pipeline (see utils_blocking.block_tables, default pipeline if None)
+    """
+    gold = synthetic.write_catalog(directory, num_rows).astype({'ltable_ID': str, 'rtable_ID': 'int64'})
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        _, clean = measure('clean', 2 * num_rows, ca.apply_same_schema)
+        table_a = st.read_table(st.table_path('table_a_cleaned'), st.TABLE_A)
+        table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+        candidates, block = measure('block', len(table_a) + len(table_b),
+                                    lambda: bl.block_tables(table_a, table_b, blockers), len)
+        block.update(candidate_pairs=len(candidates), recall=pair_recall(candidates, gold))
+        min_year = min(table_a['first_published_year'].min(), table_b['first_published_year'].min())
+
+        def score():
+            table_c = um.filter_candidates(um.candidate_table(candidates, table_a, table_b))
+            table_c['difference_year'] = um.year_difference(table_c, min_year)
+            table_c['cover_mse'] = um.cover_difference(table_c)
+            return um.rank_matches(table_c)
+
+        matches, scoring = measure('score', len(candidates), score, len)
+        scoring.update(matches=len(matches), recall=pair_recall(matches, gold))
+    finally:
+        os.chdir(cwd)
+    return [clean, block, scoring]
+
+
+def git_commit():
+    """Short hash of the checked out commit (+dirty if the tree has changes)"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+dirty' if dirty else '')
+
+
+def save_results(run, path=RESULTS_PATH):
+    with open(path, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+def previous_run(commit, blocker, path=RESULTS_PATH):
+    """Last stored run of another commit with the same blocker (None if there is none)"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        runs = [json.loads(line) for line in f if line.strip()]
+    runs = [run for run in runs if run['commit'] != commit and run.get('blocker', 'default') == blocker]
+    return runs[-1] if runs else None
+
+
+def compare(run, previous):
+    """Prints the throughput of every stage next to the throughput of the previous run"""
+    before = {(result['stage'], result['rows']): result for result in previous['results']} if previous else {}
+    header = f"{'stage':<24}{'rows':>10}{'seconds':>10}{'rows/sec':>12}{'peak MB':>9}"
+    if previous:
+        header += f"{'before':>12}{'change':>9}   (before: {previous['commit']}, {previous['created']})"
+    print(header)
+    for result in run['results']:
+        line = (f"{result['stage']:<24}{result['rows']:>10}{result['seconds']:>10.3f}"
+                f"{result['rows_per_second'] or 0:>12.0f}{result['peak_rss_mb']:>9.0f}")
+        old = before.get((result['stage'], result['rows']))
+        if old and old['rows_per_second'] and result['rows_per_second']:
+            line += f"{old['rows_per_second']:>12.0f}{result['rows_per_second'] / old['rows_per_second'] - 1:>+9.1%}"
+        print(line)
+
+
+def main(sizes='1000,10000', num_pages=500, blocker='default', concurrency=8, latency=0.005, path=RESULTS_PATH):
+    sizes = [int(size) for size in str(sizes).split(',')]
+    blockers = [ix.index_blocker(k=10, path=ix.INDEX_PATH)] if blocker == 'index' else None
+    directory = tempfile.mkdtemp(prefix='bench_pipeline_')
+    corpus = synthetic.write_corpus(os.path.join(directory, 'corpus'), int(num_pages))
+    results = bench_crawl(corpus, os.path.join(directory, 'crawled'), concurrency, latency)
+    results += bench_parse(os.path.join(directory, 'crawled'), directory)
+    for num_rows in sizes:
+        results += bench_catalog(os.path.join(directory, f'catalog_{num_rows}'), num_rows, blockers)
+    run = {'commit': git_commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+           'cpus': os.cpu_count(), 'blocker': blocker, 'results': results}
+    shutil.rmtree(directory, ignore_errors=True)
+    compare(run, previous_run(run['commit'], blocker, path))
+    save_results(run, path)
+    print(f"Results saved to {path}")
+    return run
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:4])
@@ -0,0 +1,52 @@
+"""
+Reports the pairs/sec of the parallel pair scoring engine for an increasing number of worker processes
+python -m benchmarks.bench_scoring [number of pairs]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+import utils_parallel as px
+import utils_storage as st
+
+
+def worker_counts(max_workers=None):
+    """1, 2, 4, ... up to the number of cores"""
+    max_workers = max_workers or os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+    return counts
+
+
+def main(num_pairs=200000, seed=0):
+    num_pairs = int(num_pairs)
+    table_a = st.read_table(st.table_path('table_a_cleaned'), st.TABLE_A)
+    table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+    # random pairs of the cartesian product
+    rng = np.random.default_rng(seed)
+    rows_a = rng.integers(0, len(table_a), num_pairs)
+    rows_b = rng.integers(0, len(table_b), num_pairs)
+    left = table_a['title'].to_numpy(dtype=object)[rows_a]
+    right = table_b['title'].to_numpy(dtype=object)[rows_b]
+    results = {}
+    for threshold in [None, 0.6]:
+        reference = None
+        for workers in worker_counts():
+            start = time.perf_counter()
+            distances = px.parallel_edit_distance(left, right, threshold, workers=workers)
+            seconds = time.perf_counter() - start
+            reference = distances if reference is None else reference
+            same = np.array_equal(distances, reference)
+            results[(threshold, workers)] = num_pairs / seconds
+            print(f"threshold={threshold} workers={workers:>2}: {num_pairs / seconds:12.0f} pairs/sec "
+                  f"({num_pairs / seconds / workers:10.0f} per worker), same result: {same}")
+    return results
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
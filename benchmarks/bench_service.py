@@ -0,0 +1,90 @@
+"""
+Measures the match service over localhost: startup time, latency and throughput of single and batched
+queries sent by concurrent clients, and checks that the pairs it returns that are also in tableC have
+the same features and score. Runs on the tables of the working directory (run the match stage first)
+python -m benchmarks.bench_service [number of queries, default 500] [batch size, default 32] [clients, default 4]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import utils_http as hp
+import utils_service as sv
+import utils_storage as st
+
+FEATURES = ['distance_title', 'distance_author', 'difference_year', 'language_match', 'cover_mse', 'score']
+
+
+def _records(num_queries):
+    table_a = pd.read_csv(st.table_path('table_a_cleaned'), dtype=str, keep_default_na=False, na_values=[''])
+    table_a = table_a.head(num_queries)
+    return table_a.astype(object).where(table_a.notna(), None).to_dict('records')
+
+
+def load_test(base_url, records, batch_size=1, clients=4):
+    """
+    Sends the records in batches of batch_size from clients threads
+    :return: (matches of every record, latencies of the requests in seconds, wall time in seconds)
+    """
+    session = hp.CachingSession(pool_size=clients, cache_dir=None)
+    batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+    def send(batch):
+        start = time.perf_counter()
+        response = session.post(f"{base_url}/match", json={'records': batch})
+        response.raise_for_status()
+        return response.json()['matches'], time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(send, batches))
+    seconds = time.perf_counter() - start
+    matches = [match for batch_matches, _ in results for match in batch_matches]
+    return matches, np.array([latency for _, latency in results]), seconds
+
+
+def compare_with_table_c(matches):
+    """Largest difference between the features of the returned pairs and the same pairs in tableC"""
+    returned = pd.DataFrame([match for record_matches in matches for match in record_matches])
+    if returned.empty or not os.path.exists(st.table_path('tableC')):
+        return 0, None
+    table_c = st.read_table(st.table_path('tableC'), st.TABLE_C)
+    returned = returned.astype({'ltable_ID': 'string', 'rtable_ID': 'Int64'})
+    common = returned.merge(table_c[['ltable_ID', 'rtable_ID'] + FEATURES], on=['ltable_ID', 'rtable_ID'],
+                            suffixes=('', '_table_c'))
+    differences = {feature: float(np.nanmax(np.abs(common[feature].to_numpy(dtype=float, na_value=np.nan) -
+                                                   common[feature + '_table_c'].to_numpy(dtype=float,
+                                                                                         na_value=np.nan)),
+                                            initial=0.0))
+                   for feature in FEATURES}
+    return len(common), differences
+
+
+def main(num_queries=500, batch_size=32, clients=4):
+    records = _records(int(num_queries))
+    start = time.perf_counter()
+    service = sv.MatchService()
+    print(f"Service loaded {len(service.table_b)} records in {time.perf_counter() - start:.2f} s")
+    server, base_url = sv.start_in_thread(service)
+    try:
+        for size in [1, int(batch_size)]:
+            matches, latencies, seconds = load_test(base_url, records, size, int(clients))
+            latencies = latencies * 1000
+            print(f"batch size {size}, {clients} clients: {len(records) / seconds:.0f} records/s, request latency "
+                  f"p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, "
+                  f"p99 {np.percentile(latencies, 99):.1f} ms")
+        pairs, differences = compare_with_table_c(matches)
+        print(f"{sum(map(len, matches))} matches returned, {pairs} of them in tableC, "
+              f"largest feature differences: {differences}")
+        print(f"Service stats: {hp.shared_session().get(f'{base_url}/stats').json()}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:4])
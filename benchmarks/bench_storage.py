@@ -0,0 +1,45 @@
+"""
+Compares the file size, load time and dtypes of the pipeline tables stored as CSV and as Parquet
+python -m benchmarks.bench_storage [number of rows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import utils_storage as st
+
+
+def bench_load(path, schema, repeat=5):
+    """Loads path repeat times and returns the best load time in seconds and the loaded table"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = st.read_table(path, schema, categorical=True)
+        best = min(best, time.perf_counter() - start)
+    return best, df
+
+
+def main(num_rows=100000, source='openlibrary_books.csv'):
+    num_rows = int(num_rows)
+    table = st.read_table(source, st.OPENLIBRARY_BOOKS, categorical=True)
+    # repeat the source rows to the requested size
+    table = pd.concat([table] * (num_rows // len(table) + 1), ignore_index=True).iloc[:num_rows]
+    directory = tempfile.mkdtemp(prefix='storage_')
+    results = {}
+    for fmt in ['csv', 'parquet']:
+        path = os.path.join(directory, st.table_path('openlibrary_books', fmt))
+        written = st.write_table(table, path, st.OPENLIBRARY_BOOKS)
+        seconds, loaded = bench_load(path, st.OPENLIBRARY_BOOKS)
+        same_dtypes = loaded.dtypes.astype(str).equals(written.dtypes.astype(str))
+        results[fmt] = {'bytes': os.path.getsize(path), 'load_seconds': seconds, 'dtypes_match': same_dtypes}
+        print(f"{fmt:>8}: {results[fmt]['bytes'] / 2 ** 20:8.2f} MiB, load {seconds:.3f} s, "
+              f"dtypes match schema: {same_dtypes}")
+    print(f"{num_rows} rows, dtypes: {dict(table.dtypes.astype(str))}")
+    return results
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
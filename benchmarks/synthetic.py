@@ -0,0 +1,291 @@
+"""
+Synthetic data for the benchmarks. Run the benchmarks from the repository root, e.g.
+python -m benchmarks.bench_parsers
+"""
+import html
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils_storage as st
+
+# consonant-vowel(-consonant) syllables, enough distinct q-grams for blocking to behave like on real titles
+SYLLABLES = [c + v + e for c in 'bcdfghjklmnprstvwz' for v in 'aeiou' for e in ['', 'n', 'r', 's', 'l', 'th']]
+LANGUAGES = ['English'] * 14 + ['French', 'German', 'Spanish', 'Italian', 'Dutch', 'Finnish']
+PUBLISHERS = ['Penguin Books', 'Harper & Row', 'Vintage', 'Ballantine Books', 'Tor', 'Oxford University Press',
+              'Random House', 'Bantam', 'Scholastic', 'Gallimard']
+
+OPENLIBRARY_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<title>{title} | Open Library</title>
+<meta charset="utf-8">
+<link rel="stylesheet" href="/static/build/page-book.css">
+<script>window.q = []; var ol = {{"env": "production", "page": "book"}};</script>
+</head>
+<body class="client-js">
+<div id="topNotice"><div class="page-banner">Open Library is a project of the non-profit Internet Archive</div></div>
+<header id="header-bar"><ul class="navigation-component">{navigation}</ul></header>
+<div id="test-body-mobile">
+<div class="contentTop">
+<div class="illustration"><div class="editionCover"><a href="#"><img class="cover" src="{cover_image}" alt="Cover of: {title}" itemprop="image"></a></div></div>
+<div class="work-title-and-author desktop">
+<h1 class="work-title" itemprop="name">{title}</h1>
+{subtitle_html}
+<h2 class="edition-byline">by <a href="/authors/OL1A" itemprop="author">{author}</a></h2>
+</div>
+<ul class="readers-stats" itemprop="aggregateRating" itemscope itemtype="https://schema.org/AggregateRating">
+<li class="avg-ratings"><span itemprop="ratingValue">{rating}</span> <span class="rating-count">(120 ratings)</span></li>
+<li class="reading-log-stat"><span class="readers-stats__stat">300</span> <span class="readers-stats__label">Want to read</span></li>
+</ul>
+<div class="edition-omniline">
+<div class="edition-omniline-item"><div>Publish Date</div><span itemprop="datePublished">2004</span></div>
+<div class="edition-omniline-item"><div>Publisher</div><a itemprop="publisher" href="/publishers/p">{publisher}</a></div>
+<div class="edition-omniline-item"><div>Language</div><span itemprop="inLanguage"><a href="/languages/eng">{language}</a></span></div>
+<div class="edition-omniline-item"><div>Pages</div><span class="edition-pages" itemprop="numberOfPages">{pages}</span></div>
+</div>
+<span class="first-published-date" title="First published in {year}">({year})</span>
+</div>
+<div class="book-description"><p>{description}</p></div>
+<ul class="related-books">{related}</ul>
+<div class="section">
+<h3 class="list-header">ID Numbers</h3>
+<dl class="meta">
+<dt>Open Library</dt><dd class="object">OL1M</dd>
+<dt>ISBN 10</dt><dd class="object" itemprop="isbn">{isbn_10}</dd>
+<dt>ISBN 13</dt><dd class="object" itemprop="isbn">{isbn_13}</dd>
+</dl>
+<dl class="meta">
+<dt>Work ID</dt><dd class="object">{ID}</dd>
+</dl>
+</div>
+</div>
+<footer><div id="footer-content">{footer}</div></footer>
+<script src="/static/build/all.js"></script>
+</body>
+</html>
+"""
+
+
+def openlibrary_page(record, filler=20):
+    """Renders an Open Library book page with the fields of record (dict with the openlibrary schema)"""
+    values = {key: html.escape('' if pd.isna(value) else str(value)) for key, value in record.items()}
+    subtitle = values.get('subtitle', '')
+    year = values.get('first_published_year', '').split('.')[0]
+    return OPENLIBRARY_PAGE.format(
+        navigation=''.join(f'<li><a href="/nav/{i}">Menu {i}</a></li>' for i in range(filler)),
+        subtitle_html=f'<h2 class="work-subtitle">{subtitle}</h2>' if subtitle else '',
+        related=''.join(f'<li class="related"><a href="/works/OL{i}W"><img src="/b/{i}.jpg" alt=""></a>'
+                        f'<span class="title">Related book {i}</span></li>' for i in range(filler)),
+        description=' '.join(['Lorem ipsum dolor sit amet.'] * filler),
+        footer=''.join(f'<a href="/help/{i}">Help {i}</a>' for i in range(filler)),
+        year=year,
+        **{key: values.get(key, '') for key in ['ID', 'title', 'author', 'publisher', 'language', 'cover_image',
+                                                  'pages', 'rating', 'isbn_10', 'isbn_13']}
+    )
+
+
+def write_openlibrary_pages(output_directory, num_pages, source='openlibrary_books.csv'):
+    """Writes num_pages synthetic book pages built from the records of source (cycled if needed)"""
+    os.makedirs(output_directory, exist_ok=True)
+    records = pd.read_csv(source, dtype=str).to_dict('records')
+    for i in range(num_pages):
+        record = dict(records[i % len(records)])
+        record['ID'] = f"{record['ID']}-{i}" if i >= len(records) else record['ID']
+        with open(os.path.join(output_directory, f"{record['ID']}.html"), 'w', encoding='utf-8') as f:
+            f.write(openlibrary_page(record))
+    return output_directory
+
+
+def _words(rng, num_words, min_syllables=1, max_syllables=4):
+    """Pronounceable random words built from SYLLABLES"""
+    lengths = rng.integers(min_syllables, max_syllables + 1, num_words)
+    syllables = rng.integers(0, len(SYLLABLES), lengths.sum())
+    words, start = [], 0
+    for length in lengths.tolist():
+        words.append(''.join(SYLLABLES[i] for i in syllables[start:start + length].tolist()))
+        start += length
+    return words
+
+
+def _typo(rng, text):
+    """One random insertion, deletion, substitution or transposition of text"""
+    if len(text) < 2:
+        return text
+    position = int(rng.integers(0, len(text) - 1))
+    letter = chr(int(rng.integers(ord('a'), ord('z') + 1)))
+    operation = int(rng.integers(0, 4))
+    if operation == 0:
+        return text[:position] + letter + text[position:]
+    if operation == 1:
+        return text[:position] + text[position + 1:]
+    if operation == 2:
+        return text[:position] + letter + text[position + 1:]
+    return text[:position] + text[position + 1] + text[position] + text[position + 2:]
+
+
+def synthetic_catalog(num_rows, duplicate_rate=0.2, typo_rate=0.3, seed=0):
+    """
+    Generates an Open Library and a Gutenberg catalog (openlibrary_books and gutenberg_books schema) of
+    num_rows records each. A duplicate_rate fraction of the Open Library records are copies of Gutenberg
+    records, each of their title and author has a typo with probability typo_rate. Gutenberg authors are
+    written 'last name,  first name' like on the site. Covers are left empty so nothing is downloaded
+    :return: (openlibrary_books, gutenberg_books, gold) where gold holds the (ltable_ID, rtable_ID) pairs
+    of the duplicates
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = _words(rng, max(1000, num_rows // 4))
+    first_names = [word.capitalize() for word in _words(rng, 300, 1, 3)]
+    last_names = [word.capitalize() for word in _words(rng, max(500, num_rows // 10), 2, 4)]
+
+    def records(count):
+        title_lengths = rng.integers(1, 7, count)
+        title_words = rng.integers(0, len(vocabulary), title_lengths.sum())
+        titles, start = [], 0
+        for length in title_lengths.tolist():
+            titles.append(' '.join(vocabulary[i] for i in title_words[start:start + length].tolist()).capitalize())
+            start += length
+        first = rng.integers(0, len(first_names), count).tolist()
+        last = rng.integers(0, len(last_names), count).tolist()
+        return pd.DataFrame({
+            'title': titles,
+            'first_name': [first_names[i] for i in first],
+            'last_name': [last_names[i] for i in last],
+            'first_published_year': rng.integers(1600, 2024, count),
+            'language': np.array(LANGUAGES, dtype=object)[rng.integers(0, len(LANGUAGES), count)],
+        })
+
+    gutenberg = records(num_rows)
+    openlibrary = records(num_rows)
+    # noisy copies of gutenberg records
+    duplicates = rng.random(num_rows) < duplicate_rate
+    sources = rng.choice(num_rows, num_rows, replace=False)[duplicates]
+    copies = gutenberg.iloc[sources].reset_index(drop=True)
+    for column in ['title', 'last_name']:
+        values = copies[column].tolist()
+        noisy = rng.random(len(values)) < typo_rate
+        copies[column] = [_typo(rng, value) if typo else value for value, typo in zip(values, noisy.tolist())]
+    openlibrary.loc[duplicates, copies.columns] = copies.to_numpy()
+
+    gutenberg_ids = np.arange(10000, 10000 + num_rows)
+    openlibrary_ids = np.array([f'OL{i}W' for i in range(100000, 100000 + num_rows)], dtype=object)
+    gutenberg_books = pd.DataFrame({
+        'ID': gutenberg_ids,
+        'title': gutenberg['title'],
+        'author': gutenberg['last_name'] + ',  ' + gutenberg['first_name'],
+        'publisher': 'Project Gutenberg',
+        'first_published_year': gutenberg['first_published_year'],
+        'language': gutenberg['language'],
+        'cover_image': None,
+    })
+    openlibrary_books = pd.DataFrame({
+        'ID': openlibrary_ids,
+        'title': openlibrary['title'],
+        'subtitle': None,
+        'author': openlibrary['first_name'] + ' ' + openlibrary['last_name'],
+        'publisher': np.array(PUBLISHERS, dtype=object)[rng.integers(0, len(PUBLISHERS), num_rows)],
+        'first_published_year': openlibrary['first_published_year'],
+        'language': openlibrary['language'],
+        'cover_image': None,
+        'pages': rng.integers(50, 900, num_rows),
+        'rating': [f'{rating:.1f} ({count} ratings)' for rating, count in
+                   zip(rng.uniform(1, 5, num_rows).tolist(), rng.integers(1, 500, num_rows).tolist())],
+        'isbn_10': [f'{isbn:010d}' for isbn in rng.integers(0, 10 ** 10, num_rows).tolist()],
+        'isbn_13': [f'978{isbn:010d}' for isbn in rng.integers(0, 10 ** 10, num_rows).tolist()],
+    })
+    gold = pd.DataFrame({'ltable_ID': openlibrary_ids[duplicates], 'rtable_ID': gutenberg_ids[sources]})
+    return (st.apply_schema(openlibrary_books, st.OPENLIBRARY_BOOKS),
+            st.apply_schema(gutenberg_books, st.GUTENBERG_BOOKS), gold)
+
+
+def write_catalog(directory, num_rows, duplicate_rate=0.2, typo_rate=0.3, seed=0):
+    """
+    Saves a synthetic catalog as the openlibrary_books and gutenberg_books tables of directory (the
+    input of utils_cleaning_analysis.apply_same_schema) and the duplicates as gold_pairs.csv
+    :return: the gold pairs
+    """
+    openlibrary_books, gutenberg_books, gold = synthetic_catalog(num_rows, duplicate_rate, typo_rate, seed)
+    os.makedirs(directory, exist_ok=True)
+    st.write_table(openlibrary_books, os.path.join(directory, st.table_path('openlibrary_books')),
+                   st.OPENLIBRARY_BOOKS)
+    st.write_table(gutenberg_books, os.path.join(directory, st.table_path('gutenberg_books')), st.GUTENBERG_BOOKS)
+    gold.to_csv(os.path.join(directory, 'gold_pairs.csv'), index=False)
+    return gold
+
+
+GUTENBERG_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+<title>{title} by {author} | Project Gutenberg</title>
+<meta charset="utf-8">
+<link rel="stylesheet" href="/gutenberg/style.css">
+</head>
+<body>
+<div id="header"><ul class="nav">{navigation}</ul></div>
+<div class="page_content" id="content" itemscope itemtype="http://schema.org/Book">
+<div itemprop="publisher" content="{publisher}"></div>
+<h1 itemprop="name">{title} by {author}</h1>
+<div id="cover"><img class="cover-art" src="{cover_image}" title="Book Cover" alt="Book Cover"></div>
+<table class="bibrec" summary="Bibliographic data of this book">
+<tr><th>Author</th><td><a href="/ebooks/author/1" rel="marcrel:aut" itemprop="creator">{creator}, 1800-1870</a></td></tr>
+<tr><th>Title</th><td itemprop="headline">{title}</td></tr>
+<tr><th>Note</th><td>{description}</td></tr>
+<tr property="dcterms:language" datatype="dcterms:RFC4646" itemprop="inLanguage" content="en">
+<th>Language</th><td>{language}</td></tr>
+<tr><th>EBook-No.</th><td>{ID}</td></tr>
+<tr><th>Release Date</th><td itemprop="datePublished">Jan 1, {year}</td></tr>
+<tr><th>Copyright Status</th><td>Public domain in the USA.</td></tr>
+</table>
+</div>
+<div id="footer">{footer}</div>
+</body>
+</html>
+"""
+
+
+def gutenberg_page(record, filler=20):
+    """Renders a Gutenberg book page with the fields of record (dict with the gutenberg schema)"""
+    values = {key: html.escape('' if pd.isna(value) else str(value)) for key, value in record.items()}
+    return GUTENBERG_PAGE.format(
+        navigation=''.join(f'<li><a href="/nav/{i}">Menu {i}</a></li>' for i in range(filler)),
+        description=' '.join(['Lorem ipsum dolor sit amet.'] * filler),
+        footer=''.join(f'<a href="/help/{i}">Help {i}</a>' for i in range(filler)),
+        year=values.get('first_published_year', ''),
+        creator=values.get('author', '').replace(',  ', ', '),  # the parser adds the space back
+        **{key: values.get(key, '') for key in ['ID', 'title', 'author', 'publisher', 'language', 'cover_image']}
+    )
+
+
+def search_page(links, link_class):
+    """Search result page linking to the book pages (links are the hrefs, link_class the class of the anchors)"""
+    items = ''.join(f'<li class="booklink"><a class="{link_class}" href="{link}"><span class="title">Book</span></a></li>'
+                    for link in links)
+    return f'<!DOCTYPE html><html><body><ul class="results">{items}</ul></body></html>'
+
+
+def write_corpus(directory, num_pages=500, seed=0, per_search_page=25):
+    """
+    Builds a fixed corpus of saved pages laid out like the site paths, so it can be served by a local
+    mock server and crawled: gutenberg/ebooks/<ID>, openlibrary/works/<ID> and the search result pages
+    gutenberg/search/page_<i>.html and openlibrary/search/page_<i>.html linking to them. The same seed
+    always gives the same corpus
+    :return: directory
+    """
+    openlibrary_books, gutenberg_books, _ = synthetic_catalog(num_pages, seed=seed)
+    for site, books, render, prefix, link_class in [
+            ('gutenberg', gutenberg_books, gutenberg_page, '/ebooks/', 'link'),
+            ('openlibrary', openlibrary_books, openlibrary_page, '/works/', 'results')]:
+        book_directory = os.path.join(directory, site, prefix.strip('/'))
+        search_directory = os.path.join(directory, site, 'search')
+        os.makedirs(book_directory, exist_ok=True)
+        os.makedirs(search_directory, exist_ok=True)
+        links = []
+        for record in books.to_dict('records'):
+            with open(os.path.join(book_directory, str(record['ID'])), 'w', encoding='utf-8') as f:
+                f.write(render(record))
+            links.append(f"{prefix}{record['ID']}")
+        for i, start in enumerate(range(0, len(links), per_search_page), start=1):
+            with open(os.path.join(search_directory, f'page_{i}.html'), 'w', encoding='utf-8') as f:
+                f.write(search_page(links[start:start + per_search_page], link_class))
+    return directory
@@ -1,26 +1,291 @@
-import utils_gutenberg as gb
-import utils_openlibrary as ol
+"""
+Command line interface of the pipeline, one subcommand per stage:
+    python main.py crawl    fetch the search result pages and the book pages
+    python main.py parse    extract the books of the saved pages into gutenberg_books / openlibrary_books
+    python main.py clean    clean both tables into table_a_cleaned / table_b_cleaned
+    python main.py match    match the cleaned tables into tableC
+    python main.py rescore  rank the matches again with other weights / thresholds, or sweep many weights
+    python main.py pack     move saved pages into the page archive (utils_archive)
+    python main.py cluster  group the matched records into entities, or dedupe one table (utils_clustering)
+    python main.py serve    answer match queries over HTTP with table_b kept in memory (utils_service)
+The modules of a stage (and pandas, bs4, requests, ...) are only imported when the stage runs, so
+--help and the cheap stages start fast
+"""
+import argparse
+import os
 
-if __name__ == "__main__":
-    # Assignment 1
-    # extract data from gutenberg trending
-    gb.get_html_pages("relevance", 50)
-    gb.get_book_html("gutenberg_html_pages_relevance", "gutenberg_html_books_relevance")
-    gb.process_books_gutenberg("gutenberg_html_books_relevance", "gutenberg_books_relevance.csv")
-    # extract data from gutenberg fantasy
-    gb.get_html_pages("fantasy", 50)
-    gb.get_book_html("gutenberg_html_pages_fantasy", "gutenberg_html_books_fantasy")
-    gb.process_books_gutenberg("gutenberg_html_books_fantasy", "gutenberg_books_fantasy.csv")
-    gb.combine_csv() # combine the two csv files
-    # extract data from openlibrary trending
-    ol.get_html_pages("relevance", 50)
-    ol.get_book_html("openlibrary_html_pages_relevance", "openlibrary_html_books_relevance")
-    ol.process_books("openlibrary_html_books_relevance", "openlibrary_books_relevance.csv")
-    # extract data from openlibrary fantasy
-    ol.get_html_pages("fantasy", 50)
-    ol.get_book_html("openlibrary_html_pages_fantasy", "openlibrary_html_books_fantasy")
-    ol.process_books("openlibrary_html_books_fantasy", "openlibrary_books_fantasy.csv")
-    ol.combine_csv() # combine the two csv files
-    # Assignment 2
+import utils_metrics as mt
+
+SOURCES = ["gutenberg", "openlibrary"]
+QUERIES = ["relevance", "fantasy"]
+
+
+def _directories(source, query):
+    """Directories of the search result pages and of the book pages, and the table of a crawl"""
+    return f"{source}_html_pages_{query}", f"{source}_html_books_{query}", f"{source}_books_{query}"
+
+
+def _changed_pages(directory, table_path, archive=None):
+    """Pages saved after the table was written (None if there is no table yet: parse all pages)"""
+    if not os.path.exists(table_path):
+        return None
+    written = os.path.getmtime(table_path)
+    if archive is not None:
+        return archive.list_pages(directory, since=written)
+    if not os.path.isdir(directory):
+        print(f"No page directory {directory} (not crawled, packed or deleted)")
+        return []
+    return [entry.path for entry in os.scandir(directory)
+            if entry.name.endswith('.html') and entry.stat().st_mtime > written]
+
+
+def _open_archive(args):
+    if not args.archive:
+        return None
+    import utils_archive as ar
+    return ar.PageArchive(args.archive)
+
+
+def crawl(args):
+    import utils_gutenberg as gb
+    import utils_openlibrary as ol
+    modules = {"gutenberg": gb, "openlibrary": ol}
+    archive = _open_archive(args)
+    for source in args.source:
+        for query in args.query:
+            pages_directory, books_directory, _ = _directories(source, query)
+            modules[source].get_html_pages(query, args.pages, rate=args.rate, archive=archive)
+            modules[source].get_book_html(pages_directory, books_directory, concurrency=args.concurrency,
+                                          rate=args.rate, max_age=args.max_age, archive=archive)
+    if archive is not None:
+        print(f"Page archive: {archive.stats()}")
+        archive.close()
+
+
+def parse(args):
+    import utils_gutenberg as gb
+    import utils_openlibrary as ol
+    import utils_storage as st
+    archive = _open_archive(args)
+    for source in args.source:
+        for query in QUERIES:
+            _, books_directory, table = _directories(source, query)
+            table_path = st.table_path(table)
+            # only the pages that are new or changed since the last parse, unless --full
+            filenames = None if args.full else _changed_pages(books_directory, table_path, archive)
+            if filenames == []:
+                print(f"No new pages in {books_directory}, {table_path} is up to date")
+                continue
+            if source == "gutenberg":
+                gb.process_books_gutenberg(books_directory, table_path, filenames, args.workers, archive)
+            else:
+                ol.process_books(books_directory, table_path, filenames, args.engine, args.workers, archive)
+        if source == "gutenberg":
+            gb.combine_csv()  # combine the two csv files
+        else:
+            ol.combine_csv()
+
+
+def clean(args):
+    import utils_cleaning_analysis as ca
+    ca.apply_same_schema(plot=args.plot)
+
+
+def match(args):
+    import utils_matching as um
+    blockers = None
+    if args.blocker == "index":
+        import utils_index as ix
+        blockers = [ix.index_blocker(k=args.k)]
+    # the incremental mode defaults to the thresholds of the last run
+    title_threshold = um.TITLE_THRESHOLD if args.title_threshold is None else args.title_threshold
+    author_threshold = um.AUTHOR_THRESHOLD if args.author_threshold is None else args.author_threshold
+    if args.mode == "full":
+        um.perform_matching(blockers, args.reference_pairs, args.workers, title_threshold, author_threshold)
+    elif args.mode == "chunked":
+        um.perform_matching_chunked(blockers, args.chunk_size, args.run_size, workers=args.workers,
+                                    title_threshold=title_threshold, author_threshold=author_threshold)
+    else:
+        um.incremental_matching(blockers, args.reference_pairs, args.workers, args.title_threshold,
+                                args.author_threshold)
+
+
+def _weights(text):
+    """Parses 'distance_title=0.5,cover_mse=0.2' (or 4 numbers in the order of SCORE_WEIGHTS) into a dict"""
+    import utils_matching as um
+    values = [value.strip() for value in text.split(',')]
+    if all('=' in value for value in values):
+        return {name.strip(): float(weight) for name, weight in (value.split('=') for value in values)}
+    if len(values) != len(um.SCORE_WEIGHTS):
+        raise argparse.ArgumentTypeError(f"expected {len(um.SCORE_WEIGHTS)} weights: {', '.join(um.SCORE_WEIGHTS)}")
+    return dict(zip(um.SCORE_WEIGHTS, map(float, values)))
+
+
+def rescore(args):
+    import csv
+    import pandas as pd
+    import utils_matching as um
+    if args.sweep is None:
+        try:
+            um.rescore(args.weights, args.title_threshold, args.author_threshold)
+        except ValueError as e:  # thresholds looser than the ones of the match run
+            raise SystemExit(str(e))
+        return
+    if args.reference_pairs is None:
+        raise SystemExit("--sweep needs --reference-pairs to evaluate the rankings")
+    if args.sweep == "grid":
+        weight_sets = um.weight_grid(args.step)
+    else:
+        weight_sets = pd.read_csv(args.sweep).to_dict('records')
+    try:
+        results = um.sweep_weights(weight_sets, args.reference_pairs, args.title_threshold, args.author_threshold)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    results.to_csv(args.output, index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    print(results.head(10).to_string(index=False))
+    print(f"Saved the results of {len(results)} weight sets to {args.output}")
 
 
+def pack(args):
+    import utils_archive as ar
+    archive = ar.PageArchive(args.archive)
+    for source in SOURCES:
+        for query in QUERIES:
+            for directory in _directories(source, query)[:2]:
+                if os.path.isdir(directory):
+                    ar.pack_directory(directory, archive, remove=args.remove)
+    archive.close()
+
+
+def cluster(args):
+    import utils_clustering as cl
+    if args.dedupe is not None:
+        cl.perform_dedupe(args.dedupe, workers=args.workers, max_score=args.max_score,
+                          keep_missing=args.keep_missing)
+        return
+    cl.perform_clustering(args.max_score, args.keep_missing, args.best_match_only)
+
+
+def serve(args):
+    import utils_service as sv
+    service = sv.MatchService(k=args.k, weights=args.weights, fetch_covers=args.fetch_covers)
+    sv.serve(service, args.host, args.port)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Crawls, parses, cleans and matches the books of Project "
+                                                 "Gutenberg and Open Library")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"],
+                        help="profile every stage into the profiles directory")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    crawl_parser = commands.add_parser("crawl", help="fetch the search result pages and the book pages")
+    crawl_parser.add_argument("--source", nargs="+", choices=SOURCES, default=SOURCES)
+    crawl_parser.add_argument("--query", nargs="+", choices=QUERIES, default=QUERIES)
+    crawl_parser.add_argument("--pages", type=int, default=50, help="search result pages per query")
+    crawl_parser.add_argument("--concurrency", type=int, default=8, help="book pages fetched in parallel")
+    crawl_parser.add_argument("--rate", type=float, default=1.0, help="requests per second per site")
+    crawl_parser.add_argument("--max-age", type=float, default=None,
+                              help="revalidate book pages fetched more than this many seconds ago")
+    crawl_parser.add_argument("--archive", default=None,
+                              help="store the pages in this page archive instead of one file per page")
+    crawl_parser.add_argument("--report", default="crawl_report.json")
+    crawl_parser.set_defaults(func=crawl)
+
+    parse_parser = commands.add_parser("parse", help="extract the books of the saved pages")
+    parse_parser.add_argument("--source", nargs="+", choices=SOURCES, default=SOURCES)
+    parse_parser.add_argument("--engine", choices=["bs4", "lxml"], default="bs4",
+                              help="extraction engine of the Open Library pages")
+    parse_parser.add_argument("--workers", type=int, default=1, help="parsing processes")
+    parse_parser.add_argument("--full", action="store_true",
+                              help="parse all pages instead of the pages saved since the last parse")
+    parse_parser.add_argument("--archive", default=None, help="read the pages from this page archive")
+    parse_parser.add_argument("--report", default="parse_report.json")
+    parse_parser.set_defaults(func=parse)
+
+    clean_parser = commands.add_parser("clean", help="clean both tables and give them the same schema")
+    clean_parser.add_argument("--plot", action="store_true", help="show the histograms of the columns")
+    clean_parser.add_argument("--report", default="cleaning_report.json")
+    clean_parser.set_defaults(func=clean)
+
+    match_parser = commands.add_parser("match", help="match the cleaned tables into tableC")
+    match_parser.add_argument("--mode", choices=["full", "chunked", "incremental"], default="full",
+                              help="chunked: out-of-core matching, incremental: only the changed records")
+    match_parser.add_argument("--blocker", choices=["default", "index"], default="default",
+                              help="default blocking pipeline or top-k of the similarity index")
+    match_parser.add_argument("--k", type=int, default=10, help="candidates per record of the index blocker")
+    match_parser.add_argument("--workers", type=int, default=1, help="scoring processes")
+    match_parser.add_argument("--reference-pairs", default=None,
+                              help="CSV of known matches to report the pair completeness of blocking")
+    match_parser.add_argument("--title-threshold", type=float, default=None,
+                              help="largest title distance of a match (default: 0.6, incremental: the one of the "
+                                   "last run)")
+    match_parser.add_argument("--author-threshold", type=float, default=None,
+                              help="largest author distance of a match (default: 0.35, incremental: the one of the "
+                                   "last run)")
+    match_parser.add_argument("--chunk-size", type=int, default=10000)
+    match_parser.add_argument("--run-size", type=int, default=100000)
+    match_parser.add_argument("--report", default="matching_report.json")
+    match_parser.set_defaults(func=match)
+
+    rescore_parser = commands.add_parser("rescore", help="rank the matches of the last match run again from their "
+                                                         "saved features")
+    rescore_parser.add_argument("--weights", type=_weights, default=None,
+                                help="score weights, e.g. 0.5,0.3,0.1,0.1 or distance_title=0.6,cover_mse=0.4")
+    rescore_parser.add_argument("--title-threshold", type=float, default=None,
+                                help="tighter title distance threshold (default: the one of the match run)")
+    rescore_parser.add_argument("--author-threshold", type=float, default=None,
+                                help="tighter author distance threshold (default: the one of the match run)")
+    rescore_parser.add_argument("--sweep", default=None,
+                                help="evaluate many weight sets instead: 'grid' or a CSV with a column per weight")
+    rescore_parser.add_argument("--step", type=float, default=0.1, help="weight step of the grid sweep")
+    rescore_parser.add_argument("--reference-pairs", default=None, help="CSV of known matches the sweep is scored on")
+    rescore_parser.add_argument("--output", default="weight_sweep.csv")
+    rescore_parser.add_argument("--report", default="rescore_report.json")
+    rescore_parser.set_defaults(func=rescore)
+
+    pack_parser = commands.add_parser("pack", help="move the saved pages into a page archive")
+    pack_parser.add_argument("--archive", default="page_archive")
+    pack_parser.add_argument("--remove", action="store_true", help="delete the page files once archived")
+    pack_parser.add_argument("--report", default="pack_report.json")
+    pack_parser.set_defaults(func=pack)
+
+    cluster_parser = commands.add_parser("cluster", help="group the matched records of both tables into entities")
+    cluster_parser.add_argument("--max-score", type=float, default=None,
+                                help="largest score of the pairs that are merged (default: every pair)")
+    cluster_parser.add_argument("--keep-missing", action="store_true", help="also merge the pairs without a score")
+    cluster_parser.add_argument("--best-match-only", action="store_true",
+                                help="link every Open Library record to its best Gutenberg match only")
+    cluster_parser.add_argument("--dedupe", choices=["a", "b"], default=None,
+                                help="find the duplicates within table_a or table_b instead (merged by the next "
+                                     "cluster run)")
+    cluster_parser.add_argument("--workers", type=int, default=1, help="scoring processes of --dedupe")
+    cluster_parser.add_argument("--report", default="clustering_report.json")
+    cluster_parser.set_defaults(func=cluster)
+
+    serve_parser = commands.add_parser("serve", help="answer match queries over HTTP (POST /match, GET /stats)")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8750)
+    serve_parser.add_argument("--k", type=int, default=50, help="candidates per record from the similarity index")
+    serve_parser.add_argument("--weights", type=_weights, default=None, help="score weights (see rescore)")
+    serve_parser.add_argument("--fetch-covers", action="store_true",
+                              help="download the covers of table_b that are not in the cover cache at startup")
+    serve_parser.add_argument("--report", default="service_report.json")
+    serve_parser.set_defaults(func=serve)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    if args.profile:
+        mt.PROFILE_ENGINE = args.profile
+    args.func(args)
+    mt.write_report(args.report)  # stage timings, HTTP counters and latencies of the run
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Cover fetcher against a local HTTP server standing in for the cover hosts"""
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import utils_covers as cv
+import utils_http as hp
+
+STATUS = {'/gone.jpg': 410, '/missing.jpg': 404, '/error.jpg': 500}
+
+
+@pytest.fixture
+def server():
+    requests_seen = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen[self.path] += 1
+            status = STATUS.get(self.path, 200)
+            body = f"image {self.path}".encode('utf-8') if status == 200 else b''
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", requests_seen
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _files(directory):
+    return sorted(os.path.relpath(os.path.join(root, name), directory)
+                  for root, _, names in os.walk(directory) for name in names)
+
+
+def test_fetch_covers_downloads_every_cover_once(server, tmp_path):
+    base_url, requests_seen = server
+    urls = [f"{base_url}/{name}.jpg" for name in ['a', 'b', 'a', 'missing', 'gone', 'error', 'b']] + [None, '']
+    with requests.Session() as session:
+        paths = cv.fetch_covers(urls, cache_dir=str(tmp_path), max_workers=4, session=session)
+    assert set(paths) == {url for url in urls if url}
+    assert requests_seen == {'/a.jpg': 1, '/b.jpg': 1, '/missing.jpg': 1, '/gone.jpg': 1, '/error.jpg': 1}
+    with open(paths[f"{base_url}/a.jpg"], 'rb') as f:
+        assert f.read() == b'image /a.jpg'
+    for name in ['missing', 'gone', 'error']:
+        assert paths[f"{base_url}/{name}.jpg"] is None
+    # 404 and 410 are remembered, other errors are tried again by the next run
+    for name, remembered in [('missing', True), ('gone', True), ('error', False)]:
+        path = cv.cover_cache_path(f"{base_url}/{name}.jpg", str(tmp_path))
+        assert os.path.exists(path + cv.MISSING_SUFFIX) == remembered
+    assert not any(name.endswith('.tmp') for name in _files(tmp_path))
+
+
+def test_second_run_sends_no_requests(server, tmp_path):
+    base_url, requests_seen = server
+    urls = [f"{base_url}/{name}.jpg" for name in ['a', 'b', 'missing', 'gone']]
+    with requests.Session() as session:
+        first = cv.fetch_covers(urls, cache_dir=str(tmp_path), session=session)
+        requests_seen.clear()
+        second = cv.fetch_covers(urls, cache_dir=str(tmp_path), session=session)
+    assert sum(requests_seen.values()) == 0
+    assert second == first
+
+
+def test_interrupted_write_leaves_no_partial_cover(server, tmp_path, monkeypatch):
+    base_url, _ = server
+    url = f"{base_url}/a.jpg"
+
+    def interrupted(src, dst):
+        raise OSError("interrupted")
+
+    monkeypatch.setattr(hp.os, 'replace', interrupted)
+    with requests.Session() as session, pytest.raises(OSError):
+        cv.fetch_cover(url, session, str(tmp_path))
+    assert not os.path.exists(cv.cover_cache_path(url, str(tmp_path)))
+    monkeypatch.undo()
+    with requests.Session() as session:
+        assert cv.fetch_cover(url, session, str(tmp_path)) == cv.cover_cache_path(url, str(tmp_path))
@@ -0,0 +1,133 @@
+"""
+Runs the match service over localhost on small tables matched by perform_matching and checks that its
+answers are the rows of tableC. The covers are put in the cover cache beforehand, nothing is downloaded
+"""
+import os
+
+import numpy as np
+import pytest
+import requests
+
+import utils_covers as cv
+import utils_matching as um
+import utils_service as sv
+import utils_storage as st
+
+TABLE_A = [
+    ('OL1W', 'Pride and Prejudice', 'Jane Austen', 'Penguin', '1813', 'English'),
+    ('OL2W', 'Emma', 'Jane Austen', 'Penguin', '1815', ''),
+    ('OL3W', 'Dracula', 'Bram Stoker', 'Archibald Constable', '1897', 'English'),
+    ('OL4W', 'Frankenstein', 'Mary Wollstonecraft Shelley', 'Lackington', '1818', 'English'),
+    ('OL5W', 'Les Miserables', 'Victor Hugo', 'Lacroix', '1862', 'French'),
+    ('OL6W', 'The Time Machine', 'H. G. Wells', 'Heinemann', '1895', 'English'),
+    ('OL7W', 'A Book Nobody Wrote', 'Nobody', 'Nowhere', '2000', 'English'),
+]
+TABLE_B = [
+    ('1342', 'Pride and Prejudice', 'Jane Austen', '1998', 'English'),
+    ('158', 'Emma', 'Jane Austen', '1994', 'English'),
+    ('345', 'Dracula', 'Bram Stoker', '1995', 'English'),
+    ('84', 'Frankenstein; Or, The Modern Prometheus', 'Mary Wollstonecraft Shelley', '1993', 'English'),
+    ('135', 'Les Misérables', 'Victor Hugo', '1994', 'French'),
+    ('35', 'The Time Machine', 'H. G. Wells', '2004', 'English'),
+]
+MISSING_COVERS = {'OL2W', '35'}  # covers that do not exist (cached as missing)
+FEATURES = ['distance_title', 'distance_author', 'difference_year', 'language_match', 'cover_mse', 'score']
+
+
+def _cover_url(record_id):
+    return f"https://covers.example.org/{record_id}.jpg"
+
+
+def _cache_cover(record_id, rng):
+    from PIL import Image
+    path = cv.cover_cache_path(_cover_url(record_id))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if record_id in MISSING_COVERS:
+        open(path + cv.MISSING_SUFFIX, 'wb').close()
+    else:
+        Image.fromarray(rng.integers(0, 256, (30, 20, 3), dtype=np.uint8)).save(path, format='PNG')
+
+
+def _record(row):
+    record_id, title, author, publisher, year, language = row
+    return {'ID': record_id, 'title': title, 'author': author, 'publisher': publisher,
+            'first_published_year': year, 'language': language or None, 'cover_image': _cover_url(record_id)}
+
+
+@pytest.fixture(scope='module')
+def base_url(tmp_path_factory):
+    import pandas as pd
+    directory = tmp_path_factory.mktemp('service')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        rng = np.random.default_rng(0)
+        table_a = pd.DataFrame([_record(row) for row in TABLE_A])
+        table_b = pd.DataFrame([{'ID': record_id, 'title': title, 'author': author, 'publisher': 'Project Gutenberg',
+                                 'first_published_year': year, 'language': language,
+                                 'cover_image': _cover_url(record_id)}
+                                for record_id, title, author, year, language in TABLE_B])
+        for record_id in list(table_a['ID']) + list(table_b['ID']):
+            _cache_cover(record_id, rng)
+        st.write_table(table_a, st.table_path('table_a_cleaned'), st.TABLE_A)
+        st.write_table(table_b, st.table_path('table_b_cleaned'), st.TABLE_B)
+        um.perform_matching()
+        server, url = sv.start_in_thread(sv.MatchService(k=10))
+        try:
+            yield url
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='module')
+def table_c(base_url):
+    table_c = st.read_table(st.table_path('tableC'), st.TABLE_C)
+    assert len(table_c) >= 4
+    assert (table_c['cover_mse'] > 0).any()  # some pairs compare real covers
+    return table_c
+
+
+def _check_table_c(matches, table_c):
+    """Every returned pair that is in tableC has its features and score"""
+    found = 0
+    for match in matches:
+        rows = table_c[(table_c['ltable_ID'] == match['ltable_ID']).to_numpy() &
+                       (table_c['rtable_ID'] == match['rtable_ID']).to_numpy()]
+        if len(rows):
+            found += 1
+            for feature in FEATURES:
+                assert match[feature] == pytest.approx(float(rows[feature].iloc[0]), abs=1e-12), feature
+    return found
+
+
+def test_health_and_stats(base_url):
+    assert requests.get(f"{base_url}/health").json() == {'status': 'ok'}
+    stats = requests.get(f"{base_url}/stats").json()
+    assert stats['cover_store']['records'] == len(TABLE_B)
+    assert requests.get(f"{base_url}/unknown").status_code == 404
+
+
+def test_single_record_matches_table_c(base_url, table_c):
+    record = _record(TABLE_A[2])
+    matches = requests.post(f"{base_url}/match", json={'record': record}).json()['matches']
+    assert [match['rtable_ID'] for match in matches][:1] == [345]
+    assert _check_table_c(matches, table_c) == (table_c['ltable_ID'] == 'OL3W').sum()
+
+
+def test_batch_matches_table_c(base_url, table_c):
+    records = [_record(row) for row in TABLE_A]
+    records.append(records[0])  # a repeated record gets its own list
+    matches = requests.post(f"{base_url}/match", json={'records': records}).json()['matches']
+    assert len(matches) == len(records)
+    assert matches[-1] == matches[0]
+    assert matches[len(TABLE_A) - 1] == []  # OL7W has no match
+    assert _check_table_c([match for record_matches in matches[:-1] for match in record_matches],
+                          table_c) == len(table_c)
+
+
+def test_bad_request(base_url):
+    response = requests.post(f"{base_url}/match", data=b'{"nothing": 1}')
+    assert response.status_code == 400
@@ -0,0 +1,236 @@
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+import utils_metrics as mt
+
+ARCHIVE_DIR = "page_archive"
+SEGMENT_SIZE = 256 * 2 ** 20  # a new segment file is started once the current one reaches this size
+# record header: magic, codec, stored length, raw length, sha256 of the raw content
+HEADER = struct.Struct('>4sBII32s')
+MAGIC = b'PGR1'
+RAW, ZLIB, ZSTD = 0, 1, 2
+
+_archives = {}  # archives opened by the parsing processes, by directory
+
+
+def _compress(content, level=3):
+    """Compresses with zstd if the zstandard package is installed, zlib otherwise"""
+    try:
+        import zstandard
+    except ImportError:
+        return ZLIB, zlib.compress(content, 6)
+    return ZSTD, zstandard.ZstdCompressor(level=level).compress(content)
+
+
+def _decompress(codec, payload, raw_length):
+    if codec == ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(payload, max_output_size=raw_length)
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    return bytes(payload)
+
+
+class PageArchive:
+    """
+    Append-only archive of raw pages replacing the one-file-per-page directories of the crawls.
+    Every distinct content is compressed once into a segment file (segment_<n>.pages, records of a
+    HEADER followed by the compressed content), pages with the same content (e.g. the books found
+    by several queries) share it. The offset index (index.sqlite) maps the path of a page, the file
+    it would have been saved to like 'gutenberg_html_books_fantasy/1342.html', to its content.
+    Segments are memory-mapped for reading, iterating a directory reads them sequentially
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR, segment_size=SEGMENT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.maps = {}
+        self.connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS contents (
+                    content_hash TEXT PRIMARY KEY,
+                    segment INTEGER,
+                    offset INTEGER,
+                    length INTEGER,
+                    raw_length INTEGER,
+                    codec INTEGER
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    path TEXT PRIMARY KEY,
+                    directory TEXT,
+                    content_hash TEXT,
+                    url TEXT,
+                    stored_at REAL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS pages_directory ON pages (directory)")
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"segment_{segment:05d}.pages")
+
+    def _append(self, content_hash, content):
+        """Writes a compressed record at the end of the last segment, returns its location"""
+        codec, payload = _compress(content)
+        if len(payload) >= len(content):
+            codec, payload = RAW, content
+        segment = self.connection.execute("SELECT COALESCE(MAX(segment), 0) FROM contents").fetchone()[0]
+        path = self._segment_path(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+            segment += 1
+            path = self._segment_path(segment)
+        with open(path, 'ab') as f:
+            # a record left incomplete by a crash is never indexed, the next one is appended after it
+            offset = f.tell() + HEADER.size
+            f.write(HEADER.pack(MAGIC, codec, len(payload), len(content), bytes.fromhex(content_hash)))
+            f.write(payload)
+        return segment, offset, len(payload), len(content), codec
+
+    def put(self, path, content, url=None):
+        """
+        Stores the content (bytes) of the page path, the content is only written if no other page has it
+        :return: True if the content was new, False if it was deduplicated
+        """
+        content_hash = hashlib.sha256(content).hexdigest()
+        with self.lock, self.connection:
+            new = self.connection.execute("SELECT 1 FROM contents WHERE content_hash = ?",
+                                          (content_hash,)).fetchone() is None
+            if new:
+                location = self._append(content_hash, content)
+                self.connection.execute("INSERT INTO contents VALUES (?, ?, ?, ?, ?, ?)", (content_hash, *location))
+            self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                                    (_normalize(path), _directory(path), content_hash, url, time.time()))
+        mt.count('archive_pages')
+        mt.count('archive_bytes', len(content))
+        if new:
+            mt.count('archive_contents')
+        else:
+            mt.count('archive_pages_deduplicated')
+        return new
+
+    def exists(self, path):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM pages WHERE path = ?",
+                                           (_normalize(path),)).fetchone() is not None
+
+    def content_hash(self, path):
+        """SHA-256 of the stored content of path (None if it is not archived)"""
+        with self.lock:
+            row = self.connection.execute("SELECT content_hash FROM pages WHERE path = ?",
+                                          (_normalize(path),)).fetchone()
+        return row[0] if row else None
+
+    def _view(self, segment, end):
+        """Memory map of a segment covering at least its first end bytes (remapped when the segment grew)"""
+        view = self.maps.get(segment)
+        if view is None or len(view) < end:
+            with open(self._segment_path(segment), 'rb') as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = view
+        return view
+
+    def _read(self, segment, offset, length, raw_length, codec):
+        with self.lock:
+            view = self._view(segment, offset + length)
+        return _decompress(codec, memoryview(view)[offset:offset + length], raw_length)
+
+    def read(self, path):
+        """Content of the page path (bytes), KeyError if it is not archived"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT segment, offset, length, raw_length, codec FROM pages JOIN contents USING (content_hash) "
+                "WHERE path = ?", (_normalize(path),)).fetchone()
+        if row is None:
+            raise KeyError(path)
+        return self._read(*row)
+
+    def list_pages(self, directory, filenames=None, since=None):
+        """
+        Paths of the pages of directory in the order of their contents in the archive (sequential reads)
+        :param filenames: only these pages
+        :param since: only the pages stored after this time (seconds since the epoch)
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path FROM pages JOIN contents USING (content_hash) WHERE directory = ? AND stored_at > ? "
+                "ORDER BY segment, offset, path", (_normalize(directory), since or 0)).fetchall()
+        paths = [row[0] for row in rows]
+        if filenames is not None:
+            filenames = {os.path.basename(filename) for filename in filenames}
+            paths = [path for path in paths if os.path.basename(path) in filenames]
+        return paths
+
+    def iter_pages(self, directory, filenames=None):
+        """Yields the (path, content) of the pages of directory, reading the segments sequentially"""
+        for path in self.list_pages(directory, filenames):
+            yield path, self.read(path)
+
+    def stats(self):
+        """Number of pages and distinct contents, raw and stored bytes of the distinct contents"""
+        with self.lock:
+            pages = self.connection.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            contents, raw_bytes, stored_bytes = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_length), 0), COALESCE(SUM(length), 0) FROM contents").fetchone()
+        return {'pages': pages, 'contents': contents, 'raw_bytes': raw_bytes, 'stored_bytes': stored_bytes}
+
+    def close(self):
+        with self.lock:
+            for view in self.maps.values():
+                view.close()
+            self.maps.clear()
+            self.connection.close()
+
+
+def _normalize(path):
+    return os.path.normpath(path).replace(os.sep, '/')
+
+
+def _directory(path):
+    return os.path.dirname(_normalize(path))
+
+
+def open_archive(directory=ARCHIVE_DIR):
+    """Archive of directory opened once per process (used by the parsing processes)"""
+    if directory not in _archives:
+        _archives[directory] = PageArchive(directory)
+    return _archives[directory]
+
+
+def read_pages(directory, archive=None):
+    """Yields the (path, text) of the .html pages of directory, from the archive if one is given"""
+    if archive is not None:
+        for path, content in archive.iter_pages(directory):
+            yield path, content.decode('utf-8')
+        return
+    for filename in os.listdir(directory):
+        if filename.endswith('.html'):
+            path = os.path.join(directory, filename)
+            with open(path, 'r', encoding='utf-8') as file:
+                yield path, file.read()
+
+
+def pack_directory(directory, archive, remove=False):
+    """
+    Moves the saved .html pages of directory into the archive
+    :param remove: delete the files once they are archived
+    :return: number of pages archived
+    """
+    count = 0
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.html'):
+            path = os.path.join(directory, filename)
+            with open(path, 'rb') as f:
+                archive.put(path, f.read())
+            if remove:
+                os.remove(path)
+            count += 1
+    print(f"Archived {count} pages of {directory}: {archive.stats()}")
+    return count
@@ -0,0 +1,255 @@
+import re
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import utils_normalization as nm
+
+STOP_WORDS = {"the", "a", "an", "and", "of", "in", "on", "to", "for", "with", "by", "at", "from",
+              "de", "la", "le", "el", "der", "die", "das", "und"}
+
+
+def title_tokens(text):
+    """Splits a title into lowercase word tokens without stop words"""
+    if pd.isna(text):
+        return []
+    return [token for token in re.findall(r"\w+", str(text).lower()) if token not in STOP_WORDS]
+
+
+def title_qgrams(text, q=3):
+    """Splits a title into lowercase character q-grams"""
+    if pd.isna(text):
+        return []
+    text = " ".join(str(text).lower().split())
+    if len(text) < q:
+        return [text] if text else []
+    return [text[i:i + q] for i in range(len(text) - q + 1)]
+
+
+def author_initial(name):
+    """Returns the initial of the last name (last word of the reordered author name)"""
+    if pd.isna(name):
+        return None
+    words = re.findall(r"[^\W\d_]+", str(name).lower())
+    return words[-1][0] if words else None
+
+
+def _candidates(table_a, table_b, a_pos, b_pos):
+    """Builds a deduplicated candidate set of (ltable_ID, rtable_ID) pairs from row positions"""
+    pairs = pd.DataFrame({
+        'ltable_ID': table_a['ID'].to_numpy()[np.asarray(a_pos, dtype=np.int64)],
+        'rtable_ID': table_b['ID'].to_numpy()[np.asarray(b_pos, dtype=np.int64)],
+    })
+    return pairs.drop_duplicates(ignore_index=True)
+
+
+def _positions(table_a, table_b, candidates):
+    """Maps the IDs of a candidate set back to row positions in table_a and table_b"""
+    a_pos = pd.Index(table_a['ID']).get_indexer(candidates['ltable_ID'])
+    b_pos = pd.Index(table_b['ID']).get_indexer(candidates['rtable_ID'])
+    return a_pos, b_pos
+
+
+def _keys(table, attr, key_func):
+    """Computes the blocking key of every row (None for missing keys), once per distinct value"""
+    return nm.map_distinct(table[attr], key_func, missing=key_func(None))
+
+
+def block_overlap(table_a, table_b, candidates=None, attr='title', q=None, overlap_size=1, max_block_size=None):
+    """
+    Token (or q-gram if q is given) inverted index blocker: keeps the pairs that share
+    at least overlap_size tokens on attr
+    :param max_block_size: tokens appearing in more rows of table_b than this are ignored
+    """
+    key_func = partial(title_qgrams, q=q) if q else title_tokens
+    if candidates is not None:
+        a_pos, b_pos = _positions(table_a, table_b, candidates)
+        tokens_a = _keys(table_a, attr, lambda value: set(key_func(value)))
+        tokens_b = _keys(table_b, attr, lambda value: set(key_func(value)))
+        keep = np.fromiter((len(tokens_a[i] & tokens_b[j]) >= overlap_size for i, j in zip(a_pos, b_pos)),
+                           dtype=bool, count=len(a_pos))
+        return candidates[keep].reset_index(drop=True)
+
+    def postings(table):
+        tokens = _keys(table, attr, lambda value: set(key_func(value)))
+        rows = [(token, pos) for pos, row_tokens in enumerate(tokens) for token in row_tokens]
+        return pd.DataFrame(rows, columns=['token', 'pos'])
+
+    postings_a = postings(table_a)
+    postings_b = postings(table_b)
+    if max_block_size is not None:
+        block_sizes = postings_b['token'].map(postings_b['token'].value_counts())
+        postings_b = postings_b[block_sizes <= max_block_size]
+    joined = postings_a.merge(postings_b, on='token', suffixes=('_a', '_b'))
+    overlap = joined.groupby(['pos_a', 'pos_b']).size()
+    overlap = overlap[overlap >= overlap_size]
+    return _candidates(table_a, table_b, overlap.index.get_level_values(0), overlap.index.get_level_values(1))
+
+
+def block_attr_equivalence(table_a, table_b, candidates=None, attr='language', key_func=None, allow_missing=True):
+    """
+    Keeps the pairs whose key on attr is equal. If allow_missing is set, rows with a missing
+    key are paired with every row of the other table (same semantics as language_match)
+    """
+    if key_func is None:
+        key_func = lambda value: None if pd.isna(value) or value == '' else value
+    keys_a = pd.Series(_keys(table_a, attr, key_func), dtype=object)
+    keys_b = pd.Series(_keys(table_b, attr, key_func), dtype=object)
+    if candidates is not None:
+        a_pos, b_pos = _positions(table_a, table_b, candidates)
+        left = keys_a.to_numpy()[a_pos]
+        right = keys_b.to_numpy()[b_pos]
+        missing = pd.isna(left) | pd.isna(right)
+        keep = (left == right) & ~missing
+        if allow_missing:
+            keep |= missing
+        return candidates[keep].reset_index(drop=True)
+
+    left = pd.DataFrame({'key': keys_a, 'pos_a': np.arange(len(keys_a))}).dropna()
+    right = pd.DataFrame({'key': keys_b, 'pos_b': np.arange(len(keys_b))}).dropna()
+    joined = left.merge(right, on='key')
+    a_pos = [joined['pos_a'].to_numpy()]
+    b_pos = [joined['pos_b'].to_numpy()]
+    if allow_missing:
+        # rows without a key can match anything on the other side
+        missing_a = np.flatnonzero(keys_a.isna().to_numpy())
+        missing_b = np.flatnonzero(keys_b.isna().to_numpy())
+        a_pos += [np.repeat(missing_a, len(keys_b)), np.tile(np.arange(len(keys_a)), len(missing_b))]
+        b_pos += [np.tile(np.arange(len(keys_b)), len(missing_a)), np.repeat(missing_b, len(keys_a))]
+    return _candidates(table_a, table_b, np.concatenate(a_pos), np.concatenate(b_pos))
+
+
+def block_author_initial(table_a, table_b, candidates=None, attr='author'):
+    """
+    Keeps the pairs whose authors share the last name initial. Pairs with a missing author
+    are dropped since perform_matching gives them an author distance of 1
+    """
+    return block_attr_equivalence(table_a, table_b, candidates, attr=attr, key_func=author_initial,
+                                  allow_missing=False)
+
+
+def block_year_window(table_a, table_b, candidates=None, attr='first_published_year', window=5, allow_missing=True):
+    """Keeps the pairs whose years are at most window years apart"""
+    years_a = pd.to_numeric(table_a[attr], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    years_b = pd.to_numeric(table_b[attr], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    if candidates is not None:
+        a_pos, b_pos = _positions(table_a, table_b, candidates)
+        left = years_a[a_pos]
+        right = years_b[b_pos]
+        missing = np.isnan(left) | np.isnan(right)
+        keep = np.abs(left - right) <= window
+        if allow_missing:
+            keep |= missing
+        return candidates[keep].reset_index(drop=True)
+
+    # sort table_b by year and look up the window of every table_a row with a binary search
+    known_b = np.flatnonzero(~np.isnan(years_b))
+    order = known_b[np.argsort(years_b[known_b], kind='stable')]
+    sorted_years = years_b[order]
+    known_a = np.flatnonzero(~np.isnan(years_a))
+    start = np.searchsorted(sorted_years, years_a[known_a] - window, side='left')
+    end = np.searchsorted(sorted_years, years_a[known_a] + window, side='right')
+    counts = end - start
+    a_pos = [np.repeat(known_a, counts)]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    b_pos = [order[np.repeat(start, counts) + offsets]]
+    if allow_missing:
+        missing_a = np.flatnonzero(np.isnan(years_a))
+        missing_b = np.flatnonzero(np.isnan(years_b))
+        a_pos += [np.repeat(missing_a, len(years_b)), np.tile(np.arange(len(years_a)), len(missing_b))]
+        b_pos += [np.tile(np.arange(len(years_b)), len(missing_a)), np.repeat(missing_b, len(years_a))]
+    return _candidates(table_a, table_b, np.concatenate(a_pos), np.concatenate(b_pos))
+
+
+def block_sorted_neighbourhood(table_a, table_b, candidates=None, attr='title', window=5, key_func=None):
+    """
+    Sorted neighbourhood blocker: sorts the rows of both tables by a key on attr and pairs
+    rows of table_a and table_b that are less than window positions apart
+    """
+    if key_func is None:
+        key_func = lambda value: " ".join(title_tokens(value))
+    keys = _keys(table_a, attr, key_func) + _keys(table_b, attr, key_func)
+    side = np.concatenate([np.zeros(len(table_a), dtype=bool), np.ones(len(table_b), dtype=bool)])
+    pos = np.concatenate([np.arange(len(table_a)), np.arange(len(table_b))])
+    order = np.array(sorted(range(len(keys)), key=lambda i: keys[i] or ''), dtype=np.int64)
+    side = side[order]
+    pos = pos[order]
+    a_pos = []
+    b_pos = []
+    for offset in range(1, window):
+        first, second = side[:-offset], side[offset:]
+        a_then_b = ~first & second
+        b_then_a = first & ~second
+        a_pos += [pos[:-offset][a_then_b], pos[offset:][b_then_a]]
+        b_pos += [pos[offset:][a_then_b], pos[:-offset][b_then_a]]
+    window_pairs = _candidates(table_a, table_b, np.concatenate(a_pos), np.concatenate(b_pos))
+    if candidates is not None:
+        return candidates.merge(window_pairs, on=['ltable_ID', 'rtable_ID'])
+    return window_pairs
+
+
+def union_candidates(*candidate_sets):
+    """Combines candidate sets via union"""
+    return pd.concat(candidate_sets, ignore_index=True).drop_duplicates(ignore_index=True)
+
+
+def union_blocker(*blockers):
+    """Combines blockers into a single blocker returning the union of their candidate sets"""
+    def blocker(table_a, table_b, candidates=None):
+        return union_candidates(*[block(table_a, table_b, candidates) for block in blockers])
+    return blocker
+
+
+def default_blockers():
+    """
+    Default blocking pipeline for perform_matching: title q-gram index or sorted neighbourhood,
+    refined by author initial and language blocks
+    """
+    return [
+        union_blocker(
+            partial(block_overlap, attr='title', q=3, overlap_size=3, max_block_size=500),
+            partial(block_sorted_neighbourhood, attr='title', window=5),
+        ),
+        block_author_initial,
+        partial(block_attr_equivalence, attr='language'),
+    ]
+
+
+def block_tables(table_a, table_b, blockers=None):
+    """
+    Runs a blocking pipeline. The first blocker generates the candidate set from both tables,
+    every following blocker refines the candidate set of the previous one
+    :param blockers: list of callables (table_a, table_b, candidates) -> candidates
+    :return: DataFrame of (ltable_ID, rtable_ID) candidate pairs
+    """
+    if blockers is None:
+        blockers = default_blockers()
+    candidates = None
+    for blocker in blockers:
+        candidates = blocker(table_a, table_b, candidates)
+    # keep the order of the cartesian product so the output does not depend on the blockers
+    a_pos, b_pos = _positions(table_a, table_b, candidates)
+    order = np.lexsort((b_pos, a_pos))
+    return candidates.iloc[order].reset_index(drop=True)
+
+
+def blocking_report(candidates, table_a, table_b, reference_pairs=None, cartesian_size=None):
+    """
+    Computes the reduction ratio of a candidate set and, if reference (true match) pairs are
+    given, its pair completeness
+    :param cartesian_size: number of pairs the candidates were selected from (default: all pairs of both tables)
+    """
+    if cartesian_size is None:
+        cartesian_size = len(table_a) * len(table_b)
+    report = {
+        'cartesian_size': cartesian_size,
+        'candidate_pairs': len(candidates),
+        'reduction_ratio': 1 - len(candidates) / cartesian_size if cartesian_size else 0.0,
+    }
+    if reference_pairs is not None:
+        reference_pairs = reference_pairs[['ltable_ID', 'rtable_ID']].drop_duplicates()
+        found = reference_pairs.merge(candidates, on=['ltable_ID', 'rtable_ID'])
+        report['reference_pairs'] = len(reference_pairs)
+        report['pair_completeness'] = len(found) / len(reference_pairs) if len(reference_pairs) else 1.0
+    return report
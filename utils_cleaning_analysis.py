@@ -1,7 +1,13 @@
-import csv
+import re
+import warnings
 
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+
+import utils_metrics as mt
+import utils_normalization as nm
+import utils_storage as st
+
 def reorder_author_name(name):
     if pd.isna(name):  # Check for missing values
         return name
@@ -14,19 +20,85 @@ def reorder_author_name(name):
         return name
     return f"{parts[-1]} {' '.join(parts[:-1])}"  # Reorder the name
 
+def reorder_author_names(names):
+    """Vectorized reorder_author_name for a whole column (same results), each distinct name is reordered once"""
+    codes, uniques = pd.factorize(names)
+    # object dtype so the patterns use Python's unicode whitespace like str.split
+    uniques = pd.Series(np.asarray(uniques, dtype=object), dtype=object)
+    # "last, first" -> "first last"
+    comma = uniques.str.extract(r'^([^,]*),(.*)\Z', flags=re.DOTALL)
+    with_comma = comma[1].str.strip() + ' ' + comma[0].str.strip()
+    # "first middle last" -> "last first middle"
+    words = uniques.str.extract(r'^\s*(.*?\S)\s+(\S+)\s*\Z', flags=re.DOTALL)
+    reordered = words[1] + ' ' + words[0].str.replace(r'\s+', ' ', regex=True)
+    reordered = with_comma.fillna(reordered).fillna(uniques).to_numpy(dtype=object)
+    return pd.Series(np.append(reordered, None)[codes], index=names.index, dtype='string')
+
 def detect_outliers(series, threshold=1.5):
-    q1 = series.quantile(0.1)
-    q3 = series.quantile(0.9)
+    q1, q3 = series.quantile([0.1, 0.9])
     iqr = q3 - q1
     lower_bound = q1 - threshold * iqr
     upper_bound = q3 + threshold * iqr
     return series[(series < lower_bound) | (series > upper_bound)]
 
-def apply_same_schema():
-    table_a = pd.read_csv('openlibrary_books.csv')
-    table_b = pd.read_csv('gutenberg_books.csv')
-    # drop rows with only null values
-    table_b = table_b.dropna(how='all')
+def profile_columns(table, text_columns, numerical_columns, threshold=1.5):
+    """
+    Profiles all columns at once: null fraction, statistics of the lengths (text columns) or values
+    (numerical columns), 10% / 90% quantiles and the outliers outside the bounds used by detect_outliers
+    :return: (profile DataFrame with one row per column, boolean DataFrame marking the outliers)
+    """
+    columns = list(text_columns) + list(numerical_columns)
+    # one float matrix of lengths and values, computed once and shared by all statistics
+    values = np.column_stack(
+        [table[col].str.len().to_numpy(dtype=float, na_value=np.nan) for col in text_columns] +
+        [pd.to_numeric(table[col], errors='coerce').to_numpy(dtype=float, na_value=np.nan) for col in numerical_columns]
+    ) if len(table) else np.empty((0, len(columns)))
+    present = ~np.isnan(values)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)  # columns without values give nan
+        q1, q3 = np.nanquantile(values, [0.1, 0.9], axis=0)
+        profile = pd.DataFrame({
+            'null_fraction': table[columns].isnull().mean().to_numpy(),
+            'mean': np.nanmean(values, axis=0),
+            'min': np.nanmin(values, axis=0),
+            'max': np.nanmax(values, axis=0),
+            'q10': q1,
+            'q90': q3,
+        }, index=columns)
+    iqr = q3 - q1
+    profile['lower_bound'] = q1 - threshold * iqr
+    profile['upper_bound'] = q3 + threshold * iqr
+    outliers = present & ((values < profile['lower_bound'].to_numpy()) | (values > profile['upper_bound'].to_numpy()))
+    profile['outliers'] = outliers.sum(axis=0)
+    return profile, pd.DataFrame(outliers, columns=columns, index=table.index)
+
+def plot_profile(table, text_columns, numerical_columns):
+    """Histograms of the lengths of the text columns and the values of the numerical columns"""
+    import matplotlib.pyplot as plt
+    for col in text_columns + numerical_columns:
+        plt.figure()
+        if col in text_columns:
+            table[col].str.len().hist()
+            plt.xlabel('Length')
+        elif col in numerical_columns:
+            table[col].astype(float).hist()
+            plt.xlabel('Value')
+        plt.ylabel('Frequency')
+        plt.title(col)
+    plt.show()
+
+def apply_same_schema(plot=False):
+    """
+    Cleans both tables, gives them the same schema and saves them as table_a_cleaned and table_b_cleaned
+    :param plot: show the histograms of the columns of table_a
+    """
+    with mt.stage('cleaning/read') as s:
+        table_a = st.read_table(st.table_path('openlibrary_books'), st.OPENLIBRARY_BOOKS)
+        table_b = st.read_table(st.table_path('gutenberg_books'), st.GUTENBERG_BOOKS)
+        s.rows_in = len(table_a) + len(table_b)
+        # drop rows with only null values
+        table_b = table_b.dropna(how='all')
+        s.rows_out = len(table_a) + len(table_b)
     # Apply the same schema to both tables
     gutenberg_schema = ['ID', 'title', 'author', 'publisher', 'first_published_year', 'language', 'cover_image']
     openlibrary_schema = ['ID', 'title', 'subtitle', 'author', 'publisher', 'first_published_year', 'language',
@@ -39,58 +111,45 @@ def apply_same_schema():
     table_a = table_a.drop(columns=[col for col in columns_to_drop])
     print(table_a.columns == table_b.columns)
     print(f"Schema of both tables {table_a.columns=}")
-    # compute missing values
-    missing_values = table_a.isnull().sum()
-    print(f"Missing values in table_a:\nFraction:\n{missing_values/len(table_a)}\nPercentage:\n{(missing_values/len(table_a)*100).round(2)}%")
-    missing_values = table_b.isnull().sum()
-    # print(f"Missing values in table_b:\nFraction:\n{missing_values/len(table_b)}\nPercentage:\n{(missing_values/len(table_b)*100).round(2)}%")
     # classify the columns as numerical or categorical
     # for text columms report average, max and min length
     text_columns = ['ID', 'title', 'author', 'publisher', 'language', 'cover_image']
     numerical_columns = ['first_published_year', ]
-    for col in text_columns:
-        print(f"{col}:\nAverage length: {table_a[col].str.len().mean()}\nMax length: {table_a[col].str.len().max()}\nMin length: {table_a[col].str.len().min()}")
-    # create histograms for text columns
-    for col in text_columns + numerical_columns:
-        if col in text_columns:
-            table_a[col].str.len().hist()
-            plt.xlabel('Length')
-        elif col in numerical_columns:
-            table_a[col].hist()
-            plt.xlabel('Value')
-        plt.ylabel('Frequency')
-        plt.title(col)
-        # plt.show()
-
-        # Identify outliers in numerical columns
+    # compute missing values, length statistics and outliers of all columns in one pass
+    with mt.stage('cleaning/profile', rows_in=len(table_a)):
+        profile, outliers = profile_columns(table_a, text_columns, numerical_columns)
+    missing_values = table_a.isnull().mean()
+    print(f"Missing values in table_a:\nFraction:\n{missing_values}\nPercentage:\n{(missing_values*100).round(2)}%")
+    print(f"Profile of table_a:\n{profile}")
+    if plot:
+        plot_profile(table_a, text_columns, numerical_columns)
+    # Identify outliers in numerical columns
     for col in numerical_columns:
-        outliers = detect_outliers(table_a[col].dropna())
-        print(f"Outliers in {col}: {outliers.values}")
+        print(f"Outliers in {col}: {table_a[col][outliers[col]].values}")
     for col in text_columns:
-        outliers = detect_outliers(table_a[col].str.len().dropna())
-        print(f"Outliers in {col}: {set(table_a[col][table_a[col].str.len().isin(outliers)].values)}")
+        print(f"Outliers in {col}: {set(table_a[col][outliers[col]].values)}")
 
 
 
 
     # analyse the language column
-    set_lang_a = set(table_a['language'])
+    set_lang_a = set(table_a['language'].unique())
     # print(f"Languages in table_a: {set_lang_a}")
-    set_lang_b = set(table_b['language'])
+    set_lang_b = set(table_b['language'].unique())
     # print(f"Languages in table_b: {set_lang_b}")
-    # standardize the language column
-    table_a['language'] = table_a['language'].replace('English, Middle (1100-1500)', 'Middle English')
-    table_a['language'] = table_a['language'].replace('Undetermined', '')
-    table_a['language'] = table_a['language'].replace('Spanish, English', 'English')
-    table_a['language'] = table_a['language'].replace('French, English', 'French')
-    # standardize the name column
-    table_b['author'] = table_b['author'].map(reorder_author_name) # replace last name, first name with first name last name
-    # replace same publisher / author names with a single name
-    table_a['author'] = table_a['author'].replace('3dtotal 3dtotal Publishing', '3DTotal Publishing')
-    table_a['author'] = table_a['author'].replace('3dtotal Publishing', '3DTotal Publishing')
-    table_a['author'] = table_a['author'].replace('3DTotal.com', '3DTotal Publishing')
-    table_a.to_csv('table_a_cleaned.csv', index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
-    table_b.to_csv('table_b_cleaned.csv', index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    with mt.stage('cleaning/normalize', rows_in=len(table_a) + len(table_b)) as s:
+        # standardize the language column
+        # (every distinct value is normalized once, see utils_normalization)
+        table_a['language'] = nm.normalize_column(table_a['language'], nm.canonical_language)
+        # standardize the name column
+        table_b['author'] = reorder_author_names(table_b['author']) # replace last name, first name with first name last name
+        # replace same publisher / author names with a single name
+        table_a['author'] = nm.normalize_column(table_a['author'], nm.canonical_author)
+        st.write_table(table_a, st.table_path('table_a_cleaned'), st.TABLE_A)
+        st.write_table(table_b, st.table_path('table_b_cleaned'), st.TABLE_B)
+        s.rows_out = len(table_a) + len(table_b)
 
 
-apply_same_schema()
\ No newline at end of file
+if __name__ == "__main__":
+    apply_same_schema()
+    mt.write_report("cleaning_report.json")
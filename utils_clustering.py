@@ -0,0 +1,187 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import utils_blocking as bl
+import utils_matching as um
+import utils_metrics as mt
+import utils_storage as st
+
+CLUSTERS = {'ID': 'string', 'cluster_ID': 'Int64', 'cluster_size': 'Int64'}
+
+
+class UnionFind:
+    """
+    Disjoint sets of the nodes 0..size-1 with union by size and path halving, so a sequence of unions
+    and finds runs in near-linear time
+    """
+
+    def __init__(self, size):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, node):
+        parent = self.parent
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    def union(self, a, b):
+        """Merges the sets of a and b, returns False if they were already in the same set"""
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        return True
+
+    def labels(self):
+        """Component of every node, numbered 0.. in the order of the smallest node of every component"""
+        roots = np.fromiter((self.find(node) for node in range(len(self.parent))), dtype=np.int64,
+                            count=len(self.parent))
+        first = np.full(len(roots), len(roots), dtype=np.int64)
+        np.minimum.at(first, roots, np.arange(len(roots)))
+        return pd.factorize(first[roots], sort=True)[0]
+
+
+def select_pairs(table_c, max_score=None, keep_missing=False, best_match_only=False):
+    """
+    Pairs of a ranked match table that are merged into the same entity
+    :param max_score: largest score (lower is better) of a merged pair, None: every pair of table_c
+    :param keep_missing: also merge the pairs without a score (a missing year or cover feature)
+    :param best_match_only: only the best pair of every ltable record, so a record is linked to one
+    record of the other table (one Gutenberg work <-> many Open Library editions)
+    :return: DataFrame with the ltable_ID and rtable_ID of the pairs
+    """
+    score = table_c['score']
+    keep = score.notna() if max_score is None else (score <= max_score).fillna(False)
+    if keep_missing:
+        keep |= score.isna()
+    pairs = table_c[keep.to_numpy(dtype=bool)]
+    if best_match_only:
+        pairs = pairs.sort_values(['score', 'ID'], kind='stable', na_position='last')
+        pairs = pairs.drop_duplicates(subset=['ltable_ID'], keep='first')
+    return pairs[['ltable_ID', 'rtable_ID']].reset_index(drop=True)
+
+
+def connected_components(tables, edges):
+    """
+    Clusters the records of several tables linked by pairs with union-find
+    :param tables: list of record ID columns, one per table
+    :param edges: list of (pairs, left table index, right table index), pairs with ltable_ID and rtable_ID
+    :return: list with a DataFrame (ID, cluster_ID, cluster_size) per table, the cluster IDs are shared
+    """
+    offsets = np.cumsum([0] + [len(ids) for ids in tables])
+    indexes = [pd.Index(ids) for ids in tables]
+    forest = UnionFind(int(offsets[-1]))
+    merged = 0
+    for pairs, left, right in edges:
+        left_nodes = indexes[left].get_indexer(pairs['ltable_ID']) + offsets[left]
+        right_nodes = indexes[right].get_indexer(pairs['rtable_ID']) + offsets[right]
+        known = (left_nodes >= offsets[left]) & (right_nodes >= offsets[right])  # IDs missing from the tables
+        for a, b in zip(left_nodes[known].tolist(), right_nodes[known].tolist()):
+            merged += forest.union(a, b)
+    labels = forest.labels()
+    sizes = np.bincount(labels)
+    mt.count('cluster_unions', merged)
+    return [pd.DataFrame({'ID': ids, 'cluster_ID': labels[start:end], 'cluster_size': sizes[labels[start:end]]})
+            for ids, start, end in zip(tables, offsets[:-1], offsets[1:])]
+
+
+def _summary(clusters):
+    sizes = pd.concat([df[['cluster_ID', 'cluster_size']] for df in clusters]).drop_duplicates('cluster_ID')
+    return {'records': int(sizes['cluster_size'].sum()), 'clusters': len(sizes),
+            'multi_record_clusters': int((sizes['cluster_size'] > 1).sum()),
+            'largest_cluster': int(sizes['cluster_size'].max()) if len(sizes) else 0}
+
+
+def perform_clustering(max_score=None, keep_missing=False, best_match_only=False):
+    """
+    Groups the records of both tables into entities from the matches of tableC, and from the duplicates
+    found within each table by dedupe_table if they were saved (<table>_duplicates). Saves the cluster ID of
+    every record of table_a and table_b (the tables tableC was computed from) to table_a_clusters and
+    table_b_clusters, records without a match get a cluster of their own
+    :param max_score: largest score of a merged pair (see select_pairs)
+    """
+    table_a = st.read_table(st.table_path('table_a_matched'), st.TABLE_A)
+    table_b = st.read_table(st.table_path('table_b_matched'), st.TABLE_B)
+    table_c = st.read_table(st.table_path('tableC'), st.TABLE_C)
+    with mt.stage('clustering/union_find', rows_in=len(table_c)) as s:
+        edges = [(select_pairs(table_c, max_score, keep_missing, best_match_only), 0, 1)]
+        for side, (name, schema) in enumerate([('table_a', st.TABLE_A), ('table_b', st.TABLE_B)]):
+            path = st.table_path(f'{name}_duplicates')
+            if os.path.exists(path):
+                duplicates = st.read_table(path, dedupe_schema(schema))
+                edges.append((select_pairs(duplicates, max_score, keep_missing), side, side))
+                print(f"Merging the {len(edges[-1][0])} duplicates of {path}")
+        clusters = connected_components([table_a['ID'], table_b['ID']], edges)
+        s.rows_out = sum(len(pairs) for pairs, _, _ in edges)
+    for name, df in zip(['table_a_clusters', 'table_b_clusters'], clusters):
+        st.write_table(df, st.table_path(name), CLUSTERS)
+    print(f"Clusters: {_summary(clusters)}")
+    return clusters
+
+
+def dedupe_schema(schema):
+    """Schema of the duplicate pairs of a table: the match table with both sides from the same table"""
+    return {
+        'ID': 'Int64',
+        **{f'ltable_{column}': dtype for column, dtype in schema.items()},
+        **{f'rtable_{column}': dtype for column, dtype in schema.items()},
+        **{column: dtype for column, dtype in st.TABLE_C.items() if not column.startswith(('ltable_', 'rtable_'))
+           and column != 'ID'},
+    }
+
+
+def dedupe_table(table, blockers=None, workers=1, title_threshold=um.TITLE_THRESHOLD,
+                 author_threshold=um.AUTHOR_THRESHOLD, name='table'):
+    """
+    Finds the duplicates within a table with the blocking and scoring of perform_matching (the table is
+    matched against itself, every unordered pair of distinct records is scored once)
+    :param name: name of the table, for the thumbnail stores of its covers
+    :return: ranked duplicate pairs with the columns of tableC
+    """
+    with mt.stage('dedupe/blocking', rows_in=len(table)) as s:
+        candidates = bl.block_tables(table, table, blockers)
+        left, right = bl._positions(table, table, candidates)
+        # one orientation per pair, without the pairs of a record with itself
+        first, second = np.minimum(left, right), np.maximum(left, right)
+        pairs = pd.DataFrame({'first': first, 'second': second})[first != second].drop_duplicates()
+        candidates = pd.DataFrame({'ltable_ID': table['ID'].to_numpy()[pairs['first'].to_numpy()],
+                                   'rtable_ID': table['ID'].to_numpy()[pairs['second'].to_numpy()]})
+        s.rows_out = len(candidates)
+    table_c = um.candidate_table(candidates, table, table)
+    with mt.stage('dedupe/filter', rows_in=len(table_c)) as s:
+        duplicates = um.filter_candidates(table_c, workers, title_threshold, author_threshold)
+        s.rows_out = len(duplicates)
+    duplicates['difference_year'] = um.year_difference(duplicates, table['first_published_year'].min())
+    with mt.stage('dedupe/cover_mse', rows_in=len(duplicates)) as s:
+        duplicates['cover_mse'] = um.cover_difference(duplicates, workers,
+                                                      (f'features_{name}_dedupe_l', f'features_{name}_dedupe_r'))
+        s.rows_out = len(duplicates)
+    return um.rank_matches(duplicates)
+
+
+def perform_dedupe(side='b', blockers=None, workers=1, max_score=None, keep_missing=False):
+    """
+    Dedupes table_a or table_b on its own: saves the scored duplicate pairs to <table>_duplicates (used by
+    perform_clustering) and the cluster ID of every record to <table>_dedupe_clusters
+    :param side: 'a' (Open Library, table_a_cleaned) or 'b' (Gutenberg, table_b_cleaned)
+    :param max_score: largest score of a merged pair (see select_pairs)
+    """
+    name, schema = ('table_a', st.TABLE_A) if side == 'a' else ('table_b', st.TABLE_B)
+    table = st.read_table(st.table_path(f'{name}_cleaned'), schema)
+    duplicates = dedupe_table(table, blockers, workers, name=name)
+    st.write_table(duplicates, st.table_path(f'{name}_duplicates'), dedupe_schema(schema))
+    print(f"Found {len(duplicates)} duplicate pairs in {name}")
+    with mt.stage('dedupe/union_find', rows_in=len(duplicates)) as s:
+        pairs = select_pairs(duplicates, max_score, keep_missing)
+        clusters = connected_components([table['ID']], [(pairs, 0, 0)])
+        s.rows_out = len(pairs)
+    st.write_table(clusters[0], st.table_path(f'{name}_dedupe_clusters'), CLUSTERS)
+    print(f"Clusters: {_summary(clusters)}")
+    return duplicates, clusters[0]
@@ -0,0 +1,185 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import requests
+
+import utils_http as hp
+import utils_metrics as mt
+
+COVER_CACHE_DIR = "cover_cache"
+MISSING_SUFFIX = ".missing"
+COVER_SIZE = (300, 200)  # (width, height) all covers are resized to before comparing them
+
+
+def normalize_cover_url(url):
+    """Turns the cover links of both sources into absolute URLs (None if there is no usable cover)"""
+    if not isinstance(url, str) or not url:
+        return None
+    if url.startswith('//'):
+        return 'http:' + url
+    if url.startswith('http'):
+        return url
+    return None  # relative links point to the placeholder cover of open library
+
+
+def cover_cache_path(url, cache_dir=COVER_CACHE_DIR):
+    """Path of the cached cover of url, the file name is the SHA-256 of the URL"""
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def fetch_cover(url, session, cache_dir=COVER_CACHE_DIR, timeout=30):
+    """
+    Downloads a single cover into the cache unless it is already there
+    :return: path of the cached cover or None if the cover could not be downloaded
+    """
+    path = cover_cache_path(url, cache_dir)
+    if os.path.exists(path):
+        mt.count('cover_cache_hits')
+        return path
+    if os.path.exists(path + MISSING_SUFFIX):
+        mt.count('cover_cache_hits')
+        return None
+    mt.count('cover_cache_misses')
+    try:
+        # the cover cache already keeps the covers, they are not stored a second time in the HTTP cache
+        response = session.get(url, timeout=timeout, headers={'Cache-Control': 'no-store'})
+    except requests.RequestException as e:
+        print(f"Error downloading image {url} {e}")
+        return None
+    if response.status_code == 200:
+        hp.write_atomic(path, response.content)
+        return path
+    print(f"Failed to download image: {url} {response.status_code}")
+    if response.status_code in (404, 410):
+        hp.write_atomic(path + MISSING_SUFFIX, b'')  # remember covers that do not exist
+    return None
+
+
+def fetch_covers(urls, cache_dir=COVER_CACHE_DIR, max_workers=8, session=None, timeout=30):
+    """
+    Downloads every distinct cover once with a bounded thread pool sharing one session.
+    Covers that are already cached (also from previous runs) are not downloaded again
+    :param urls: iterable of cover URLs (may contain duplicates and missing values)
+    :return: dict mapping every distinct URL to the path of its cached cover (None if unavailable)
+    """
+    distinct_urls = sorted({url for url in urls if isinstance(url, str) and url})
+    if session is None:
+        session = hp.shared_session(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        paths = executor.map(lambda url: fetch_cover(url, session, cache_dir, timeout), distinct_urls)
+        cover_paths = dict(zip(distinct_urls, paths))
+    downloaded = sum(path is not None for path in cover_paths.values())
+    print(f"Covers available: {downloaded}/{len(distinct_urls)}")
+    return cover_paths
+
+
+def load_cover(path):
+    """Opens a cached cover (None if there is no cover or it can not be decoded)"""
+    if path is None:
+        return None
+    from PIL import Image
+    try:
+        with open(path, 'rb') as f:
+            return Image.open(BytesIO(f.read()))
+    except (OSError, Image.DecompressionBombError) as e:
+        print(f"Error reading image {path} {e}")
+        return None
+
+
+def cover_thumbnail(path, size=COVER_SIZE):
+    """Decodes a cached cover into a normalized (height, width, 3) uint8 RGB array (None if unavailable)"""
+    image = load_cover(path)
+    if image is None:
+        return None
+    try:
+        return np.asarray(image.resize(size).convert('RGB'), dtype=np.uint8)
+    except OSError as e:
+        print(f"Error decoding image {path} {e}")
+        return None
+
+
+def build_cover_store(ids, urls, store_path, cache_dir=COVER_CACHE_DIR, size=COVER_SIZE):
+    """
+    Precomputes the thumbnails of the covers of a set of records. Every distinct cover is decoded
+    once and the thumbnails are saved in a memory mapped .npy file indexed by record ID
+    (the covers have to be in the cache already, see fetch_covers)
+    :param ids: record IDs
+    :param urls: cover URL of every record
+    :param store_path: path of the store without extension (<store_path>.npy and <store_path>_index.csv)
+    :return: the store as returned by load_cover_store
+    """
+    index = pd.DataFrame({'ID': list(ids), 'url': [normalize_cover_url(url) for url in urls]})
+    index = index.drop_duplicates(subset=['ID'], ignore_index=True)
+    os.makedirs(os.path.dirname(store_path) or '.', exist_ok=True)
+    thumbnails = np.lib.format.open_memmap(store_path + '.npy', mode='w+', dtype=np.uint8,
+                                           shape=(len(index), size[1], size[0], 3))
+    has_cover = np.zeros(len(index), dtype=bool)
+    decoded = {}
+    for row, url in enumerate(index['url'].tolist()):
+        if not isinstance(url, str):
+            continue
+        if url not in decoded:
+            path = cover_cache_path(url, cache_dir)
+            decoded[url] = cover_thumbnail(path if os.path.exists(path) else None, size)
+        if decoded[url] is not None:
+            thumbnails[row] = decoded[url]
+            has_cover[row] = True
+    thumbnails.flush()
+    del thumbnails
+    index['has_cover'] = has_cover
+    index[['ID', 'has_cover']].to_csv(store_path + '_index.csv', index=False)
+    print(f"Stored {has_cover.sum()}/{len(index)} cover thumbnails in {store_path}.npy")
+    return load_cover_store(store_path)
+
+
+def load_cover_store(store_path):
+    """
+    Opens a cover store built by build_cover_store without reading the thumbnails into memory
+    :return: dict with the memory mapped thumbnails, the record IDs as index and the has_cover flags
+    """
+    index = pd.read_csv(store_path + '_index.csv')
+    return {
+        'thumbnails': np.load(store_path + '.npy', mmap_mode='r'),
+        'ids': pd.Index(index['ID']),
+        'has_cover': index['has_cover'].to_numpy(dtype=bool),
+    }
+
+
+def cover_rows(store_a, ids_a, store_b, ids_b):
+    """Row positions of the covers of record pairs in two stores, -1 where a cover is missing"""
+    rows_a = store_a['ids'].get_indexer(ids_a)
+    rows_b = store_b['ids'].get_indexer(ids_b)
+    valid = (rows_a >= 0) & (rows_b >= 0)
+    valid[valid] = store_a['has_cover'][rows_a[valid]] & store_b['has_cover'][rows_b[valid]]
+    return np.where(valid, rows_a, -1), np.where(valid, rows_b, -1)
+
+
+def cover_mse_rows(thumbnails_a, rows_a, thumbnails_b, rows_b, chunk_size=256):
+    """cover_mse_batch on row positions of the thumbnail arrays (pairs with a -1 row get 0)"""
+    result = np.zeros(len(rows_a), dtype=np.float64)
+    pairs = np.flatnonzero((rows_a >= 0) & (rows_b >= 0))
+    for start in range(0, len(pairs), chunk_size):
+        chunk = pairs[start:start + chunk_size]
+        # gather both sides of the chunk and reduce in one vectorized pass
+        image_a = thumbnails_a[rows_a[chunk]].astype(np.float32) / 255.0
+        image_b = thumbnails_b[rows_b[chunk]].astype(np.float32) / 255.0
+        result[chunk] = np.mean((image_a - image_b) ** 2, axis=(1, 2, 3))
+    return result
+
+
+def cover_mse_batch(store_a, ids_a, store_b, ids_b, chunk_size=256):
+    """
+    Mean squared error between the covers of many record pairs, computed on float pixels scaled to
+    [0, 1] so the result is in [0, 1]. Pairs where a cover is missing get 0 (as in perform_matching)
+    :param ids_a: record IDs of the left side of the pairs (looked up in store_a)
+    :param ids_b: record IDs of the right side of the pairs (looked up in store_b)
+    :param chunk_size: number of pairs gathered from the stores at once, bounds the memory used
+    :return: NumPy array with the MSE of every pair
+    """
+    rows_a, rows_b = cover_rows(store_a, ids_a, store_b, ids_b)
+    return cover_mse_rows(store_a['thumbnails'], rows_a, store_b['thumbnails'], rows_b, chunk_size)
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+
+import utils_http as hp
+import utils_metrics as mt
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MANIFEST_PATH = "fetch_manifest.sqlite"
+
+
+class TokenBucket:
+    """Thread safe token bucket allowing rate requests per second with bursts of up to burst requests"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """One token bucket per host so every site gets its own request rate"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.setdefault(host, TokenBucket(self.rate, self.burst))
+        bucket.acquire()
+
+
+class FetchManifest:
+    """
+    Persistent record of every fetched URL (SQLite): HTTP status, validators (ETag / Last-Modified),
+    content hash and fetch time. Used to skip pages that are already on disk, to revalidate stale
+    ones with conditional requests and to resume interrupted crawls
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS fetches (
+                    url TEXT PRIMARY KEY,
+                    output_path TEXT,
+                    status INTEGER,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    fetched_at REAL
+                )""")
+
+    def get(self, url):
+        """Returns the manifest entry of url as a dict (None if it was never fetched)"""
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT url, output_path, status, etag, last_modified, content_hash, fetched_at "
+                "FROM fetches WHERE url = ?", (url,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        keys = ['url', 'output_path', 'status', 'etag', 'last_modified', 'content_hash', 'fetched_at']
+        return dict(zip(keys, row))
+
+    def record(self, url, output_path, status, etag=None, last_modified=None, content_hash=None):
+        """Stores the result of a fetch, committed immediately so an interrupted crawl can resume"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO fetches VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, output_path, status, etag, last_modified, content_hash, time.time()))
+
+    def touch(self, url):
+        """Marks an entry as revalidated (304 Not Modified) without changing its content"""
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE fetches SET fetched_at = ? WHERE url = ?", (time.time(), url))
+
+    def close(self):
+        self.connection.close()
+
+
+def _retry_delay(response, attempt, backoff):
+    """Seconds to wait before the next attempt, honours the Retry-After header of the server"""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return backoff * 2 ** attempt
+
+
+def fetch(url, session, limiter, max_retries=3, backoff=1.0, timeout=30, headers=None):
+    """
+    Fetches a single URL respecting the rate limit of its host, retries with exponential backoff
+    on 429/5xx responses and connection errors. The pages bypass the HTTP cache of the session
+    (utils_http.CachingSession): the saved pages and the fetch manifest are the cache of the crawls
+    :return: (response or None, number of requests sent)
+    """
+    headers = {'Cache-Control': 'no-store', **(headers or {})}
+    response = None
+    for attempt in range(max_retries + 1):
+        limiter.acquire(url)
+        try:
+            response = session.get(url, timeout=timeout, headers=headers)
+        except requests.RequestException as e:
+            print(f"Error fetching {url} {e}")
+            response = None
+        if response is not None and response.status_code not in RETRY_STATUS:
+            return response, attempt + 1
+        if attempt < max_retries:
+            time.sleep(_retry_delay(response, attempt, backoff))
+    return response, max_retries + 1
+
+
+def _conditional_headers(entry):
+    """Builds the validators of a conditional GET from a manifest entry"""
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def crawl(jobs, concurrency=8, rate=1.0, burst=1, max_retries=3, backoff=1.0, timeout=30, as_text=False,
+          session=None, progress_every=25, manifest=None, max_age=None, archive=None):
+    """
+    Downloads many pages concurrently and saves them to disk
+    :param jobs: iterable of (url, output_filepath) tuples
+    :param concurrency: number of pages fetched in parallel
+    :param rate: requests per second allowed per host
+    :param burst: number of requests a host may receive at once after being idle
+    :param as_text: save the decoded text re-encoded as utf-8 instead of the raw bytes
+    :param session: requests session (default: the shared session of utils_http, pages are not stored in
+    its HTTP cache)
+    :param manifest: FetchManifest; pages it records as fetched (and still on disk) are skipped or
+    revalidated with a conditional GET, which makes interrupted crawls resumable
+    :param max_age: seconds after which a page in the manifest is revalidated (None: never, 0: always)
+    :param archive: utils_archive.PageArchive the pages are stored in (under their output file path)
+    instead of one file per page
+    :return: report dict with request counts, bytes, throughput and the list of new or changed files
+    """
+    jobs = list(dict((output_filepath, url) for url, output_filepath in jobs).items())
+    if session is None:
+        session = hp.shared_session(concurrency)
+    limiter = HostRateLimiter(rate, burst)
+    report = {'pages': len(jobs), 'saved': 0, 'failed': 0, 'skipped': 0, 'not_modified': 0, 'unchanged': 0,
+              'requests': 0, 'bytes': 0}
+    changed = []
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def saved(output_filepath):
+        return archive.exists(output_filepath) if archive is not None else os.path.exists(output_filepath)
+
+    def download(output_filepath, url):
+        entry = manifest.get(url) if manifest is not None else None
+        headers = None
+        if entry is not None and entry['status'] == 200 and saved(output_filepath):
+            if max_age is None or time.time() - entry['fetched_at'] < max_age:
+                with lock:
+                    report['skipped'] += 1
+                mt.count('fetch_manifest_hits')
+                return
+            headers = _conditional_headers(entry)
+        mt.count('fetch_manifest_misses')
+        response, requests_sent = fetch(url, session, limiter, max_retries, backoff, timeout, headers)
+        outcome = 'failed'
+        if response is not None and response.status_code == 304:
+            manifest.touch(url)
+            outcome = 'not_modified'
+        elif response is not None and response.status_code == 200:
+            content = response.text.encode('utf-8') if as_text else response.content
+            content_hash = hashlib.sha256(content).hexdigest()
+            if entry is not None and entry['content_hash'] == content_hash and saved(output_filepath):
+                outcome = 'unchanged'
+            elif archive is not None:
+                archive.put(output_filepath, content, url)
+                outcome = 'saved'
+            else:
+                os.makedirs(os.path.dirname(output_filepath) or '.', exist_ok=True)
+                with open(output_filepath, 'wb') as f:
+                    f.write(content)
+                outcome = 'saved'
+            if manifest is not None:
+                manifest.record(url, output_filepath, 200, response.headers.get('ETag'),
+                                response.headers.get('Last-Modified'), content_hash)
+        else:
+            status = response.status_code if response is not None else None
+            print(f"Failed to fetch {url} ({status or 'no response'})")
+            if manifest is not None and entry is None:
+                manifest.record(url, output_filepath, status)
+        mt.count(f'crawl_{outcome}')
+        with lock:
+            report['requests'] += requests_sent
+            report[outcome] += 1
+            report['bytes'] += len(response.content) if response is not None else 0
+            if outcome == 'saved':
+                changed.append(output_filepath)
+            done = report['saved'] + report['failed'] + report['not_modified'] + report['unchanged']
+            if progress_every and done % progress_every == 0:
+                elapsed = time.monotonic() - start
+                print(f"Fetched {done}/{len(jobs)} pages ({done / elapsed:.2f} pages/s)")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(download, output_filepath, url) for output_filepath, url in jobs]
+        for future in as_completed(futures):
+            future.result()
+    report['seconds'] = time.monotonic() - start
+    report['pages_per_second'] = len(jobs) / report['seconds'] if report['seconds'] else 0.0
+    print(f"Crawl report: {report}")
+    report['changed'] = sorted(changed)
+    return report
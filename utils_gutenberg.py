@@ -1,57 +1,70 @@
-import csv
 import os
-import requests
-import time
 from bs4 import BeautifulSoup
-import pandas as pd
 
-def get_html_pages(query, num_pages):
+import utils_archive as ar
+import utils_crawler as cr
+import utils_metrics as mt
+import utils_parsing as ps
+
+def get_html_pages(query, num_pages, concurrency=4, rate=1.0, manifest_path=cr.MANIFEST_PATH, archive=None):
+    """
+    Fetches the search result pages of gutenberg to extract links to books
+    :param concurrency: number of pages fetched in parallel
+    :param rate: requests per second sent to gutenberg
+    :param manifest_path: fetch manifest, the result pages change over time so they are always
+    revalidated with conditional requests
+    :param archive: utils_archive.PageArchive the pages are stored in instead of one file per page
+    """
     # Create directory if it doesn't exist
     output_dir = f"gutenberg_html_pages_{query}"
-    if not os.path.exists(output_dir):
+    if archive is None and not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    jobs = []
     for i in range(1, num_pages + 1):
         if query == "relevance":
             url = f"https://www.gutenberg.org/ebooks/search/?sort_order=downloads&start_index={(i - 1) * 25 + 1}"
         else:
             url = f"https://www.gutenberg.org/ebooks/search/?query={query}&submit_search=Go!&start_index={(i-1)*25+1}"
-        print(f"Fetching page {i} from {url}")
-        print(url)
-        response = requests.get(url)
-        if response.status_code == 200:
-            file_path = os.path.join(output_dir, f'page_{query}_{i}.html')
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            print(f"Saved page {i} to {file_path}")
-        else:
-            print(f"Failed to fetch page {i}")
-        time.sleep(1)  # Delay to avoid being blocked
+        jobs.append((url, os.path.join(output_dir, f'page_{query}_{i}.html')))
+    manifest = cr.FetchManifest(manifest_path)
+    with mt.stage(f'gutenberg/get_html_pages/{query}', rows_in=len(jobs)) as s:
+        report = cr.crawl(jobs, concurrency=concurrency, rate=rate, manifest=manifest, max_age=0,
+                          archive=archive)  # rate limited to avoid being blocked
+        s.rows_out = report['pages'] - report['failed']
+    manifest.close()
 
 
-def get_book_html(input_directory, output_directory):
-    if not os.path.exists(output_directory):
+def get_book_html(input_directory, output_directory, concurrency=8, rate=1.0, manifest_path=cr.MANIFEST_PATH,
+                  max_age=None, archive=None):
+    """
+    Fetches the book pages linked from the search result pages. Pages already in the fetch manifest
+    are skipped (or revalidated once older than max_age seconds), so an interrupted crawl resumes
+    :param concurrency: number of pages fetched in parallel
+    :param rate: requests per second sent to gutenberg
+    :param archive: utils_archive.PageArchive the search result pages are read from and the book pages
+    are stored in
+    :return: list of the book pages that are new or changed
+    """
+    if archive is None and not os.path.exists(output_directory):
         os.makedirs(output_directory)
-    book_counter = 0
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.html'):
-            filepath = os.path.join(input_directory, filename)
-            with open(filepath, 'r', encoding='utf-8') as file:
-                content = file.read()
-                soup = BeautifulSoup(content, 'html.parser')
-                book_links = soup.find_all("a", class_="link") # extract links to books
-                book_links = [link.get('href') for link in book_links]
-                for link in book_links:
-                    book_url = f"https://www.gutenberg.org{link}"
-                    book_html = requests.get(book_url).text
-                    book_id = link.split('/')[-1]
-                    output_filepath = os.path.join(output_directory, f"{book_id}.html")
-                    with open(output_filepath, 'w', encoding='utf-8') as output_file:
-                        output_file.write(book_html)
-                    book_counter += 1
-                    print(f"Saved book {book_id} to {output_filepath}")
-                    time.sleep(1)  # delay to avoid being blocked
-    print(f"Total books saved: {book_counter}")
+    jobs = []
+    for _, content in ar.read_pages(input_directory, archive):
+        soup = BeautifulSoup(content, 'html.parser')
+        book_links = soup.find_all("a", class_="link") # extract links to books
+        book_links = [link.get('href') for link in book_links]
+        for link in book_links:
+            book_url = f"https://www.gutenberg.org{link}"
+            book_id = link.split('/')[-1]
+            jobs.append((book_url, os.path.join(output_directory, f"{book_id}.html")))
+    manifest = cr.FetchManifest(manifest_path)
+    with mt.stage('gutenberg/get_book_html', rows_in=len(jobs)) as s:
+        report = cr.crawl(jobs, concurrency=concurrency, rate=rate, as_text=True, manifest=manifest,
+                          max_age=max_age, archive=archive)  # rate limited to avoid being blocked
+        s.rows_out = report['pages'] - report['failed']
+    manifest.close()
+    print(f"Total books saved: {report['saved']}")
+    return report['changed']
 
 
 def extract_book_title(soup):
@@ -109,51 +122,80 @@ def extract_ebook_number(soup):
         return ebook_dd.text.strip() if ebook_dd else None
     return None
 
-def process_books_gutenberg(input_directory, output_filepath):
-    data = []
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.html'):
-            filepath = os.path.join(input_directory, filename)
-            with open(filepath, 'r', encoding='utf-8') as file:
-                content = file.read()
-                soup = BeautifulSoup(content, 'html.parser')
-                title = extract_book_title(soup)
-                author = extract_author(soup)
-                publisher = extract_publisher(soup)
-                first_published_year = extract_first_published_year(soup)
-                cover_image = extract_cover_image(soup)
-                language = extract_language(soup)
-                ebook_number = extract_ebook_number(soup)
-                data.append({
-                    "ID": ebook_number,
-                    "title": title,
-                    "author": author,
-                    "publisher": publisher,
-                    "first_published_year": first_published_year,
-                    "language": language,
-                    "cover_image": cover_image,
-                })
-    df = pd.DataFrame(data)
-    df.to_csv(output_filepath, index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
-    print(f"Processed {len(data)} books and saved to {output_filepath}")
+COLUMNS = ["ID", "title", "author", "publisher", "first_published_year", "language", "cover_image"]
+
+
+def extract_book(soup):
+    """Extracts all fields of a book page"""
+    return {
+        "ID": extract_ebook_number(soup),
+        "title": extract_book_title(soup),
+        "author": extract_author(soup),
+        "publisher": extract_publisher(soup),
+        "first_published_year": extract_first_published_year(soup),
+        "language": extract_language(soup),
+        "cover_image": extract_cover_image(soup),
+    }
+
+
+def parse_book(content):
+    """Parses the html of a book page and extracts its fields"""
+    return extract_book(BeautifulSoup(content, 'html.parser'))
+
+
+def iter_books(input_directory, filenames=None, workers=1, errors=None, archive=None):
+    """
+    Yields the records of the saved book pages (sorted by file name) while they are parsed
+    :param errors: list the (file, error) of the pages that could not be parsed are appended to
+    :param archive: utils_archive.PageArchive the pages are read from, in the order they are stored in
+    """
+    if archive is not None:
+        filepaths = archive.list_pages(input_directory, filenames)
+        return ps.iter_parsed(filepaths, parse_book, workers=workers, errors=errors, archive_dir=archive.directory)
+    filepaths = ps.list_html_files(input_directory, filenames)
+    return ps.iter_parsed(filepaths, parse_book, workers=workers, errors=errors)
+
+
+def process_books_gutenberg(input_directory, output_filepath, filenames=None, workers=1, archive=None):
+    """
+    Extracts the book data of the saved book pages and saves it to a CSV file (or Parquet if the
+    file name ends with .parquet). The records are streamed to the file in batches
+    :param filenames: only parse these pages (e.g. the new or changed pages returned by get_book_html)
+    and update the existing output file with them
+    :param workers: number of processes parsing the pages (None for one per core)
+    :param archive: utils_archive.PageArchive the pages are read from
+    """
+    import pandas as pd
+    errors = []
+    with mt.stage('gutenberg/process_books/' + os.path.basename(output_filepath)) as s:
+        records = iter_books(input_directory, filenames, workers, errors, archive)
+        if filenames is not None:
+            df = pd.DataFrame(list(records), columns=COLUMNS)
+            ps.update_table(df, output_filepath)
+            count = len(df)
+        else:
+            count = ps.write_records(records, output_filepath, COLUMNS)
+        s.rows_in = count + len(errors)
+        s.rows_out = count
+    mt.count('parse_errors', len(errors))
+    ps.save_error_report(errors, output_filepath)
+    print(f"Processed {count} books and saved to {output_filepath}")
 
 
 def combine_csv():
     """
     Combines the CSV files generated by the process_books function
     """
-    dtype = {
-        'first_published_year': str,
-        'pages': str,
-        'isbn_10': str,
-        'isbn_13': str,
-        'ID': str
-    }
-    df1 = pd.read_csv("gutenberg_books_relevance.csv", dtype=dtype)
-    df2 = pd.read_csv("gutenberg_books_fantasy.csv", dtype=dtype)
-    df = pd.concat([df1, df2])
-    print(df.head(5))
-    print(df.shape)
-    df = df.drop_duplicates(subset=['ID'], keep='first')  # filter out duplicates
-    print(df.shape)
-    df.to_csv("gutenberg_books.csv", index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    import pandas as pd
+    import utils_storage as st
+    with mt.stage('gutenberg/combine_csv') as s:
+        df1 = st.read_table(st.table_path("gutenberg_books_relevance"), st.GUTENBERG_BOOKS)
+        df2 = st.read_table(st.table_path("gutenberg_books_fantasy"), st.GUTENBERG_BOOKS)
+        df = pd.concat([df1, df2])
+        print(df.head(5))
+        print(df.shape)
+        df = df.drop_duplicates(subset=['ID'], keep='first')  # filter out duplicates
+        print(df.shape)
+        st.write_table(df, st.table_path("gutenberg_books"), st.GUTENBERG_BOOKS)
+        s.rows_in = len(df1) + len(df2)
+        s.rows_out = len(df)
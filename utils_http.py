@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.request import ACCEPT_ENCODING
+
+import utils_metrics as mt
+
+HTTP_CACHE_DIR = "http_cache"
+TIMEOUT = (10, 30)  # (connect, read) seconds of requests that do not set a timeout
+# headers that describe the encoded body on the wire, the cache stores the decoded body
+_TRANSFER_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_connect_seconds = [0.0, 0]  # total time and number of new connections, for the handshake savings
+_shared = None
+
+
+class _TimedConnection(HTTPConnection):
+    """Connection that measures its TCP (+TLS) handshake, only new connections call connect"""
+
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        seconds = time.monotonic() - start
+        _local.connected = True
+        with _lock:
+            _connect_seconds[0] += seconds
+            _connect_seconds[1] += 1
+        mt.count('http_connections')
+        mt.observe('http_connect_latency', seconds)
+
+
+class _TimedHTTPSConnection(_TimedConnection, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
+
+
+def _cache_control(headers):
+    """Directives of the Cache-Control header, e.g. {'max-age': '3600', 'no-cache': None}"""
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+
+def _freshness(headers):
+    """
+    Seconds a response may be served from the cache without revalidation (0: revalidate every time),
+    None if it must not be stored
+    """
+    directives = _cache_control(headers)
+    if 'no-store' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    age = int(headers.get('Age', '0')) if headers.get('Age', '').isdigit() else 0
+    for name in ['s-maxage', 'max-age']:
+        if directives.get(name, '').isdigit():
+            return max(0, int(directives[name]) - age)
+    if headers.get('Expires'):
+        try:
+            expires = parsedate_to_datetime(headers['Expires'])
+            date = parsedate_to_datetime(headers['Date']) if headers.get('Date') else None
+        except (TypeError, ValueError):
+            return 0  # invalid dates mean already expired
+        now = date.timestamp() if date is not None else time.time()
+        return max(0, int(expires.timestamp() - now))
+    return 0
+
+
+class ResponseCache:
+    """
+    On-disk cache of GET responses, laid out like the cover cache: <directory>/<ab>/<sha256 of the URL>.json
+    holds the status, headers and expiry of an entry, .body next to it its decoded body. Entries without freshness information are
+    only stored if they can be revalidated (ETag or Last-Modified)
+    """
+
+    def __init__(self, directory=HTTP_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, url):
+        """(metadata, body) of the cached response of url, None if it is not cached"""
+        path = self._path(url)
+        try:
+            with open(path + '.json') as f:
+                entry = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                return entry, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, response, elapsed):
+        """Stores a 200 response if its headers allow it, elapsed is the time it took to download"""
+        freshness = _freshness(response.headers)
+        validators = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        vary = response.headers.get('Vary', '').lower().replace(' ', '')
+        if response.status_code != 200 or freshness is None or vary not in ('', 'accept-encoding'):
+            return False
+        if not freshness and not validators:
+            return False
+        entry = {'url': url, 'status': response.status_code, 'elapsed': elapsed,
+                 'headers': {key: value for key, value in response.headers.items()
+                             if key.lower() not in _TRANSFER_HEADERS},
+                 'expires_at': time.time() + freshness}
+        path = self._path(url)
+        write_atomic(path + '.body', response.content)
+        write_atomic(path + '.json', json.dumps(entry).encode('utf-8'))
+        return True
+
+    def refresh(self, url, entry, headers):
+        """Updates an entry after a 304 Not Modified with the new headers and expiry"""
+        entry['headers'].update({key: value for key, value in headers.items() if key.lower() not in _TRANSFER_HEADERS})
+        entry['expires_at'] = time.time() + (_freshness(CaseInsensitiveDict(entry['headers'])) or 0)
+        write_atomic(self._path(url) + '.json', json.dumps(entry).encode('utf-8'))
+
+
+def write_atomic(path, content):
+    """Writes content to path through a temporary file so interrupted runs leave no partial files"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _cached_response(url, entry, body):
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = body
+    response.url = url
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.elapsed = timedelta(0)
+    response.from_cache = True
+    return response
+
+
+class CachingSession(requests.Session):
+    """
+    Session shared by all fetchers: keep-alive connection pools per host, a default timeout,
+    compressed transfers (gzip and deflate, brotli and zstd if the brotli / zstandard packages are
+    installed) and the on-disk ResponseCache. Every request is counted in utils_metrics: network
+    requests, bytes, status codes, latency, new and reused connections with the handshake time the
+    reuse saved, and the cache hits with the transfer time and bytes they saved.
+    Requests that set their own validators (If-None-Match / If-Modified-Since) bypass the cache lookup
+    and get the 304 themselves, requests with 'Cache-Control: no-store' bypass the cache entirely
+    """
+
+    def __init__(self, pool_size=16, cache_dir=HTTP_CACHE_DIR, timeout=TIMEOUT):
+        super().__init__()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.headers['Accept-Encoding'] = ACCEPT_ENCODING
+        self.resize(pool_size)
+
+    def resize(self, pool_size):
+        """Mounts connection pools of pool_size connections per host (one per concurrent thread)"""
+        adapter = _TimedAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.pool_size = pool_size
+
+    def cached(self, url):
+        """Fresh cached response of url (None if it has to be fetched)"""
+        if self.cache is None:
+            return None
+        cached = self.cache.get(url)
+        if cached is None or cached[0]['expires_at'] <= time.time():
+            return None
+        mt.count('http_cache_hits')
+        mt.count('http_cache_bytes_saved', len(cached[1]))
+        mt.count('http_cache_seconds_saved', cached[0]['elapsed'])
+        return _cached_response(url, *cached)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        headers = kwargs.get('headers') or {}
+        use_cache = (self.cache is not None and method.upper() == 'GET' and
+                     'no-store' not in _cache_control(headers) and
+                     not any(name in headers for name in ['If-None-Match', 'If-Modified-Since', 'Range']))
+        cached = None
+        if use_cache:
+            response = self.cached(url)
+            if response is not None:
+                return response
+            cached = self.cache.get(url)
+            if cached is not None and 'no-cache' not in _cache_control(headers):
+                # stale entry: revalidate it with a conditional request
+                validators = {'If-None-Match': cached[0]['headers'].get('ETag'),
+                              'If-Modified-Since': cached[0]['headers'].get('Last-Modified')}
+                kwargs['headers'] = {**headers, **{key: value for key, value in validators.items() if value}}
+            mt.count('http_cache_misses')
+        response, elapsed = self._send(method, url, **kwargs)
+        if use_cache and cached is not None and response.status_code == 304:
+            entry, body = cached
+            self.cache.refresh(url, entry, response.headers)
+            mt.count('http_cache_revalidated')
+            mt.count('http_cache_bytes_saved', len(body))
+            mt.count('http_cache_seconds_saved', max(0.0, entry['elapsed'] - elapsed))
+            return _cached_response(url, entry, body)
+        if use_cache and response.status_code == 200 and 'no-store' not in _cache_control(headers):
+            self.cache.put(url, response, elapsed)
+        return response
+
+    def _send(self, method, url, **kwargs):
+        """Sends a request over the network and records its metrics"""
+        _local.connected = False
+        start = time.monotonic()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException:
+            mt.count('http_errors')
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            mt.count('http_requests')
+            mt.observe('http_latency', elapsed)
+        if not _local.connected:
+            # the request reused a keep-alive connection, estimate the handshake it saved
+            with _lock:
+                mean_connect = _connect_seconds[0] / _connect_seconds[1] if _connect_seconds[1] else 0.0
+            mt.count('http_connections_reused')
+            mt.count('http_handshake_seconds_saved', mean_connect)
+        mt.count('http_bytes', len(response.content))
+        mt.count(f'http_status_{response.status_code}')
+        return response, elapsed
+
+
+def shared_session(pool_size=16):
+    """
+    Session shared by all fetchers of the process, its connection pools grow to pool_size connections
+    per host if a caller needs more concurrent connections
+    """
+    global _shared
+    with _lock:
+        if _shared is None:
+            _shared = CachingSession(pool_size)
+        elif _shared.pool_size < pool_size:
+            _shared.resize(pool_size)
+        return _shared
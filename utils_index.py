@@ -0,0 +1,173 @@
+import math
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+import utils_blocking as bl
+import utils_metrics as mt
+import utils_storage as st
+
+INDEX_PATH = "table_b_index.npz"
+
+
+def _table_hash(table, columns):
+    """Fingerprint of the indexed columns, used to detect a stale index file"""
+    return int(pd.util.hash_pandas_object(table[columns], index=False).sum()) & (2 ** 63 - 1)
+
+
+class SimilarityIndex:
+    """
+    TF-IDF index of the character q-grams of the titles and authors of a table, answers top-k
+    cosine similarity queries through an inverted index (one posting list per q-gram).
+    The similarity of two records is title_weight * cosine(titles) + author_weight * cosine(authors)
+    """
+
+    def __init__(self, ids, vocabulary, idf, term_ptr, rows, weights, q=3, title_weight=0.7,
+                 author_weight=0.3, fingerprint=0):
+        self.ids = ids
+        self.vocabulary = vocabulary
+        self.terms = {term: i for i, term in enumerate(vocabulary)}
+        self.idf = idf
+        self.term_ptr = term_ptr
+        self.rows = rows
+        self.weights = weights
+        self.q = q
+        self.title_weight = title_weight
+        self.author_weight = author_weight
+        self.fingerprint = fingerprint
+        self.unknown_idf = math.log(len(ids) + 1) + 1  # idf of q-grams that are not in the index
+
+    @staticmethod
+    def _grams(title, author, q):
+        """Counts of the title and author q-grams, prefixed with the field they come from"""
+        grams = Counter('t' + gram for gram in bl.title_qgrams(title, q))
+        grams.update('a' + gram for gram in bl.title_qgrams(author, q))
+        return grams
+
+    @classmethod
+    def build(cls, table, q=3, title_weight=0.7, author_weight=0.3):
+        """Indexes the 'title' and 'author' columns of table (records are identified by its 'ID' column)"""
+        counts = [cls._grams(title, author, q) for title, author in zip(table['title'].tolist(),
+                                                                        table['author'].tolist())]
+        vocabulary = sorted(set().union(*counts))
+        terms = {term: i for i, term in enumerate(vocabulary)}
+        rows = np.repeat(np.arange(len(counts)), [len(grams) for grams in counts])
+        term_ids = np.fromiter((terms[term] for grams in counts for term in grams), dtype=np.int64, count=len(rows))
+        tf = np.fromiter((count for grams in counts for count in grams.values()), dtype=np.float64, count=len(rows))
+        # smoothed idf and sublinear tf as in the usual TF-IDF weighting
+        idf = np.log((len(counts) + 1) / (np.bincount(term_ids, minlength=len(vocabulary)) + 1)) + 1
+        weights = (1 + np.log(tf)) * idf[term_ids]
+        is_title = np.fromiter((term[0] == 't' for term in vocabulary), dtype=bool, count=len(vocabulary))[term_ids]
+        weights = cls._normalize(weights, rows, is_title, len(counts), title_weight, author_weight)
+        # posting lists: entries sorted by q-gram
+        order = np.argsort(term_ids, kind='stable')
+        term_ptr = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(vocabulary)))])
+        ids = table['ID'].to_numpy(dtype=np.int64 if pd.api.types.is_integer_dtype(table['ID']) else str)
+        return cls(ids, vocabulary, idf, term_ptr, rows[order].astype(np.int32),
+                   weights[order].astype(np.float32), q, title_weight, author_weight,
+                   _table_hash(table, ['ID', 'title', 'author']))
+
+    @staticmethod
+    def _normalize(weights, rows, is_title, num_rows, title_weight, author_weight):
+        """Scales the title and author part of every vector to a norm of sqrt of their weight"""
+        for field, field_weight in [(is_title, title_weight), (~is_title, author_weight)]:
+            norms = np.sqrt(np.bincount(rows[field], weights=weights[field] ** 2, minlength=num_rows))
+            weights[field] *= math.sqrt(field_weight) / np.maximum(norms[rows[field]], 1e-12)
+        return weights
+
+    def _query_vector(self, title, author):
+        """Known q-gram ids and weights of a query, normalized like the indexed vectors"""
+        grams = self._grams(title, author, self.q)
+        known = [self.terms.get(term, -1) for term in grams]
+        term_ids = np.array(known, dtype=np.int64)
+        idf = np.full(len(term_ids), self.unknown_idf)
+        idf[term_ids >= 0] = self.idf[term_ids[term_ids >= 0]]
+        weights = (1 + np.log(np.fromiter(grams.values(), dtype=np.float64, count=len(grams)))) * idf
+        is_title = np.fromiter((term[0] == 't' for term in grams), dtype=bool, count=len(grams))
+        weights = self._normalize(weights, np.zeros(len(grams), dtype=np.int64), is_title, 1,
+                                  self.title_weight, self.author_weight)
+        return term_ids[term_ids >= 0], weights[term_ids >= 0]
+
+    def query(self, title, author=None, k=10):
+        """
+        Top-k most similar indexed records of a (title, author) query
+        :return: list of (ID, similarity) tuples from most to least similar
+        """
+        term_ids, query_weights = self._query_vector(title, author)
+        if not len(term_ids):
+            return []
+        starts = self.term_ptr[term_ids]
+        lengths = self.term_ptr[term_ids + 1] - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        rows, inverse = np.unique(self.rows[positions], return_inverse=True)
+        scores = np.bincount(inverse, weights=self.weights[positions] * np.repeat(query_weights, lengths))
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+        top = top[np.lexsort((rows[top], -scores[top]))]
+        return list(zip(self.ids[rows[top]].tolist(), scores[top].tolist()))
+
+    def top_k(self, table, k=10, min_similarity=0.0):
+        """
+        Top-k candidates of every record of table
+        :return: DataFrame with the ltable_ID, rtable_ID and similarity of the candidate pairs
+        """
+        pairs = []
+        for record_id, title, author in zip(table['ID'].tolist(), table['title'].tolist(), table['author'].tolist()):
+            pairs += [(record_id, match_id, similarity) for match_id, similarity in self.query(title, author, k)
+                      if similarity >= min_similarity]
+        return pd.DataFrame(pairs, columns=['ltable_ID', 'rtable_ID', 'similarity'])
+
+    def save(self, path=INDEX_PATH):
+        """Saves the index as an uncompressed .npz file so it loads without parsing"""
+        np.savez(path, ids=self.ids, vocabulary=np.array(self.vocabulary, dtype=str), idf=self.idf,
+                 term_ptr=self.term_ptr, rows=self.rows, weights=self.weights,
+                 params=np.array([self.q, self.title_weight, self.author_weight]),
+                 fingerprint=np.array([self.fingerprint], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        with np.load(path) as data:
+            q, title_weight, author_weight = data['params'].tolist()
+            return cls(data['ids'], data['vocabulary'].tolist(), data['idf'], data['term_ptr'], data['rows'],
+                       data['weights'], int(q), title_weight, author_weight, int(data['fingerprint'][0]))
+
+
+def load_or_build_index(table, path=INDEX_PATH, q=3, source=None):
+    """
+    Loads the index of table from path, rebuilds and saves it if the file is missing or stale
+    :param source: name of the table the index file belongs to (e.g. 'table_b_cleaned'), the index of
+    another table (e.g. the changed records of an incremental run) is only built in memory so it does
+    not replace the file
+    """
+    fingerprint = _table_hash(table, ['ID', 'title', 'author'])
+    if os.path.exists(path):
+        index = SimilarityIndex.load(path)
+        if index.q == q and index.fingerprint == fingerprint:
+            mt.count('similarity_index_hits')
+            return index
+    mt.count('similarity_index_misses')
+    index = SimilarityIndex.build(table, q)
+    if source is not None:
+        source_table = st.read_table(st.table_path(source), st.TABLE_B)
+        if _table_hash(source_table, ['ID', 'title', 'author']) != fingerprint:
+            print(f"Built similarity index of {len(index.ids)} records in memory")
+            return index
+    index.save(path)
+    print(f"Built similarity index of {len(index.ids)} records ({len(index.vocabulary)} q-grams) in {path}")
+    return index
+
+
+def index_blocker(k=10, min_similarity=0.0, path=INDEX_PATH, source='table_b_cleaned'):
+    """
+    Blocker (see utils_blocking.block_tables) returning the top-k most similar table_b records of every
+    table_a record according to the similarity index of table_b, e.g. perform_matching([index_blocker()])
+    :param source: table whose index is saved to path, the index of any other table_b is built in memory
+    """
+    def blocker(table_a, table_b, candidates=None):
+        index = load_or_build_index(table_b, path, source=source)
+        pairs = index.top_k(table_a, k, min_similarity)[['ltable_ID', 'rtable_ID']]
+        if candidates is not None:
+            return candidates.merge(pairs, on=['ltable_ID', 'rtable_ID'])
+        return pairs
+    return blocker
@@ -1,10 +1,16 @@
-import csv
-import matplotlib.pyplot as plt
+import itertools
+import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
-import requests
-from io import BytesIO
-from PIL import Image
+import utils_blocking as bl
+import utils_covers as cv
+import utils_http as hp
+import utils_metrics as mt
+import utils_normalization as nm
+import utils_parallel as px
+import utils_storage as st
 
 
 def mse(image1, image2):
@@ -18,51 +24,27 @@ def mse(image1, image2):
     # axes[1].axis('off')
     # fig.suptitle(f'Mean Squared Error: {np.mean((np.array(image1) - np.array(image2)) ** 2):.2f}')
     # plt.show()
-    image1 = np.array(image1)
-    image2 = np.array(image2)
+    # compare float pixels in [0, 1], subtracting the uint8 arrays directly would wrap around
+    image1 = np.asarray(image1, dtype=np.float32) / 255.0
+    image2 = np.asarray(image2, dtype=np.float32) / 255.0
 
-    return np.mean((image1 - image2) ** 2) / 255.0
+    return np.mean((image1 - image2) ** 2)
 
 
 def get_picture_openbook(url):
-    if url.startswith('//'):
-        url = 'http:' + url
-    elif url.startswith('http'):
-        pass
-    elif url.startswith('/'):
+    """Returns the open library cover of url from the cover cache (downloaded if needed)"""
+    url = cv.normalize_cover_url(url)
+    if url is None:
         return None
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            image = Image.open(BytesIO(response.content))
-            # plt.imshow(image)
-            # plt.axis('off')
-            # plt.show()
-        else:
-            print(f"Failed to download image:{url} {response.status_code}")
-            return None
-    except Exception as e:
-        print(f"Error downloading image for ID:{url} {e}")
-        return None
-    return image
+    return cv.load_cover(cv.fetch_cover(url, hp.shared_session()))
+
+
 def get_picture_gutenberg(url):
-    if url:
-        try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                image = Image.open(BytesIO(response.content))
-                # plt.imshow(image)
-                # plt.axis('off')
-                # plt.show()
-            else:
-                print(f"Failed to download image: {url} {response.status_code}")
-                return None
-        except Exception as e:
-            print(f"Error downloading image for {url} {e}")
-            return None
-    else:
+    """Returns the gutenberg cover of url from the cover cache (downloaded if needed)"""
+    url = cv.normalize_cover_url(url)
+    if url is None:
         return None
-    return image
+    return cv.load_cover(cv.fetch_cover(url, hp.shared_session()))
 
 def normalize_title(title):
     common_prefixes = {"the ", "a ", "an "}
@@ -72,87 +54,526 @@ def normalize_title(title):
         words.pop(0)
     return " ".join(words)
 
-def perform_matching():
-    table_a = pd.read_csv('table_a_cleaned.csv')
-    table_b = pd.read_csv('table_b_cleaned.csv')
-    # Normalize titles
-    # table_a['title'] = table_a.apply(lambda row: normalize_title(row['title']), axis=1)
-    # table_b['title'] = table_b.apply(lambda row: normalize_title(row['title']), axis=1)
-    # not used since it performs poorly
-    # Create a Cartesian Product (Cross Join)
+# run report of the matching stages (see utils_metrics)
+REPORT_PATH = "matching_report.json"
+# candidate pairs are kept if their distances are below these thresholds
+TITLE_THRESHOLD = 0.6
+AUTHOR_THRESHOLD = 0.35
+# score of a match: weighted sum of its features, lower is better
+SCORE_WEIGHTS = {'distance_title': 0.5, 'distance_author': 0.3, 'difference_year': 0.1, 'cover_mse': 0.1}
+# features of the matches of the last run, for re-scoring without matching again (see rescore)
+FEATURES_PATH = "pair_features.npz"
+FEATURE_COLUMNS = ['ltable_ID', 'rtable_ID', 'distance_title', 'distance_author', 'language_match', 'cover_mse',
+                   'ltable_first_published_year', 'rtable_first_published_year']
+MATCH_COLUMNS = ['ID', 'ltable_ID', 'rtable_ID', 'ltable_title', 'rtable_title', 'ltable_author', 'rtable_author',
+                 'ltable_first_published_year', 'rtable_first_published_year', 'ltable_language', 'rtable_language',
+                 'ltable_cover_image', 'rtable_cover_image', 'ltable_publisher', 'rtable_publisher', 'distance_title',
+                 'distance_author', 'difference_year', 'language_match', 'cover_mse', 'score']
+
+
+def candidate_table(candidates, table_a, table_b):
+    """Joins the (ltable_ID, rtable_ID) candidate pairs with the attributes of both tables"""
     table_a = table_a.rename(columns={
         col: f"ltable_{col}" for col in table_a.columns
     })
     table_b = table_b.rename(columns={
         col: f"rtable_{col}" for col in table_b.columns
     })
-    table_a['key'] = 1
-    table_b['key'] = 1
-    table_c = table_a.merge(table_b, on='key').drop(columns=['key'])
-    print(f"Size of cartesian product: {len(table_c)}")
-
-    # Compute Title Edit Distance
-    table_c['distance_title'] = table_c.apply(
-        lambda row: edit_distance(row['ltable_title'], row['rtable_title']) / max(len(row['ltable_title']), len(row['rtable_title'])),
-        axis=1
-    )
-
-    # Compute Author Edit Distance
-    table_c['distance_author'] = table_c.apply(
-        lambda row: 1 if pd.isna(row['ltable_author']) or pd.isna(row['rtable_author'])
-        else edit_distance(row['ltable_author'], row['rtable_author']) / max(len(row['ltable_author']), len(row['rtable_author'])), axis=1
-    )
+    table_c = candidates.merge(table_a, on='ltable_ID').merge(table_b, on='rtable_ID')
+    return table_c[list(table_a.columns) + list(table_b.columns)]
 
-    # Compute Language Match
-    table_c['language_match'] = np.where(
-        (table_c['ltable_language'].fillna('') == table_c['rtable_language'].fillna('')) |
-        (table_c['ltable_language'].isna() | table_c['rtable_language'].isna()), 1, 0
-    )
+
+def filter_candidates(table_c, workers=1, title_threshold=TITLE_THRESHOLD, author_threshold=AUTHOR_THRESHOLD):
+    """
+    Computes the language match and the author and title distances of the candidate pairs
+    :param workers: number of processes computing the distances (see utils_parallel)
+    :param title_threshold: largest title distance (excluded) of the pairs that are kept
+    :param author_threshold: largest author distance (excluded) of the pairs that are kept
+    :return: the pairs that pass the thresholds
+    """
+    table_c = candidate_distances(table_c, workers, title_threshold, author_threshold)
     print("Finished computing distances and language matches")
     # Filter matches based on distances and language match
-    filtered_table_c = table_c[
-        (table_c['distance_title'] < 0.6) &
-        (table_c['distance_author'] < 0.35) &
-        (table_c['language_match'] == 1)
-        ]
-    filtered_table_c.to_csv('table_c_initial.csv', index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    keep = ((table_c['distance_title'] < title_threshold) & (table_c['distance_author'] < author_threshold) &
+            (table_c['language_match'] == 1)).to_numpy()
+    return table_c[keep].copy()
+
+
+def candidate_distances(table_c, workers=1, title_threshold=TITLE_THRESHOLD, author_threshold=AUTHOR_THRESHOLD):
+    """
+    Language match and author and title distances of the candidate pairs (see filter_candidates), the
+    distances of pairs that can not pass the thresholds are inf
+    :return: copy of table_c with the distance_title, distance_author and language_match columns
+    """
+    # Compute Language Match
+    # (integer comparison of interned languages, missing languages match everything)
+    languages = nm.ValueDictionary()
+    language_match = nm.codes_match(languages.encode(table_c['ltable_language']),
+                                    languages.encode(table_c['rtable_language']))
+    # Compute Author and Title Edit Distance as a similarity join: the distances are only computed
+    # for pairs that can still pass the filters, the others are set to inf
+    distance_author = np.full(len(table_c), np.inf)
+    distance_title = np.full(len(table_c), np.inf)
+    remaining = np.flatnonzero(language_match == 1)
+    distance_author[remaining] = px.parallel_edit_distance(
+        table_c['ltable_author'].to_numpy(dtype=object)[remaining],
+        table_c['rtable_author'].to_numpy(dtype=object)[remaining], author_threshold, missing=1, workers=workers)
+    remaining = remaining[distance_author[remaining] < author_threshold]
+    distance_title[remaining] = px.parallel_edit_distance(
+        table_c['ltable_title'].to_numpy(dtype=object)[remaining],
+        table_c['rtable_title'].to_numpy(dtype=object)[remaining], title_threshold, workers=workers)
+    mt.count('pairs_scored', len(table_c))
+    mt.count('edit_distances', int(np.isfinite(distance_author).sum() + np.isfinite(distance_title).sum()))
+    table_c = table_c.copy()
+    table_c['distance_title'] = distance_title
+    table_c['distance_author'] = distance_author
+    table_c['language_match'] = language_match
+    return table_c
+
+
+def year_difference(table_c, min_year, max_year=None):
+    """
+    Year difference of the matches normalized by the largest year of the matches minus min_year
+    (the smallest year of both tables)
+    :param max_year: largest year of all matches if table_c is only a part of them (default: of table_c)
+    """
+    if max_year is None:
+        max_year = table_c[['ltable_first_published_year', 'rtable_first_published_year']].max().max()
+    max_year_diff = max_year - min_year
+    max_year_diff = 0 if pd.isna(max_year_diff) else float(max_year_diff)
+    difference = (table_c['ltable_first_published_year'] -
+                  table_c['rtable_first_published_year']).abs().to_numpy(dtype=float, na_value=np.nan)
+    return difference / max_year_diff if max_year_diff > 0 else np.zeros(len(difference))
+
+
+def cover_difference(table_c, workers=1, stores=('features_table_a', 'features_table_b')):
+    """
+    Cover MSE of the matches, the covers are downloaded once into the cover cache
+    :param stores: names of the thumbnail stores of the ltable and rtable records in the cover cache
+    """
+    # download every distinct cover once, concurrently; the cache is reused by get_picture_* and later runs
+    cv.fetch_covers([cv.normalize_cover_url(url) for url in
+                     table_c['ltable_cover_image'].tolist() + table_c['rtable_cover_image'].tolist()])
+    # decode every cover once into the thumbnail stores and compare all pairs in a vectorized pass
+    store_path_a, store_path_b = (os.path.join(cv.COVER_CACHE_DIR, store) for store in stores)
+    cv.build_cover_store(table_c['ltable_ID'], table_c['ltable_cover_image'], store_path_a)
+    cv.build_cover_store(table_c['rtable_ID'], table_c['rtable_cover_image'], store_path_b)
+    mt.count('cover_pairs', len(table_c))
+    return px.parallel_cover_mse(store_path_a, table_c['ltable_ID'], store_path_b, table_c['rtable_ID'], workers)
+
+
+def weighted_score(features, weights=None):
+    """
+    Score of the matches: weighted sum of their features (missing if a feature is missing)
+    :param features: DataFrame (or dict of arrays) with the columns of the weights
+    :param weights: dict feature -> weight (default: SCORE_WEIGHTS)
+    """
+    score = None
+    for column, weight in (weights or SCORE_WEIGHTS).items():
+        term = weight * features[column]
+        score = term if score is None else score + term
+    return score
+
+
+def rank_matches(table_c, first_id=0, weights=None, keep_ids=False):
+    """
+    Computes the score of the matches, numbers them and sorts them from best to worst
+    (ties are ordered by ID, missing scores come last)
+    :param first_id: ID of the first match, for numbering the matches in batches
+    :param weights: weights of the score (default: SCORE_WEIGHTS)
+    :param keep_ids: keep the ID column of table_c instead of numbering the matches
+    """
+    table_c = table_c.copy()
+    table_c['score'] = weighted_score(table_c, weights)
+    print('Finished computing score')
+    # Add ID column
+    if not keep_ids:
+        table_c['ID'] = np.arange(first_id, first_id + len(table_c))
+    table_c = table_c[MATCH_COLUMNS]
+    return table_c.sort_values(['score', 'ID'], ascending=True, kind='stable')
+
+
+def _rank_key(row):
+    """Sort key of a ranked match, the same order as rank_matches"""
+    score = row['score']
+    return (1, 0.0, row['ID']) if pd.isna(score) else (0, score, row['ID'])
+
+
+def save_snapshot(table_a, table_b):
+    """Saves the tables a ranking was computed from, incremental_matching compares them with the next version"""
+    st.write_table(table_a, st.table_path('table_a_matched'), st.TABLE_A)
+    st.write_table(table_b, st.table_path('table_b_matched'), st.TABLE_B)
+
+
+def perform_matching(blockers=None, reference_pairs=None, workers=1, title_threshold=TITLE_THRESHOLD,
+                     author_threshold=AUTHOR_THRESHOLD):
+    """
+    Matches table_a against table_b and saves the ranked matches to tableC.csv, and their features to
+    FEATURES_PATH so they can be re-scored (see rescore)
+    :param blockers: blocking pipeline passed to utils_blocking.block_tables (default pipeline if None)
+    :param reference_pairs: optional CSV file with known (ltable_ID, rtable_ID) matches used to report
+    the pair completeness of the blocking stage
+    :param workers: number of processes scoring the pairs (None: one per core, 1: in-process)
+    :param title_threshold: filter threshold of the title distance (see filter_candidates)
+    :param author_threshold: filter threshold of the author distance
+    """
+    table_a = st.read_table(st.table_path('table_a_cleaned'), st.TABLE_A)
+    table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+    # Normalize titles
+    # table_a['title'] = table_a.apply(lambda row: normalize_title(row['title']), axis=1)
+    # table_b['title'] = table_b.apply(lambda row: normalize_title(row['title']), axis=1)
+    # not used since it performs poorly
+    # Generate candidate pairs instead of the full Cartesian Product (Cross Join)
+    with mt.stage('matching/blocking', rows_in=len(table_a) + len(table_b)) as s:
+        candidates = bl.block_tables(table_a, table_b, blockers)
+        s.rows_out = len(candidates)
+    if reference_pairs is not None:
+        reference_pairs = st.read_table(reference_pairs, st.TABLE_C)
+    report = bl.blocking_report(candidates, table_a, table_b, reference_pairs)
+    print(f"Blocking report: {report}")
+    # smallest year of the whole cartesian product, used to normalize the year difference
+    min_year = min(table_a['first_published_year'].min(), table_b['first_published_year'].min())
+    table_c = candidate_table(candidates, table_a, table_b)
+    print(f"Size of candidate set: {len(table_c)}")
+
+    with mt.stage('matching/filter', rows_in=len(table_c)) as s:
+        filtered_table_c = filter_candidates(table_c, workers, title_threshold, author_threshold)
+        st.write_table(filtered_table_c, st.table_path('table_c_initial'), st.TABLE_C)
+        s.rows_out = len(filtered_table_c)
     print(f"Size filtered matches: {len(filtered_table_c)}")
     print("Finished filtering matches")
     # Compute Year Difference Normalization
-    max_year_diff = filtered_table_c[['ltable_first_published_year', 'rtable_first_published_year']].max().max() - table_c[
-        ['ltable_first_published_year', 'rtable_first_published_year']].min().min()
-    filtered_table_c['difference_year'] = filtered_table_c.apply(
-        lambda row: abs(
-            row['ltable_first_published_year'] - row['rtable_first_published_year']) / max_year_diff if max_year_diff > 0 else 0,
-        axis=1
-    )
+    filtered_table_c['difference_year'] = year_difference(filtered_table_c, min_year)
     print('Finished computing publish year difference')
 
     # Compute cover_mse
-    filtered_table_c['cover_mse'] = filtered_table_c.apply(
-        lambda row: 0 if get_picture_openbook(row['ltable_cover_image']) is None or get_picture_gutenberg(
-            row['rtable_cover_image']) is None
-        else mse(get_picture_openbook(row['ltable_cover_image']), get_picture_gutenberg(row['rtable_cover_image'])),
-        axis=1
-    )
+    with mt.stage('matching/cover_mse', rows_in=len(filtered_table_c)) as s:
+        filtered_table_c['cover_mse'] = cover_difference(filtered_table_c, workers)
+        s.rows_out = len(filtered_table_c)
     print('Finished computing cover_mse')
 
     # Compute score
-    filtered_table_c['score'] = (0.5 * filtered_table_c['distance_title'] + 0.3 *
-                                        filtered_table_c['distance_author'] + 0.1 * filtered_table_c['difference_year']
-                                        + 0.1 * filtered_table_c['cover_mse'])
-    print('Finished computing score')
-    # Add ID column
-    filtered_table_c['ID'] = np.arange(len(filtered_table_c))
-    filtered_table_c = filtered_table_c[['ID', 'ltable_ID', 'rtable_ID', 'ltable_title', 'rtable_title', 'ltable_author',
-                                         'rtable_author', 'ltable_first_published_year', 'rtable_first_published_year',
-                                         'ltable_language', 'rtable_language', 'ltable_cover_image', 'rtable_cover_image',
-                                         'ltable_publisher', 'rtable_publisher', 'distance_title', 'distance_author',
-                                         'difference_year', 'language_match', 'cover_mse', 'score']]
-    filtered_table_c.sort_values('score', ascending=True, inplace=True)
-    filtered_table_c.to_csv('tableC.csv', index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    with mt.stage('matching/rank', rows_in=len(filtered_table_c)) as s:
+        filtered_table_c = rank_matches(filtered_table_c)
+        st.write_table(filtered_table_c, st.table_path('tableC'), st.TABLE_C)
+        s.rows_out = len(filtered_table_c)
+    save_snapshot(table_a, table_b)
+    save_features(filtered_table_c, min_year, title_threshold, author_threshold)
+
+
+def _combine(func, *values):
+    """min / max of the values that are not missing (NA if all are missing)"""
+    values = [value for value in values if not pd.isna(value)]
+    return func(values) if values else pd.NA
+
+
+def perform_matching_chunked(blockers=None, chunk_size=10000, run_size=100000, spill_dir=None, workers=1,
+                             title_threshold=TITLE_THRESHOLD, author_threshold=AUTHOR_THRESHOLD):
+    """
+    Out-of-core version of perform_matching for catalogs that do not fit in memory. table_b is kept
+    in memory as the indexed side, table_a is streamed in chunks of chunk_size rows:
+    1. every chunk is blocked and filtered against table_b and its matches are appended to table_c_initial
+    2. table_c_initial is read back in runs of run_size matches, which are scored, sorted by score and
+       spilled to disk
+    3. the sorted runs are merged into tableC (external merge sort)
+    Memory is bounded by chunk_size (candidate pairs of a chunk) and run_size (matches held at once)
+    instead of the size of table_a. Blocking a chunk against table_b can differ slightly from blocking
+    the full tables (sorted neighbourhood windows), utils_index.index_blocker does not depend on the chunks
+    :param spill_dir: directory of the sorted runs (a temporary directory if None), removed at the end
+    :param workers: number of processes scoring the pairs (see perform_matching)
+    :param title_threshold: filter threshold of the title distance (see filter_candidates)
+    :param author_threshold: filter threshold of the author distance
+    """
+    table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+    min_year = table_b['first_published_year'].min()
+    max_year = pd.NA
+    candidate_pairs = 0
+
+    def filtered_chunks():
+        nonlocal min_year, max_year, candidate_pairs
+        for chunk in st.iter_table(st.table_path('table_a_cleaned'), st.TABLE_A, chunk_size):
+            min_year = _combine(min, min_year, chunk['first_published_year'].min())
+            table_c = candidate_table(bl.block_tables(chunk, table_b, blockers), chunk, table_b)
+            candidate_pairs += len(table_c)
+            filtered = filter_candidates(table_c, workers, title_threshold, author_threshold)
+            max_year = _combine(max, max_year, filtered['ltable_first_published_year'].max(),
+                                filtered['rtable_first_published_year'].max())
+            yield filtered
+
+    # pass 1: block and filter table_a chunk by chunk
+    initial_path = st.table_path('table_c_initial')
+    columns = [f'ltable_{col}' for col in st.TABLE_A] + [f'rtable_{col}' for col in st.TABLE_B] + [
+        'distance_title', 'distance_author', 'language_match']
+    with mt.stage('matching/filter_chunks') as s:
+        matches = st.write_table_batches(filtered_chunks(), initial_path, st.TABLE_C, columns)
+        s.rows_in = candidate_pairs
+        s.rows_out = matches
+    print(f"Size of candidate set: {candidate_pairs}")
+    print(f"Size filtered matches: {matches}")
+
+    # pass 2: score the matches in runs and spill every run sorted by score
+    cleanup = spill_dir is None
+    spill_dir = tempfile.mkdtemp(prefix='matching_spill_') if spill_dir is None else spill_dir
+    os.makedirs(spill_dir, exist_ok=True)
+    runs = []
+    with mt.stage('matching/score_runs', rows_in=matches) as s:
+        for table_c in st.iter_table(initial_path, st.TABLE_C, run_size):
+            table_c['difference_year'] = year_difference(table_c, min_year, max_year)
+            table_c['cover_mse'] = cover_difference(table_c, workers)
+            run_path = os.path.join(spill_dir, st.table_path(f'run_{len(runs):05d}'))
+            st.write_table(rank_matches(table_c, first_id=run_size * len(runs)), run_path, st.TABLE_C)
+            runs.append(run_path)
+        s.rows_out = matches
+    print(f"Spilled {len(runs)} sorted runs to {spill_dir}")
+
+    # pass 3: external merge of the sorted runs
+    with mt.stage('matching/merge_runs', rows_in=matches) as s:
+        s.rows_out = st.write_table_batches(st.merge_sorted_tables(runs, st.TABLE_C, _rank_key, run_size),
+                                            st.table_path('tableC'), st.TABLE_C, MATCH_COLUMNS)
+    if cleanup:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    print("Finished merging matches")
+    # the features are a few columns of tableC, small enough to be gathered in memory
+    features = pd.concat([chunk[FEATURE_COLUMNS + ['ID']] for chunk in
+                          st.iter_table(st.table_path('tableC'), st.TABLE_C, run_size)], ignore_index=True)
+    save_features(features, min_year, title_threshold, author_threshold)
+
+
+def table_delta(old, new, key='ID'):
+    """
+    Compares two versions of a table row by row (by hashing the values of every row)
+    :return: (added, changed, removed) lists of keys
+    """
+    columns = [column for column in new.columns if column in old.columns]
+    old_hashes = pd.Series(pd.util.hash_pandas_object(old[columns], index=False).to_numpy(), index=old[key])
+    new_hashes = pd.Series(pd.util.hash_pandas_object(new[columns], index=False).to_numpy(), index=new[key])
+    added = new_hashes.index.difference(old_hashes.index)
+    removed = old_hashes.index.difference(new_hashes.index)
+    common = new_hashes.index.intersection(old_hashes.index)
+    changed = common[new_hashes[common].to_numpy() != old_hashes[common].to_numpy()]
+    return list(added), list(changed), list(removed)
+
+
+def _last_thresholds(path=FEATURES_PATH):
+    """(title, author) thresholds of the last match run, saved with its pair features (defaults if not saved)"""
+    try:
+        _, params = load_features(path)
+    except OSError:
+        return TITLE_THRESHOLD, AUTHOR_THRESHOLD
+    return params['title_threshold'], params['author_threshold']
+
+
+def incremental_matching(blockers=None, reference_pairs=None, workers=1, title_threshold=None,
+                         author_threshold=None):
+    """
+    Updates tableC.csv after table_a and/or table_b changed, without matching the full tables again.
+    The cleaned tables are compared with the snapshot of the last run: only the candidate pairs of
+    added and changed records (against the whole opposite table) are scored, the matches of changed
+    and removed records are retired and the remaining matches are kept. The year difference and the
+    score depend on all matches, so they are recomputed for the merged ranking.
+    Blocking the new records against the opposite table is not always identical to blocking the full
+    tables (sorted neighbourhood windows and block sizes depend on the rows blocked together), run
+    perform_matching from time to time to rebuild the ranking from scratch
+    :param blockers: blocking pipeline passed to utils_blocking.block_tables (default pipeline if None)
+    :param reference_pairs: CSV file of known matches, the pair completeness of blocking the added and
+    changed records is reported for the known matches of these records
+    :param workers: number of processes scoring the pairs
+    :param title_threshold: title distance threshold (default: the one of the last run). The kept matches
+    were filtered with the threshold of the last run, a looser one matches the full tables again
+    :param author_threshold: author distance threshold (default: the one of the last run)
+    """
+    last_title_threshold, last_author_threshold = _last_thresholds()
+    title_threshold = last_title_threshold if title_threshold is None else title_threshold
+    author_threshold = last_author_threshold if author_threshold is None else author_threshold
+    snapshot_paths = [st.table_path(name) for name in ['table_a_matched', 'table_b_matched', 'tableC']]
+    if not all(os.path.exists(path) for path in snapshot_paths):
+        print("No previous matching run found, matching the full tables")
+        return perform_matching(blockers, reference_pairs, workers, title_threshold, author_threshold)
+    if title_threshold > last_title_threshold or author_threshold > last_author_threshold:
+        print(f"The last run kept the matches up to the thresholds {last_title_threshold} (title) and "
+              f"{last_author_threshold} (author), matching the full tables")
+        return perform_matching(blockers, reference_pairs, workers, title_threshold, author_threshold)
+    table_a = st.read_table(st.table_path('table_a_cleaned'), st.TABLE_A)
+    table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+    old_a = st.read_table(st.table_path('table_a_matched'), st.TABLE_A)
+    old_b = st.read_table(st.table_path('table_b_matched'), st.TABLE_B)
+    added_a, changed_a, removed_a = table_delta(old_a, table_a)
+    added_b, changed_b, removed_b = table_delta(old_b, table_b)
+    print(f"table_a: {len(added_a)} added, {len(changed_a)} changed, {len(removed_a)} removed")
+    print(f"table_b: {len(added_b)} added, {len(changed_b)} changed, {len(removed_b)} removed")
+
+    # retire the matches of changed and removed records, and those that do not pass tighter thresholds
+    table_c = st.read_table(st.table_path('tableC'), st.TABLE_C)
+    retired = (table_c['ltable_ID'].isin(changed_a + removed_a).to_numpy() |
+               table_c['rtable_ID'].isin(changed_b + removed_b).to_numpy() |
+               ~((table_c['distance_title'] < title_threshold) &
+                 (table_c['distance_author'] < author_threshold)).to_numpy())
+    kept = table_c[~retired].drop(columns=['score'])
+    print(f"Retired matches: {retired.sum()}, kept matches: {len(kept)}")
+
+    # block and score the added and changed records against the opposite table
+    delta_a = table_a[table_a['ID'].isin(added_a + changed_a)]
+    delta_b = table_b[table_b['ID'].isin(added_b + changed_b)]
+    candidate_sets = []
+    if len(delta_a) and len(table_b):
+        candidate_sets.append(bl.block_tables(delta_a, table_b, blockers))
+    if len(delta_b) and len(table_a):
+        candidate_sets.append(bl.block_tables(table_a, delta_b, blockers))
+    new_matches = kept.iloc[:0]
+    if candidate_sets:
+        candidates = bl.union_candidates(*candidate_sets)
+        if reference_pairs is not None:
+            reference_pairs = st.read_table(reference_pairs, st.TABLE_C)
+            # only the known matches of the added and changed records can be found by this run
+            reference_pairs = reference_pairs[(reference_pairs['ltable_ID'].isin(delta_a['ID']) |
+                                               reference_pairs['rtable_ID'].isin(delta_b['ID'])).to_numpy()]
+            cartesian_size = len(delta_a) * len(table_b) + len(table_a) * len(delta_b)
+            report = bl.blocking_report(candidates, table_a, table_b, reference_pairs, cartesian_size)
+            print(f"Blocking report of the added and changed records: {report}")
+        new_table_c = candidate_table(candidates, table_a, table_b)
+        print(f"Size of candidate set: {len(new_table_c)}")
+        with mt.stage('matching/filter', rows_in=len(new_table_c)) as s:
+            new_matches = filter_candidates(new_table_c, workers, title_threshold, author_threshold)
+            s.rows_out = len(new_matches)
+        print(f"New matches: {len(new_matches)}")
+        # covers are only compared for the new matches
+        new_matches['cover_mse'] = cover_difference(new_matches, workers)
+        # the kept matches keep their IDs, the new ones are numbered after the largest ID of the last run
+        first_id = int(table_c['ID'].max()) + 1 if len(table_c) else 0
+        new_matches['ID'] = np.arange(first_id, first_id + len(new_matches))
+
+    filtered_table_c = pd.concat([kept, new_matches], ignore_index=True)
+    st.write_table(filtered_table_c.drop(columns=['difference_year', 'cover_mse']),
+                   st.table_path('table_c_initial'), st.TABLE_C)
+    min_year = min(table_a['first_published_year'].min(), table_b['first_published_year'].min())
+    filtered_table_c['difference_year'] = year_difference(filtered_table_c, min_year)
+    filtered_table_c = rank_matches(filtered_table_c, keep_ids=True)
+    st.write_table(filtered_table_c, st.table_path('tableC'), st.TABLE_C)
+    save_snapshot(table_a, table_b)
+    save_features(filtered_table_c, min_year, title_threshold, author_threshold)
+    print(f"Size of updated matches: {len(filtered_table_c)}")
+
+
+def save_features(table_c, min_year, title_threshold=TITLE_THRESHOLD, author_threshold=AUTHOR_THRESHOLD,
+                  path=FEATURES_PATH):
+    """
+    Saves the features of the matches (distances, language match, cover MSE and the years the year
+    difference is computed from) as an uncompressed .npz file, one row per (ltable_ID, rtable_ID) pair in
+    the order the matches were numbered. min_year and the thresholds the matches were filtered with are
+    saved with them: re-scoring can only tighten the thresholds
+    """
+    table_c = table_c.sort_values('ID', kind='stable')
+    np.savez(path, ltable_ID=table_c['ltable_ID'].to_numpy(dtype=str),
+             rtable_ID=table_c['rtable_ID'].to_numpy(dtype=np.int64),
+             **{column: table_c[column].to_numpy(dtype=np.float64, na_value=np.nan)
+                for column in FEATURE_COLUMNS[2:]},
+             params=np.array([np.nan if pd.isna(min_year) else float(min_year), title_threshold, author_threshold]))
+    print(f"Saved the features of {len(table_c)} matches to {path}")
+
+
+def load_features(path=FEATURES_PATH):
+    """
+    Loads the features saved by save_features
+    :return: (DataFrame with FEATURE_COLUMNS, dict with min_year, title_threshold and author_threshold)
+    """
+    with np.load(path) as data:
+        features = pd.DataFrame({column: data[column] for column in FEATURE_COLUMNS})
+        min_year, title_threshold, author_threshold = data['params'].tolist()
+    features = features.astype({'ltable_ID': 'string', 'rtable_ID': 'Int64', 'language_match': 'Int8',
+                                'ltable_first_published_year': 'Int64', 'rtable_first_published_year': 'Int64'})
+    params = {'min_year': pd.NA if np.isnan(min_year) else min_year, 'title_threshold': title_threshold,
+              'author_threshold': author_threshold}
+    return features, params
+
+
+def _select_features(features, params, title_threshold=None, author_threshold=None):
+    """Features of the matches that pass the (tighter) thresholds, in the order they were numbered"""
+    title_threshold = params['title_threshold'] if title_threshold is None else title_threshold
+    author_threshold = params['author_threshold'] if author_threshold is None else author_threshold
+    if title_threshold > params['title_threshold'] or author_threshold > params['author_threshold']:
+        raise ValueError(f"The features were computed for thresholds up to {params['title_threshold']} (title) and "
+                         f"{params['author_threshold']} (author), run the matching with larger thresholds first")
+    keep = ((features['distance_title'] < title_threshold) & (features['distance_author'] < author_threshold) &
+            (features['language_match'] == 1))
+    features = features[keep.to_numpy()].reset_index(drop=True)
+    features['difference_year'] = year_difference(features, params['min_year'])
+    return features
+
+
+def rescore(weights=None, title_threshold=None, author_threshold=None, path=FEATURES_PATH):
+    """
+    Ranks the matches of the last run again with other score weights and / or tighter thresholds from
+    their saved features, without blocking, computing distances or downloading covers. The attributes of
+    the matches come from the snapshot of the matched tables, tableC is replaced by the new ranking
+    (the same weights and thresholds give the same tableC)
+    :param weights: dict feature -> weight (default: SCORE_WEIGHTS)
+    :param title_threshold: title distance threshold, at most the one the features were computed with
+    :param author_threshold: author distance threshold, at most the one the features were computed with
+    :return: the ranked matches
+    """
+    features, params = load_features(path)
+    with mt.stage('matching/rescore', rows_in=len(features)) as s:
+        features = _select_features(features, params, title_threshold, author_threshold)
+        table_a = st.read_table(st.table_path('table_a_matched'), st.TABLE_A)
+        table_b = st.read_table(st.table_path('table_b_matched'), st.TABLE_B)
+        table_c = candidate_table(features[['ltable_ID', 'rtable_ID']], table_a, table_b)
+        table_c = table_c.merge(features.drop(columns=['ltable_first_published_year', 'rtable_first_published_year']),
+                                on=['ltable_ID', 'rtable_ID'])
+        table_c = rank_matches(table_c, weights=weights)
+        st.write_table(table_c, st.table_path('tableC'), st.TABLE_C)
+        s.rows_out = len(table_c)
+    print(f"Re-scored {len(table_c)} matches")
+    return table_c
+
+
+def weight_grid(step=0.1):
+    """Every combination of SCORE_WEIGHTS features with weights in multiples of step summing to 1"""
+    steps = int(round(1 / step))
+    return [{column: round(count * step, 10) for column, count in zip(SCORE_WEIGHTS, counts)}
+            for counts in itertools.product(range(steps + 1), repeat=len(SCORE_WEIGHTS)) if sum(counts) == steps]
+
+
+def sweep_weights(weight_sets, reference_pairs, title_threshold=None, author_threshold=None, path=FEATURES_PATH,
+                  batch_size=64):
+    """
+    Evaluates many score weights at once against known matches: the scores of a batch of weight sets are
+    one matrix product of the features, the rankings and their precision are computed for all columns
+    together
+    :param weight_sets: list of dicts feature -> weight (e.g. weight_grid())
+    :param reference_pairs: DataFrame (or CSV file) of known matches with ltable_ID and rtable_ID columns
+    :return: DataFrame with one row per weight set: the weights, the average precision of the ranking,
+    its precision at k (k: number of known matches) and the recall of the matches, best first
+    """
+    features, params = load_features(path)
+    features = _select_features(features, params, title_threshold, author_threshold)
+    if isinstance(reference_pairs, str):
+        reference_pairs = st.read_table(reference_pairs, st.TABLE_C)
+    reference_pairs = reference_pairs[['ltable_ID', 'rtable_ID']].astype(
+        {'ltable_ID': 'string', 'rtable_ID': 'Int64'}).drop_duplicates()
+    relevant = (features[['ltable_ID', 'rtable_ID']].merge(reference_pairs, how='left', indicator=True)['_merge'] ==
+                'both').to_numpy()
+    columns = list(SCORE_WEIGHTS)
+    values = features[columns].to_numpy(dtype=np.float64)
+    k = min(len(reference_pairs), len(features))
+    ranks = np.arange(1, len(features) + 1)[:, None]
+    results = []
+    with mt.stage('matching/sweep_weights', rows_in=len(features) * len(weight_sets)) as s:
+        for start in range(0, len(weight_sets), batch_size):
+            batch = weight_sets[start:start + batch_size]
+            weights = np.array([[weight_set.get(column, 0.0) for column in columns] for weight_set in batch])
+            scores = values @ weights.T  # missing features give missing scores, ranked last
+            hits = relevant[np.argsort(scores, axis=0, kind='stable')]
+            precision = np.cumsum(hits, axis=0) / ranks
+            average_precision = (precision * hits).sum(axis=0) / max(len(reference_pairs), 1)
+            precision_at_k = hits[:k].sum(axis=0) / k if k else np.full(len(batch), np.nan)
+            for weight_set, ap, pk in zip(batch, average_precision, precision_at_k):
+                results.append({**{column: weight_set.get(column, 0.0) for column in columns},
+                                'average_precision': ap, 'precision_at_k': pk})
+        s.rows_out = len(results)
+    results = pd.DataFrame(results, columns=columns + ['average_precision', 'precision_at_k'])
+    results['recall'] = relevant.sum() / len(reference_pairs) if len(reference_pairs) else np.nan
+    return results.sort_values('average_precision', ascending=False, kind='stable').reset_index(drop=True)
 
-import Levenshtein as lev
 
 def jaccard_similarity(str1, str2):
     a = set(str1.split())
@@ -178,6 +599,9 @@ def edit_distance_not_optimized(str1, str2): # not used since it is slow
     return matrix[len_str1 - 1, len_str2 - 1]
 
 def edit_distance(str1, str2):
+    import Levenshtein as lev
     return lev.distance(str1, str2)
 
-perform_matching()
\ No newline at end of file
+if __name__ == "__main__":
+    perform_matching()
+    mt.write_report(REPORT_PATH)
@@ -0,0 +1,188 @@
+import bisect
+import contextlib
+import csv
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+# profile every stage when set: 'cprofile' or 'pyinstrument' (pyinstrument has to be installed)
+PROFILE_ENGINE = os.environ.get("BOOKS_PROFILE")
+PROFILE_DIR = "profiles"
+
+_lock = threading.Lock()
+_local = threading.local()
+_stages = []
+_counters = {}
+_histograms = {}
+_profiling = False
+
+
+def reset():
+    """Forgets all recorded stages, counters and histograms (start of a new run)"""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _histograms.clear()
+
+
+def peak_rss():
+    """Peak resident set size of the process so far in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on linux
+
+
+def current_rss():
+    """Current resident set size in bytes (None where /proc is not available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def count(name, value=1):
+    """Adds value to the counter name, e.g. count('http_requests') or count('http_bytes', len(content))"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Records a duration in the latency histogram name"""
+    with _lock:
+        histogram = _histograms.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                                  'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+        histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+class Stage:
+    """Measurements of one stage, the code in the stage sets rows_in / rows_out"""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+def _start_profiler(engine):
+    if engine == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, engine, name, directory):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name.replace('/', '.'))
+    if engine == 'pyinstrument':
+        profiler.stop()
+        with open(path + '.html', 'w') as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(path + '.prof')
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None, profile=None):
+    """
+    Measures the wall time, the RSS and the rows in / out of a pipeline stage. Nested stages are
+    named parent/child:
+        with stage('matching/blocking', rows_in=len(table_a)) as s:
+            ...
+            s.rows_out = len(candidates)
+    :param profile: profile the stage with 'cprofile' or 'pyinstrument' (default: PROFILE_ENGINE),
+    the profile is saved to PROFILE_DIR/<stage>.prof (.html for pyinstrument)
+    """
+    global _profiling
+    parents = getattr(_local, 'stack', [])
+    _local.stack = parents + [name]
+    measured = Stage('/'.join(_local.stack), rows_in)
+    engine = profile or PROFILE_ENGINE
+    profiler = None
+    with _lock:
+        if engine and not _profiling:  # only one profiler can be active at a time
+            _profiling = True
+            profiler = _start_profiler(engine)
+    rss_before = current_rss()
+    start = time.perf_counter()
+    try:
+        yield measured
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            _stop_profiler(profiler, engine, measured.name, PROFILE_DIR)
+            _profiling = False
+        _local.stack = parents
+        rss_after = current_rss()
+        record = {
+            'stage': measured.name,
+            'seconds': seconds,
+            'rows_in': measured.rows_in,
+            'rows_out': measured.rows_out,
+            'rss_before_mb': None if rss_before is None else rss_before / 2 ** 20,
+            'rss_after_mb': None if rss_after is None else rss_after / 2 ** 20,
+            'peak_rss_mb': peak_rss() / 2 ** 20,
+        }
+        with _lock:
+            _stages.append(record)
+        print(f"[{measured.name}] {seconds:.2f} s, rows in: {measured.rows_in}, rows out: {measured.rows_out}, "
+              f"peak RSS: {record['peak_rss_mb']:.0f} MB")
+
+
+def report():
+    """
+    Run report: the measurements of every stage (in the order they finished), the counters, the
+    hit rate of every cache with <name>_hits / <name>_misses counters and the latency histograms
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {name: dict(histogram, buckets=list(histogram['buckets']))
+                      for name, histogram in _histograms.items()}
+        stages = [dict(record) for record in _stages]
+    hit_rates = {}
+    for name in counters:
+        if name.endswith('_hits'):
+            cache = name[:-len('_hits')]
+            lookups = counters[name] + counters.get(cache + '_misses', 0)
+            hit_rates[cache] = counters[name] / lookups if lookups else None
+    for histogram in histograms.values():
+        histogram['mean'] = histogram['sum'] / histogram['count'] if histogram['count'] else None
+        histogram['bucket_bounds'] = LATENCY_BUCKETS + ['inf']
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'peak_rss_mb': peak_rss() / 2 ** 20,
+        'stages': stages,
+        'counters': counters,
+        'hit_rates': hit_rates,
+        'histograms': histograms,
+    }
+
+
+def write_report(path="run_report.json"):
+    """
+    Saves the run report as JSON, and the stage table as CSV next to it (<path without .json>_stages.csv)
+    :return: the report
+    """
+    run_report = report()
+    with open(path, 'w') as f:
+        json.dump(run_report, f, indent=2)
+    columns = ['stage', 'seconds', 'rows_in', 'rows_out', 'rss_before_mb', 'rss_after_mb', 'peak_rss_mb']
+    with open(os.path.splitext(path)[0] + '_stages.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, quoting=csv.QUOTE_MINIMAL)
+        writer.writeheader()
+        writer.writerows(run_report['stages'])
+    print(f"Saved run report to {path}")
+    return run_report
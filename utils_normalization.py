@@ -0,0 +1,86 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# language values of open library that are standardized before matching
+LANGUAGE_ALIASES = {
+    'English, Middle (1100-1500)': 'Middle English',
+    'Undetermined': '',
+    'Spanish, English': 'English',
+    'French, English': 'French',
+}
+# different spellings of the same author
+AUTHOR_ALIASES = {
+    '3dtotal 3dtotal Publishing': '3DTotal Publishing',
+    '3dtotal Publishing': '3DTotal Publishing',
+    '3DTotal.com': '3DTotal Publishing',
+}
+
+
+@lru_cache(maxsize=65536)
+def canonical_language(language):
+    return LANGUAGE_ALIASES.get(language, language)
+
+
+@lru_cache(maxsize=65536)
+def canonical_author(author):
+    return AUTHOR_ALIASES.get(author, author)
+
+
+def map_distinct(values, func, missing=None):
+    """
+    Applies func once per distinct value instead of once per row
+    :param values: Series or sequence of hashable values
+    :param missing: result for missing values (func is not called for them)
+    :return: list with the result of every row
+    """
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    results = [func(value) for value in uniques] + [missing]  # code -1 (missing) maps to the last entry
+    return [results[code] for code in codes.tolist()]
+
+
+def normalize_column(series, func):
+    """Canonicalizes every distinct value of a string column once, missing values are kept"""
+    values = map_distinct(series, func, missing=pd.NA)
+    return pd.Series(values, index=series.index, dtype='string')
+
+
+class ValueDictionary:
+    """
+    Interned values: every distinct value gets an integer code, so columns encoded with the same
+    dictionary are compared on integers instead of strings. Missing values are encoded as -1
+    """
+
+    def __init__(self, values=()):
+        self.values = []
+        self.codes = {}
+        for value in values:
+            self.intern(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def intern(self, value):
+        """Code of value, a new code is assigned to values that were not seen before"""
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values):
+        """Integer codes of a column (each distinct value is looked up once)"""
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        lookup = np.array([self.intern(value) for value in uniques] + [-1], dtype=np.int64)
+        return lookup[codes]
+
+
+def codes_match(left, right, allow_missing=True):
+    """Compares two code arrays: 1 where equal (or where one side is missing if allow_missing), else 0"""
+    left = np.asarray(left)
+    right = np.asarray(right)
+    match = (left == right) & (left >= 0)
+    if allow_missing:
+        match |= (left < 0) | (right < 0)
+    return match.astype(np.int64)
@@ -1,15 +1,23 @@
-import csv
 import re
+from functools import partial
 from bs4 import BeautifulSoup
 import os
-import requests
-import time
 
-def get_html_pages(query, num_pages):
+import utils_archive as ar
+import utils_crawler as cr
+import utils_metrics as mt
+import utils_parsing as ps
+
+def get_html_pages(query, num_pages, concurrency=4, rate=1.0, manifest_path=cr.MANIFEST_PATH, archive=None):
     """
     Fetches the HTML pages from the Open Library website to extract links to books
     :param query: Query string to search for books
     :param num_pages: Number of pages to fetch
+    :param concurrency: Number of pages fetched in parallel
+    :param rate: Requests per second sent to Open Library
+    :param manifest_path: Fetch manifest, the result pages change over time so they are always
+    revalidated with conditional requests
+    :param archive: utils_archive.PageArchive the pages are stored in instead of one file per page
     """
     output_dir = "openlibrary_html_pages"
     base_url = "https://openlibrary.org/"
@@ -19,43 +27,46 @@ def get_html_pages(query, num_pages):
     elif query == "fantasy":
         base_url = f"https://openlibrary.org/search?q=fantasy&mode=everything&page=" # fantasy books
         output_dir = "openlibrary_html_pages_fantasy"
-    if not os.path.exists(output_dir):
+    if archive is None and not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    for i in range(1, num_pages + 1):
-        url = base_url + str(i)
-        print(f"Fetching page {i} from {url}")
-        response = requests.get(url)
-        if response.status_code == 200:
-            file_path = os.path.join(output_dir, f'page_{i}.html')
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            print(f"Saved page {i} to {file_path}")
-        else:
-            print(f"Failed to fetch page {i}")
-        time.sleep(1)  # small delay to avoid being blocked
+    jobs = [(base_url + str(i), os.path.join(output_dir, f'page_{i}.html')) for i in range(1, num_pages + 1)]
+    manifest = cr.FetchManifest(manifest_path)
+    with mt.stage(f'openlibrary/get_html_pages/{query}', rows_in=len(jobs)) as s:
+        report = cr.crawl(jobs, concurrency=concurrency, rate=rate, manifest=manifest, max_age=0,
+                          archive=archive)  # rate limited to avoid being blocked
+        s.rows_out = report['pages'] - report['failed']
+    manifest.close()
 
 
-def get_book_html(input_directory, output_directory):
+def get_book_html(input_directory, output_directory, concurrency=8, rate=1.0, manifest_path=cr.MANIFEST_PATH,
+                  max_age=None, archive=None):
     """
-    extracts the book html pages from the Open Library website
+    extracts the book html pages from the Open Library website. Pages already in the fetch manifest
+    are skipped (or revalidated once older than max_age seconds), so an interrupted crawl resumes
+    :param concurrency: Number of pages fetched in parallel
+    :param rate: Requests per second sent to Open Library
+    :param archive: utils_archive.PageArchive the search result pages are read from and the book pages
+    are stored in
+    :return: List of the book pages that are new or changed
     """
-    if not os.path.exists(output_directory):
+    if archive is None and not os.path.exists(output_directory):
         os.makedirs(output_directory)
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.html'):
-            filepath = os.path.join(input_directory, filename)
-            with open(filepath, 'r', encoding='utf-8') as file:
-                content = file.read()
-                soup = BeautifulSoup(content, 'html.parser')
-                book_links = soup.findAll("a", class_="results") # extract links to books
-                book_links = [link.get('href') for link in book_links]
-                for link in book_links:
-                    book_url = f"https://openlibrary.org{link}"
-                    book_html = requests.get(book_url).text
-                    book_id = link.split('/')[-1]
-                    output_filepath = os.path.join(output_directory, f"{book_id}.html")
-                    with open(output_filepath, 'w', encoding='utf-8') as output_file:
-                        output_file.write(book_html)
+    jobs = []
+    for _, content in ar.read_pages(input_directory, archive):
+        soup = BeautifulSoup(content, 'html.parser')
+        book_links = soup.findAll("a", class_="results") # extract links to books
+        book_links = [link.get('href') for link in book_links]
+        for link in book_links:
+            book_url = f"https://openlibrary.org{link}"
+            book_id = link.split('/')[-1]
+            jobs.append((book_url, os.path.join(output_directory, f"{book_id}.html")))
+    manifest = cr.FetchManifest(manifest_path)
+    with mt.stage('openlibrary/get_book_html', rows_in=len(jobs)) as s:
+        report = cr.crawl(jobs, concurrency=concurrency, rate=rate, as_text=True, manifest=manifest,
+                          max_age=max_age, archive=archive)  # rate limited to avoid being blocked
+        s.rows_out = report['pages'] - report['failed']
+    manifest.close()
+    return report['changed']
 
 
 def extract_book_title(soup):
@@ -130,68 +141,181 @@ def extract_work_id(soup):
         return work_id_dd.text.strip() if work_id_dd else None
     return None
 
-import pandas as pd
-def process_books(input_directory, output_file):
+COLUMNS = ['ID', 'title', 'subtitle', 'author', 'publisher', 'first_published_year', 'language', 'cover_image',
+           'pages', 'rating', 'isbn_10', 'isbn_13']
+
+
+def extract_book(soup):
+    """Extracts all fields of a book page parsed with BeautifulSoup"""
+    isbn_10 = extract_isbn_10(soup)
+    isbn_13 = extract_isbn_13(soup)
+    return {
+        'ID': extract_work_id(soup),
+        'title': extract_book_title(soup),
+        'subtitle': extract_book_subtitle(soup),
+        'author': extract_author(soup),
+        'publisher': extract_publisher(soup),
+        'first_published_year': extract_first_published_year(soup),
+        'language': extract_language(soup),
+        'cover_image': extract_cover_image(soup),
+        'pages': extract_number_of_pages(soup),
+        'rating': extract_rating(soup),
+        'isbn_10': isbn_10,
+        'isbn_13': isbn_13
+    }
+
+
+def _classes(element):
+    return element.get('class', '').split()
+
+
+def _string(element):
+    """Same as the .string of BeautifulSoup: the text of an element with a single text child (else None)"""
+    children = list(element)
+    if not children:
+        return element.text or ''
+    if len(children) == 1 and not (element.text or '') and not (children[0].tail or ''):
+        return _string(children[0])
+    return None
+
+
+# fields of the book page: (tag, test on the element, field name(s)), the first matching element wins
+LXML_FIELDS = {
+    'h1': [(lambda el: 'work-title' in _classes(el), 'title')],
+    'h2': [(lambda el: 'work-subtitle' in _classes(el), 'subtitle')],
+    'a': [(lambda el: el.get('itemprop') == 'author', 'author'),
+          (lambda el: el.get('itemprop') == 'publisher', 'publisher')],
+    'span': [(lambda el: 'first-published-date' in _classes(el), 'first_published_year'),
+             (lambda el: el.get('itemprop') == 'ratingValue', 'rating'),
+             (lambda el: 'edition-pages' in _classes(el) and el.get('itemprop') == 'numberOfPages', 'pages'),
+             (lambda el: el.get('itemprop') == 'inLanguage', 'language')],
+    'img': [(lambda el: 'cover' in _classes(el), 'cover_image')],
+    'dd': [(lambda el: 'object' in _classes(el) and el.get('itemprop') == 'isbn', 'isbn')],
+    'dt': [(lambda el: _string(el) == 'Work ID', 'ID')],
+}
+SKIPPED_TAGS = {'head', 'script', 'style', 'noscript', 'svg'}
+
+
+def extract_book_lxml(content):
     """
-    uses extraction functions and saves the data to a CSV file
+    Extracts the same fields as extract_book with the C-based lxml parser, gathering all of them in a
+    single traversal of the page body (the subtrees of SKIPPED_TAGS are skipped like with a SoupStrainer)
     """
-    data = []
-
-    for filename in os.listdir(input_directory):
-        if filename.endswith('.html'):
-            filepath = os.path.join(input_directory, filename)
-            with open(filepath, 'r', encoding='utf-8') as file:
-                content = file.read()
-                soup = BeautifulSoup(content, 'html.parser')
-                title = extract_book_title(soup)
-
-                subtitle = extract_book_subtitle(soup)
-                author = extract_author(soup)
-                first_published_year = extract_first_published_year(soup)
-                rating = extract_rating(soup)
-                cover_image = extract_cover_image(soup)
-                pages = extract_number_of_pages(soup)
-                language = extract_language(soup)
-                publisher = extract_publisher(soup)
-                isbn_10 = extract_isbn_10(soup)
-                isbn_13 = extract_isbn_13(soup)
-                work_id = extract_work_id(soup)
-                data.append({
-                    'ID': work_id,
-                    'title': title,
-                    'subtitle': subtitle,
-                    'author': author,
-                    'publisher': publisher,
-                    'first_published_year': first_published_year,
-                    'language': language,
-                    'cover_image': cover_image,
-                    'pages': pages,
-                    'rating': rating,
-                    'isbn_10': isbn_10,
-                    'isbn_13': isbn_13
-
-                })
-
-    df = pd.DataFrame(data)
-    print(df.head(5))
-    df = df.map(lambda x: x.replace("\n", " ") if isinstance(x, str) else x)
-    df.to_csv(output_file, index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
-    print(f"Data saved to {output_file}")
+    from lxml import etree, html as lxml_html
+    try:
+        root = lxml_html.fromstring(content)
+    except etree.ParserError:  # empty page
+        root = lxml_html.fromstring('<html></html>')
+    body = root.find('body')
+    if body is None:
+        body = root
+    found = {}
+    remaining = sum(len(tests) for tests in LXML_FIELDS.values())
+    walker = etree.iterwalk(body, events=('start',))
+    for _, element in walker:
+        tag = element.tag
+        if tag in SKIPPED_TAGS:
+            walker.skip_subtree()
+            continue
+        for test, field in LXML_FIELDS.get(tag, ()):
+            if field not in found and test(element):
+                found[field] = element
+                remaining -= 1
+        if remaining == 0:
+            break
 
-def combine_csv():
+    def text(field):
+        return found[field].text_content().strip() if field in found else None
+
+    isbn = text('isbn') or ''
+    isbn_10 = re.findall(r'\b\d{10}\b', isbn)
+    isbn_13 = re.findall(r'\b\d{13}\b', isbn)
+    work_id = None
+    if 'ID' in found:
+        for sibling in found['ID'].itersiblings('dd'):
+            if 'object' in _classes(sibling):
+                work_id = sibling.text_content().strip()
+                break
+    year = text('first_published_year')
+    return {
+        'ID': work_id,
+        'title': text('title'),
+        'subtitle': text('subtitle'),
+        'author': text('author'),
+        'publisher': text('publisher'),
+        'first_published_year': year.strip("()").replace("(", "").replace(")", "") if year is not None else None,
+        'language': text('language'),
+        'cover_image': found['cover_image'].get('src') if 'cover_image' in found else None,
+        'pages': text('pages'),
+        'rating': text('rating'),
+        'isbn_10': isbn_10[0] if isbn_10 else None,
+        'isbn_13': isbn_13[0] if isbn_13 else None
+    }
+
+
+def parse_book(content, engine='bs4'):
+    """Extracts the fields of a book page with the given engine ('bs4' or 'lxml')"""
+    if engine == 'lxml':
+        return extract_book_lxml(content)
+    if engine == 'bs4':
+        return extract_book(BeautifulSoup(content, 'html.parser'))
+    raise ValueError(f"Unknown extraction engine: {engine}")
+
+
+def iter_books(input_directory, filenames=None, engine='bs4', workers=1, errors=None, archive=None):
     """
-    Combines the CSV files generated by the process_books function
+    Yields the records of the saved book pages (sorted by file name) while they are parsed, with the
+    line breaks of the text fields replaced by spaces
+    :param errors: list the (file, error) of the pages that could not be parsed are appended to
+    :param archive: utils_archive.PageArchive the pages are read from, in the order they are stored in
     """
-    dtype = {
-        'first_published_year': str,
-        'pages': str,
-        'isbn_10': str,
-        'isbn_13': str
-    }
-    df1 = pd.read_csv("openlibrary_books_relevance.csv", dtype=dtype)
-    df2 = pd.read_csv("openlibrary_books_fantasy.csv", dtype=dtype)
-    df = pd.concat([df1, df2])
-    df = df.drop_duplicates(subset=['ID'], keep='first')  # filter out duplicates
-    df.to_csv("openlibrary_books.csv", index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    parse = partial(parse_book, engine=engine)
+    if archive is not None:
+        filepaths = archive.list_pages(input_directory, filenames)
+        records = ps.iter_parsed(filepaths, parse, workers=workers, errors=errors, archive_dir=archive.directory)
+    else:
+        filepaths = ps.list_html_files(input_directory, filenames)
+        records = ps.iter_parsed(filepaths, parse, workers=workers, errors=errors)
+    return map(ps.replace_newlines, records)
 
 
+def process_books(input_directory, output_file, filenames=None, engine='bs4', workers=1, archive=None):
+    """
+    uses extraction functions and saves the data to a CSV file (or Parquet if the file name ends with
+    .parquet). The records are streamed to the file in batches
+    :param filenames: only parse these pages (e.g. the new or changed pages returned by get_book_html)
+    and update the existing output file with them
+    :param engine: extraction engine, 'bs4' (BeautifulSoup) or 'lxml' (single pass, several times faster)
+    :param workers: number of processes parsing the pages (None for one per core)
+    :param archive: utils_archive.PageArchive the pages are read from
+    """
+    import pandas as pd
+    errors = []
+    with mt.stage('openlibrary/process_books/' + os.path.basename(output_file)) as s:
+        records = iter_books(input_directory, filenames, engine, workers, errors, archive)
+        if filenames is not None:
+            df = pd.DataFrame(list(records), columns=COLUMNS)
+            ps.update_table(df, output_file)
+            count = len(df)
+        else:
+            count = ps.write_records(records, output_file, COLUMNS)
+        s.rows_in = count + len(errors)
+        s.rows_out = count
+    mt.count('parse_errors', len(errors))
+    ps.save_error_report(errors, output_file)
+    print(f"Saved {count} books to {output_file}")
+
+def combine_csv():
+    """
+    Combines the CSV files generated by the process_books function
+    """
+    import pandas as pd
+    import utils_storage as st
+    with mt.stage('openlibrary/combine_csv') as s:
+        df1 = st.read_table(st.table_path("openlibrary_books_relevance"), st.OPENLIBRARY_BOOKS)
+        df2 = st.read_table(st.table_path("openlibrary_books_fantasy"), st.OPENLIBRARY_BOOKS)
+        df = pd.concat([df1, df2])
+        df = df.drop_duplicates(subset=['ID'], keep='first')  # filter out duplicates
+        st.write_table(df, st.table_path("openlibrary_books"), st.OPENLIBRARY_BOOKS)
+        s.rows_in = len(df1) + len(df2)
+        s.rows_out = len(df)
@@ -0,0 +1,192 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import utils_covers as cv
+import utils_scoring as sc
+
+
+class SharedArray:
+    """
+    NumPy array in a shared memory block. Worker processes attach to it by name (see handle)
+    instead of receiving a pickled copy
+    """
+
+    def __init__(self, shm, shape, dtype, owner):
+        self.shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.owner = owner
+
+    @classmethod
+    def create(cls, array):
+        """Copies array into a new shared memory block"""
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        shared = cls(shm, array.shape, array.dtype, owner=True)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, handle):
+        name, shape, dtype = handle
+        # pool workers share the resource tracker of the parent, which unlinks the block in close
+        return cls(shared_memory.SharedMemory(name=name), shape, np.dtype(dtype), owner=False)
+
+    @property
+    def handle(self):
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    def close(self):
+        self.array = None  # release the buffer before closing the block
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedStrings:
+    """Strings in shared memory, stored as their concatenated UTF-8 bytes and the offset of every string"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def create(cls, values):
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(SharedArray.create(data), SharedArray.create(offsets))
+
+    @classmethod
+    def attach(cls, handle):
+        return cls(SharedArray.attach(handle[0]), SharedArray.attach(handle[1]))
+
+    @property
+    def handle(self):
+        return self.data.handle, self.offsets.handle
+
+    def get(self, indices):
+        """Strings at indices (None for -1)"""
+        data = self.data.array
+        offsets = self.offsets.array
+        return [None if i < 0 else bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8') for i in indices]
+
+    def close(self):
+        self.data.close()
+        self.offsets.close()
+
+
+def _partitions(num_pairs, workers, partitions_per_worker):
+    """Contiguous (start, end) slices of the pairs, a few per worker to balance the load"""
+    size = max(1, -(-num_pairs // (workers * partitions_per_worker)))
+    return [(start, min(start + size, num_pairs)) for start in range(0, num_pairs, size)]
+
+
+def _distance_partition(task):
+    """Worker: edit distances of the pairs start:end, written into the shared output array"""
+    strings_handle, codes_handles, output_handle, start, end, threshold, missing = task
+    strings = SharedStrings.attach(strings_handle)
+    left_codes, right_codes, output = [SharedArray.attach(handle) for handle in codes_handles + (output_handle,)]
+    try:
+        left = left_codes.array[start:end]
+        right = right_codes.array[start:end]
+        # decode every distinct string of the partition once
+        needed = np.unique(np.concatenate([left, right]))
+        values = np.array(strings.get(needed.tolist()), dtype=object)
+        left = values[np.searchsorted(needed, left)]
+        right = values[np.searchsorted(needed, right)]
+        if threshold is None:
+            output.array[start:end] = sc.normalized_edit_distance(left, right, missing)
+        else:
+            output.array[start:end] = sc.thresholded_edit_distance(left, right, threshold, missing)
+    finally:
+        for shared in [strings, left_codes, right_codes, output]:
+            shared.close()
+    return end - start
+
+
+def _cover_partition(task):
+    """Worker: cover MSE of the pairs start:end, the thumbnail stores are memory mapped from disk"""
+    store_path_a, store_path_b, rows_handles, output_handle, start, end = task
+    rows_a, rows_b, output = [SharedArray.attach(handle) for handle in rows_handles + (output_handle,)]
+    try:
+        thumbnails_a = np.load(store_path_a + '.npy', mmap_mode='r')
+        thumbnails_b = np.load(store_path_b + '.npy', mmap_mode='r')
+        output.array[start:end] = cv.cover_mse_rows(thumbnails_a, rows_a.array[start:end],
+                                                    thumbnails_b, rows_b.array[start:end])
+    finally:
+        for shared in [rows_a, rows_b, output]:
+            shared.close()
+    return end - start
+
+
+def _run(worker, tasks, workers):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(worker, tasks):
+            pass
+
+
+def parallel_edit_distance(left, right, threshold=None, missing=1.0, workers=None, partitions_per_worker=4):
+    """
+    Multi-process version of utils_scoring.normalized_edit_distance (threshold None) and
+    utils_scoring.thresholded_edit_distance. The distinct strings of both columns and the string codes
+    of the pairs are put in shared memory once, every worker reads its contiguous slice of pairs from
+    there and writes its distances into a shared output array at the same positions, so the result
+    does not depend on the number of workers or the order the partitions finish in
+    :param workers: number of processes (None: one per core, 1: in-process)
+    :return: NumPy array of distances
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        if threshold is None:
+            return sc.normalized_edit_distance(left, right, missing)
+        return sc.thresholded_edit_distance(left, right, threshold, missing)
+    left = np.asarray(left, dtype=object)
+    right = np.asarray(right, dtype=object)
+    if len(left) != len(right):
+        raise ValueError(f"Columns have different lengths: {len(left)} != {len(right)}")
+    # one shared dictionary of the distinct strings of both columns
+    codes, uniques = pd.factorize(np.concatenate([left, right]))
+    strings = SharedStrings.create(uniques.tolist())
+    shared = [SharedArray.create(codes[:len(left)]), SharedArray.create(codes[len(left):]),
+              SharedArray.create(np.zeros(len(left), dtype=np.float64))]
+    try:
+        tasks = [(strings.handle, (shared[0].handle, shared[1].handle), shared[2].handle, start, end, threshold,
+                  missing) for start, end in _partitions(len(left), workers, partitions_per_worker)]
+        _run(_distance_partition, tasks, workers)
+        return shared[2].array.copy()
+    finally:
+        strings.close()
+        for array in shared:
+            array.close()
+
+
+def parallel_cover_mse(store_path_a, ids_a, store_path_b, ids_b, workers=None, partitions_per_worker=4):
+    """
+    Multi-process version of utils_covers.cover_mse_batch for stores built by build_cover_store. The
+    thumbnails are memory mapped by every worker (shared through the page cache), only the row
+    positions of the pairs and the output are put in shared memory
+    :return: NumPy array with the MSE of every pair
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    store_a = cv.load_cover_store(store_path_a)
+    store_b = cv.load_cover_store(store_path_b)
+    if workers == 1:
+        return cv.cover_mse_batch(store_a, ids_a, store_b, ids_b)
+    rows_a, rows_b = cv.cover_rows(store_a, ids_a, store_b, ids_b)
+    shared = [SharedArray.create(rows_a), SharedArray.create(rows_b),
+              SharedArray.create(np.zeros(len(rows_a), dtype=np.float64))]
+    try:
+        tasks = [(store_path_a, store_path_b, (shared[0].handle, shared[1].handle), shared[2].handle, start, end)
+                 for start, end in _partitions(len(rows_a), workers, partitions_per_worker)]
+        _run(_cover_partition, tasks, workers)
+        return shared[2].array.copy()
+    finally:
+        for array in shared:
+            array.close()
@@ -0,0 +1,167 @@
+import csv
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+
+def update_table(df, output_filepath, key='ID'):
+    """
+    Merges freshly parsed records into an existing CSV (or Parquet) file: records with the same key are
+    replaced, the others are kept. Used when only the new or changed pages of a crawl were parsed
+    :return: the merged DataFrame that was saved
+    """
+    import pandas as pd
+    parquet = output_filepath.endswith('.parquet')
+    if os.path.exists(output_filepath):
+        existing = pd.read_parquet(output_filepath) if parquet else pd.read_csv(output_filepath, dtype=str)
+        df = pd.concat([existing.astype(object), df.astype(object)], ignore_index=True)
+        df = df.drop_duplicates(subset=[key], keep='last')
+    if parquet:
+        df.astype('string').to_parquet(output_filepath, index=False)
+    else:
+        df.to_csv(output_filepath, index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    return df
+
+
+def list_html_files(input_directory, filenames=None):
+    """Sorted paths of the .html files of input_directory (or of the given file names only)"""
+    if filenames is None:
+        filenames = os.listdir(input_directory)
+    filenames = sorted({os.path.basename(filename) for filename in filenames if filename.endswith('.html')})
+    return [os.path.join(input_directory, filename) for filename in filenames]
+
+
+def _parse_chunk(parse_func, filepaths, archive_dir=None):
+    """
+    Parses a chunk of files in a worker process. Errors are caught per file so a broken page does not
+    crash the batch
+    :param archive_dir: read the pages from this utils_archive.PageArchive instead of files
+    :return: list of (filepath, record or None, error message or None)
+    """
+    results = []
+    archive = None
+    if archive_dir is not None:
+        import utils_archive as ar
+        archive = ar.open_archive(archive_dir)
+    for filepath in filepaths:
+        try:
+            if archive is not None:
+                results.append((filepath, parse_func(archive.read(filepath).decode('utf-8')), None))
+                continue
+            with open(filepath, 'r', encoding='utf-8') as file:
+                results.append((filepath, parse_func(file.read()), None))
+        except Exception as e:
+            results.append((filepath, None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _chunk_size(num_files, workers, chunk_size):
+    if chunk_size is None:
+        chunk_size = max(1, min(64, -(-num_files // (workers * 4))))
+    return chunk_size
+
+
+def iter_parsed(filepaths, parse_func, workers=1, chunk_size=None, errors=None, archive_dir=None):
+    """
+    Generator version of parse_files: yields the records in the order of filepaths as soon as their
+    chunk is parsed. At most two chunks per worker are in flight, so memory does not grow with the
+    number of files and consumers can start before parsing finishes
+    :param errors: list the (filepath, error) of the files that could not be parsed are appended to
+    :param archive_dir: directory of the utils_archive.PageArchive the pages are read from (every
+    process memory-maps the archive itself, only the paths are sent to the workers)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunk_size = _chunk_size(len(filepaths), workers, chunk_size)
+    chunks = (filepaths[i:i + chunk_size] for i in range(0, len(filepaths), chunk_size))
+    if workers == 1:
+        for chunk in chunks:
+            yield from _records(_parse_chunk(parse_func, chunk, archive_dir), errors)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(_parse_chunk, parse_func, chunk, archive_dir)
+                        for chunk in islice(chunks, workers * 2))
+        while pending:
+            results = pending.popleft().result()  # oldest chunk first keeps the order
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                pending.append(executor.submit(_parse_chunk, parse_func, next_chunk, archive_dir))
+            yield from _records(results, errors)
+
+
+def _records(chunk_results, errors):
+    for filepath, record, error in chunk_results:
+        if error is None:
+            yield record
+        elif errors is not None:
+            errors.append((filepath, error))
+
+
+def parse_files(filepaths, parse_func, workers=1, chunk_size=None):
+    """
+    Parses files with parse_func (content -> record dict), in a process pool if workers > 1.
+    The files are split in chunks of chunk_size files per task and the records are returned in the
+    order of filepaths whatever the number of workers
+    :param parse_func: picklable function (module level function or functools.partial of one)
+    :param workers: number of processes (None for one per core, 1 parses in this process)
+    :param chunk_size: files per task, by default about 4 tasks per worker and at most 64 files
+    :return: (list of records, list of (filepath, error) for the files that could not be parsed)
+    """
+    errors = []
+    records = list(iter_parsed(filepaths, parse_func, workers, chunk_size, errors))
+    return records, errors
+
+
+def replace_newlines(record):
+    """Replaces the line breaks in the text fields of a record by spaces"""
+    return {key: value.replace("\n", " ") if isinstance(value, str) else value for key, value in record.items()}
+
+
+def write_records(records, output_filepath, columns, batch_size=1000):
+    """
+    Writes a stream of records to CSV (or Parquet if output_filepath ends with .parquet) in batches of
+    batch_size records, so only one batch is held in memory
+    :param records: iterable of record dicts
+    :param columns: column names of the output file
+    :return: number of records written
+    """
+    import pandas as pd
+    records = iter(records)
+    parquet = output_filepath.endswith('.parquet')
+    writer = None
+    if parquet:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([(column, pa.string()) for column in columns])
+        writer = pq.ParquetWriter(output_filepath, schema)
+    count = 0
+    try:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch and count:
+                break
+            df = pd.DataFrame(batch, columns=columns)
+            if parquet:
+                writer.write_table(pa.Table.from_pandas(df.astype(object), schema=schema, preserve_index=False))
+            else:
+                df.to_csv(output_filepath, mode='a' if count else 'w', header=not count, index=False,
+                          quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+            count += len(batch)
+            if len(batch) < batch_size:
+                break
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def save_error_report(errors, output_filepath):
+    """Saves the files that could not be parsed next to the output CSV (<output>_errors.csv)"""
+    if not errors:
+        return None
+    import pandas as pd
+    report_path = f"{os.path.splitext(output_filepath)[0]}_errors.csv"
+    pd.DataFrame(errors, columns=['file', 'error']).to_csv(report_path, index=False)
+    print(f"Failed to parse {len(errors)} files, see {report_path}")
+    return report_path
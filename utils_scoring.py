@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+from rapidfuzz.distance import Levenshtein as rf_lev
+from rapidfuzz.process import cpdist
+
+
+def _unique_pairs(left, right):
+    """
+    Deduplicates identical (left, right) string pairs
+    :return: object arrays of the unique left and right strings and the index of the unique pair
+    of every input pair
+    """
+    left_codes, left_uniques = pd.factorize(left)
+    right_codes, right_uniques = pd.factorize(right)
+    width = max(len(right_uniques), 1)
+    unique_keys, codes = np.unique(left_codes.astype(np.int64) * width + right_codes, return_inverse=True)
+    unique_left = np.asarray(left_uniques, dtype=object)[unique_keys // width]
+    unique_right = np.asarray(right_uniques, dtype=object)[unique_keys % width]
+    return unique_left, unique_right, codes.reshape(-1)
+
+
+def _string_columns(left, right):
+    """Converts two string columns to object arrays and flags the pairs without missing values"""
+    left = np.asarray(left, dtype=object)
+    right = np.asarray(right, dtype=object)
+    if len(left) != len(right):
+        raise ValueError(f"Columns have different lengths: {len(left)} != {len(right)}")
+    present = ~(pd.isna(left) | pd.isna(right))
+    return left, right, present
+
+
+def normalized_edit_distance(left, right, missing=1.0, workers=1):
+    """
+    Batch Levenshtein distance normalized by the length of the longer string
+    (same value as edit_distance(a, b) / max(len(a), len(b)) for every pair)
+    :param left: column (Series or sequence) of strings
+    :param right: column of strings with the same length as left
+    :param missing: distance assigned to pairs where one of the values is missing
+    :param workers: number of threads used by the distance kernel (-1 for all cores)
+    :return: NumPy array of normalized distances
+    """
+    left, right, present = _string_columns(left, right)
+    distances = np.full(len(left), missing, dtype=np.float64)
+    if not present.any():
+        return distances
+    unique_left, unique_right, codes = _unique_pairs(left[present], right[present])
+    # one bulk call into the C++ kernel for all distinct pairs
+    unique_distances = cpdist(unique_left.tolist(), unique_right.tolist(), scorer=rf_lev.normalized_distance,
+                              dtype=np.float64, workers=workers)
+    distances[present] = unique_distances[codes]
+    return distances
+
+
+def max_edit_distance(max_len, threshold):
+    """
+    Largest edit distance d with d / max_len < threshold (the filter used in perform_matching)
+    :param max_len: array with the length of the longer string of every pair
+    """
+    max_len = np.asarray(max_len, dtype=np.int64)
+    k = np.ceil(threshold * max_len).astype(np.int64) - 1
+    # correct the float rounding of threshold * max_len so k matches the strict comparison exactly
+    safe_len = np.maximum(max_len, 1)
+    k = np.where((k + 1) / safe_len < threshold, k + 1, k)
+    k = np.where((k >= 0) & (k / safe_len >= threshold), k - 1, k)
+    return np.where(max_len == 0, 0 if threshold > 0 else -1, k)
+
+
+def _tagged_characters(text, rank):
+    """Characters of text tagged with their occurrence number, sorted from rarest to most frequent"""
+    seen = {}
+    tokens = []
+    for char in text:
+        seen[char] = seen.get(char, 0) + 1
+        tokens.append((char, seen[char]))
+    return sorted(tokens, key=lambda token: (rank.get(token, 0), token))
+
+
+def prefix_filter(left, right, k):
+    """
+    Positional prefix filter: an edit distance of at most k destroys at most k character occurrences,
+    so two strings with ed <= k share at least max(len) - k tagged characters and the k + 1 rarest
+    tagged characters of both strings must overlap
+    :param left: list of strings
+    :param right: list of strings
+    :param k: array of the largest allowed edit distance of every pair
+    :return: boolean array, False for pairs that cannot be within k edits
+    """
+    # global ordering: rarest tagged characters first
+    counts = {}
+    for text in set(left) | set(right):
+        for token in set(_tagged_characters(text, {})):
+            counts[token] = counts.get(token, 0) + 1
+    sorted_tokens = {text: _tagged_characters(text, counts) for text in set(left) | set(right)}
+    keep = np.ones(len(left), dtype=bool)
+    for i, (a, b, max_dist) in enumerate(zip(left, right, k)):
+        if max(len(a), len(b)) - max_dist < 1:
+            continue  # the count filter gives no constraint
+        prefix_a = sorted_tokens[a][:max_dist + 1]
+        prefix_b = sorted_tokens[b][:max_dist + 1]
+        keep[i] = not set(prefix_a).isdisjoint(prefix_b)
+    return keep
+
+
+def thresholded_edit_distance(left, right, threshold, missing=1.0, use_prefix_filter=False, workers=1):
+    """
+    Similarity join version of normalized_edit_distance: only computes the distance of pairs that can
+    have a normalized distance below threshold. Pairs are rejected by the length filter
+    (|len(a) - len(b)| / max is a lower bound), then the prefix filter, and the remaining ones are
+    computed with a bounded (banded) Levenshtein that exits early once the bound is exceeded
+    :param use_prefix_filter: also apply the prefix filter. It runs in Python, so it only pays off
+    for long strings or strict thresholds; for titles and author names the bounded kernel is faster
+    :return: NumPy array with the exact normalized distance of pairs below threshold, missing for
+    pairs with a missing value and np.inf for rejected pairs
+    """
+    left, right, present = _string_columns(left, right)
+    distances = np.full(len(left), np.inf, dtype=np.float64)
+    distances[~present] = missing
+    if not present.any():
+        return distances
+    unique_left, unique_right, codes = _unique_pairs(left[present], right[present])
+    len_left = np.fromiter(map(len, unique_left), dtype=np.int64, count=len(unique_left))
+    len_right = np.fromiter(map(len, unique_right), dtype=np.int64, count=len(unique_right))
+    max_len = np.maximum(len_left, len_right)
+    k = max_edit_distance(max_len, threshold)
+    # length filter
+    candidates = np.flatnonzero(np.abs(len_left - len_right) <= k)
+    if use_prefix_filter and len(candidates):
+        keep = prefix_filter(unique_left[candidates].tolist(), unique_right[candidates].tolist(), k[candidates])
+        candidates = candidates[keep]
+    unique_distances = np.full(len(unique_left), np.inf, dtype=np.float64)
+    # bounded distance: one kernel call per distance bound
+    for bound in np.unique(k[candidates]):
+        group = candidates[k[candidates] == bound]
+        dist = cpdist(unique_left[group].tolist(), unique_right[group].tolist(),
+                      scorer=rf_lev.distance, score_cutoff=int(bound), dtype=np.int64, workers=workers)
+        within = dist <= bound
+        unique_distances[group[within]] = dist[within] / np.maximum(max_len[group[within]], 1)
+    distances[present] = unique_distances[codes]
+    return distances
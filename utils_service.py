@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import utils_covers as cv
+import utils_http as hp
+import utils_index as ix
+import utils_matching as um
+import utils_metrics as mt
+import utils_normalization as nm
+import utils_storage as st
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8750
+COVER_STORE = os.path.join(cv.COVER_CACHE_DIR, 'features_table_b_service')
+MATCH_FIELDS = ['ltable_ID', 'rtable_ID', 'rtable_title', 'rtable_author', 'rtable_first_published_year',
+                'distance_title', 'distance_author', 'difference_year', 'language_match', 'cover_mse', 'score']
+
+
+class MatchService:
+    """
+    Matches Open Library records against table_b on demand. table_b, its similarity index (the candidates
+    of a record are its top-k most similar table_b records, as with utils_index.index_blocker) and the
+    thumbnails of its covers (a memory-mapped cover store) are kept between queries, only the covers of
+    the queried records are downloaded. The features and the score of a pair are computed
+    like in perform_matching, the year difference is normalized with the years of the matches of the last
+    match run (saved with the pair features), so a pair that is in tableC gets the same values
+    """
+
+    def __init__(self, k=50, weights=None, title_threshold=um.TITLE_THRESHOLD, author_threshold=um.AUTHOR_THRESHOLD,
+                 index_path=ix.INDEX_PATH, features_path=um.FEATURES_PATH, cover_store=COVER_STORE,
+                 fetch_covers=False, cover_cache_size=4096):
+        with mt.stage('service/load') as s:
+            table_b = st.read_table(st.table_path('table_b_cleaned'), st.TABLE_B)
+            self.index = ix.load_or_build_index(table_b, index_path)
+            self.table_b = table_b.rename(columns={col: f"rtable_{col}" for col in table_b.columns})
+            self.positions = pd.Index(table_b['ID'])  # position of every table_b record by ID
+            self.min_year, self.max_year = self._year_range(table_b, features_path)
+            self.covers = self._cover_store(table_b, cover_store, fetch_covers)
+            s.rows_out = len(table_b)
+        self.k = k
+        self.weights = weights
+        self.title_threshold = title_threshold
+        self.author_threshold = author_threshold
+        self.thumbnails = OrderedDict()  # decoded covers of queried records, least recently used first
+        self.cover_cache_size = cover_cache_size
+        self.thumbnails_lock = threading.Lock()
+        self.started = time.monotonic()
+
+    @staticmethod
+    def _year_range(table_b, features_path):
+        """min_year and max_year of the year difference, from the last match run if its features were saved"""
+        try:
+            features, params = um.load_features(features_path)
+        except OSError:
+            print(f"No pair features in {features_path}, normalizing the year difference with the years of table_b")
+            return table_b['first_published_year'].min(), table_b['first_published_year'].max()
+        max_year = features[['ltable_first_published_year', 'rtable_first_published_year']].max().max()
+        return params['min_year'], max_year
+
+    @staticmethod
+    def _cover_store(table_b, store_path, fetch_covers=False):
+        """
+        Thumbnail store of the covers of table_b (see utils_covers.build_cover_store), built from the covers
+        in the cover cache (the match stage downloaded those of its candidates) and reused while table_b and
+        its cached covers do not change
+        :param fetch_covers: download the covers of table_b that are not cached first
+        """
+        urls = [cv.normalize_cover_url(url) for url in table_b['cover_image'].tolist()]
+        if fetch_covers:
+            cv.fetch_covers(urls)
+        cached = np.array([url is not None and os.path.exists(cv.cover_cache_path(url)) for url in urls], dtype=bool)
+        if os.path.exists(store_path + '_index.csv'):
+            store = cv.load_cover_store(store_path)
+            if store['ids'].tolist() == table_b['ID'].tolist() and np.array_equal(store['has_cover'], cached):
+                mt.count('service_cover_store_hits')
+                return store
+        return cv.build_cover_store(table_b['ID'], table_b['cover_image'], store_path)
+
+    def _thumbnail(self, url):
+        """Decoded cover of a queried record, downloaded into the cover cache on first use (None if unavailable)"""
+        if url is None:
+            return None
+        with self.thumbnails_lock:
+            if url in self.thumbnails:
+                self.thumbnails.move_to_end(url)
+                return self.thumbnails[url]
+        thumbnail = cv.cover_thumbnail(cv.fetch_cover(url, hp.shared_session()))
+        if thumbnail is None:
+            return None  # not remembered, a failed download is tried again by the next query
+        with self.thumbnails_lock:
+            self.thumbnails[url] = thumbnail
+            if len(self.thumbnails) > self.cover_cache_size:
+                self.thumbnails.popitem(last=False)
+        return thumbnail
+
+    def prepare(self, records):
+        """Cleans raw Open Library records like utils_cleaning_analysis does for table_a"""
+        queries = pd.DataFrame(records, columns=list(st.TABLE_A))
+        queries['ID'] = queries['ID'].where(queries['ID'].notna(), pd.Series(range(len(queries))).astype(str))
+        queries = st.apply_schema(queries, st.TABLE_A, categorical=False)
+        queries['language'] = nm.normalize_column(queries['language'], nm.canonical_language)
+        queries['author'] = nm.normalize_column(queries['author'], nm.canonical_author)
+        # empty values (e.g. the language 'Undetermined') are missing like in the tables read by read_table
+        return queries.replace('', pd.NA)
+
+    def _cover_mse(self, table_c):
+        """cover MSE of the pairs, the table_b side is read from the cover store (0 if a cover is missing)"""
+        rows_b = self.covers['ids'].get_indexer(table_c['rtable_ID'])
+        rows_b[rows_b >= 0] = np.where(self.covers['has_cover'][rows_b[rows_b >= 0]], rows_b[rows_b >= 0], -1)
+        thumbnails, rows_a = [], np.full(len(table_c), -1)
+        for row, url in enumerate(table_c['ltable_cover_image'].tolist()):
+            # the query cover is not needed if the table_b record has no cover
+            thumbnail = self._thumbnail(cv.normalize_cover_url(url)) if rows_b[row] >= 0 else None
+            if thumbnail is not None:
+                rows_a[row] = len(thumbnails)
+                thumbnails.append(thumbnail)
+        if not thumbnails:
+            return np.zeros(len(table_c))
+        return cv.cover_mse_rows(np.stack(thumbnails), rows_a, self.covers['thumbnails'], rows_b)
+
+    def match(self, records, k=None):
+        """
+        Matches a batch of Open Library records
+        :param records: list of dicts with the fields of openlibrary_books (ID, title, author, language, ...)
+        :return: list with the matches of every record (dicts with MATCH_FIELDS), best first, in the order of
+        records (one list per record even if records share an ID)
+        """
+        start = time.perf_counter()
+        queries = self.prepare(records)
+        # candidate pairs straight from the index, the rows of both sides are gathered by position
+        query_rows, table_b_ids = [], []
+        for row, (title, author) in enumerate(zip(queries['title'].tolist(), queries['author'].tolist())):
+            for record_id, _ in self.index.query(title, author, k or self.k):
+                query_rows.append(row)
+                table_b_ids.append(record_id)
+        left = queries.rename(columns={col: f"ltable_{col}" for col in queries.columns}).take(query_rows)
+        right = self.table_b.take(self.positions.get_indexer(table_b_ids))
+        table_c = pd.concat([left.reset_index(drop=True), right.reset_index(drop=True)], axis=1)
+        table_c = um.candidate_distances(table_c, 1, self.title_threshold, self.author_threshold)
+        keep = ((table_c['distance_title'] < self.title_threshold) &
+                (table_c['distance_author'] < self.author_threshold) & (table_c['language_match'] == 1)).to_numpy()
+        table_c = table_c[keep].reset_index(drop=True)
+        table_c['query_row'] = np.asarray(query_rows, dtype=np.int64)[keep]
+        table_c['difference_year'] = um.year_difference(table_c, self.min_year, self.max_year)
+        table_c['cover_mse'] = self._cover_mse(table_c)
+        table_c['score'] = um.weighted_score(table_c, self.weights)
+        table_c = table_c.sort_values(['score', 'rtable_ID'], kind='stable')
+        matches = [[] for _ in range(len(queries))]
+        for row, *values in zip(*[table_c[field].tolist() for field in ['query_row'] + MATCH_FIELDS]):
+            matches[row].append({field: None if pd.isna(value) else value for field, value in zip(MATCH_FIELDS, values)})
+        mt.count('service_queries')
+        mt.count('service_records', len(queries))
+        mt.count('service_matches', len(table_c))
+        mt.observe('service_latency', time.perf_counter() - start)
+        return matches
+
+    def stats(self):
+        """Latency histogram of the queries and throughput (records per second) since the service started"""
+        report = mt.report()
+        uptime = time.monotonic() - self.started
+        records = report['counters'].get('service_records', 0)
+        return {
+            'uptime_seconds': uptime,
+            'queries': report['counters'].get('service_queries', 0),
+            'records': records,
+            'matches': report['counters'].get('service_matches', 0),
+            'records_per_second': records / uptime if uptime else None,
+            'latency': report['histograms'].get('service_latency'),
+            'cover_store': {'records': len(self.covers['ids']), 'covers': int(self.covers['has_cover'].sum())},
+            'query_covers': len(self.thumbnails),
+            'peak_rss_mb': report['peak_rss_mb'],
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    JSON API of the service:
+        POST /match   {"record": {...}} -> {"matches": [...]}, {"records": [...]} -> {"matches": [[...], ...]}
+        GET /stats    latency and throughput
+        GET /health
+    """
+    service = None
+    protocol_version = 'HTTP/1.1'  # keep-alive connections for clients sending many queries
+
+    def _send(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send(200, self.service.stats())
+        else:
+            self._send(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/match':
+            self._send(404, {'error': f"unknown path {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            single = 'record' in body
+            records = [body['record']] if single else body['records']
+            matches = self.service.match(records, body.get('k'))
+        except (ValueError, KeyError, TypeError) as e:
+            mt.count('service_errors')
+            self._send(400, {'error': f"{type(e).__name__}: {e}"})
+            return
+        self._send(200, {'matches': matches[0] if single else matches})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    """HTTP server of service (port 0 picks a free port, see server.server_address)"""
+    handler = type('Handler', (_Handler,), {'service': service})
+    return _Server((host, port), handler)
+
+
+def serve(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    """Answers match queries until interrupted"""
+    server = make_server(service, host, port)
+    print(f"Serving matches of {len(service.table_b)} table_b records on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def start_in_thread(service, host=SERVICE_HOST, port=0):
+    """Starts the server in a background thread, returns (server, base URL); stop it with server.shutdown()"""
+    server = make_server(service, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
@@ -0,0 +1,190 @@
+import csv
+import heapq
+import os
+
+import numpy as np
+import pandas as pd
+
+# storage format of the tables written by the pipeline, 'csv' or 'parquet' (needs pyarrow)
+STORAGE_FORMAT = os.environ.get("BOOKS_STORAGE_FORMAT", "csv")
+
+# explicit schemas of the tables handed between the stages. 'category' columns are dictionary
+# encoded in Parquet files
+OPENLIBRARY_BOOKS = {
+    'ID': 'string',
+    'title': 'string',
+    'subtitle': 'string',
+    'author': 'string',
+    'publisher': 'category',
+    'first_published_year': 'Int64',
+    'language': 'category',
+    'cover_image': 'string',
+    'pages': 'Int64',
+    'rating': 'string',
+    'isbn_10': 'string',  # ISBNs keep their leading zeros
+    'isbn_13': 'string',
+}
+GUTENBERG_BOOKS = {
+    'ID': 'Int64',
+    'title': 'string',
+    'author': 'string',
+    'publisher': 'category',
+    'first_published_year': 'Int64',
+    'language': 'category',
+    'cover_image': 'string',
+}
+TABLE_A = {column: OPENLIBRARY_BOOKS[column] for column in GUTENBERG_BOOKS}
+TABLE_B = dict(GUTENBERG_BOOKS)
+TABLE_C = {
+    'ID': 'Int64',
+    **{f'ltable_{column}': dtype for column, dtype in TABLE_A.items() if column != 'ID'},
+    **{f'rtable_{column}': dtype for column, dtype in TABLE_B.items() if column != 'ID'},
+    'ltable_ID': 'string',
+    'rtable_ID': 'Int64',
+    'distance_title': 'float64',
+    'distance_author': 'float64',
+    'difference_year': 'float64',
+    'language_match': 'Int8',
+    'cover_mse': 'float64',
+    'score': 'float64',
+}
+
+
+def table_path(name, fmt=None):
+    """File name of a table in the configured storage format, e.g. table_path('tableC') -> 'tableC.csv'"""
+    return f"{name}.{fmt or STORAGE_FORMAT}"
+
+
+def _integers(series):
+    """Parses integers stored as text ('  2004 ', '12949.0'), invalid values become missing"""
+    if not pd.api.types.is_numeric_dtype(series):
+        series = series.astype('string').str.strip()
+    numbers = pd.to_numeric(series, errors='coerce')
+    # values like 2004.5 are not integers
+    numbers = numbers.where(numbers.isna() | (numbers == np.floor(numbers)))
+    return numbers.astype('Int64')
+
+
+def _floats(series):
+    """Parses floats stored as text exactly (to_numeric may be off in the last digit), invalid values become missing"""
+    try:
+        return series.astype('float64')
+    except (ValueError, TypeError):
+        return pd.to_numeric(series, errors='coerce').astype('float64')
+
+
+def _strings(series):
+    """Text values, empty strings become missing"""
+    series = series.astype('string')
+    return series.mask(series == '')
+
+
+def apply_schema(df, schema, categorical=True):
+    """
+    Converts the columns of df to the dtypes of schema (columns not in the schema are left as they are).
+    Empty strings become missing values in both formats, as the CSV files are read with na_values=['']
+    :param categorical: keep 'category' columns as categories, otherwise they become 'string' columns
+    which is easier for code that edits their values
+    """
+    df = df.copy()
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype in ('Int64', 'Int8'):
+            df[column] = _integers(df[column]).astype(dtype)
+        elif dtype == 'float64':
+            df[column] = _floats(df[column])
+        elif dtype == 'category' and categorical:
+            df[column] = _strings(df[column]).astype('category')
+        else:
+            df[column] = _strings(df[column])
+    return df
+
+
+def read_table(path, schema, categorical=False):
+    """
+    Reads a table written by write_table (CSV or Parquet, chosen by the file extension) with the
+    dtypes of schema instead of the inferred ones
+    """
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''])
+    return apply_schema(df, schema, categorical)
+
+
+def write_table(df, path, schema):
+    """Writes a table as CSV or Parquet (chosen by the file extension) with the dtypes of schema"""
+    df = apply_schema(df, schema)
+    if path.endswith('.parquet'):
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='')
+    return df
+
+
+def iter_table(path, schema, chunk_size=100000, categorical=False):
+    """Reads a table written by write_table in chunks of chunk_size rows, so memory does not grow with the table"""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield apply_schema(batch.to_pandas(), schema, categorical)
+    else:
+        for df in pd.read_csv(path, dtype=str, keep_default_na=False, na_values=[''], chunksize=chunk_size):
+            yield apply_schema(df, schema, categorical)
+
+
+def write_table_batches(batches, path, schema, columns=None):
+    """
+    Writes a table batch by batch (CSV appends or Parquet row groups) so only one batch is in memory.
+    Category columns are written as strings since the batches do not share their categories
+    :param batches: iterable of DataFrames with the same columns
+    :param columns: columns of the table, used for the header if there are no batches
+    :return: number of rows written
+    """
+    rows = 0
+    writer = None
+    for batch in batches:
+        batch = apply_schema(batch, schema, categorical=False)
+        if path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+        else:
+            batch.to_csv(path, index=False, quoting=csv.QUOTE_MINIMAL, sep=",", na_rep='',
+                         mode='w' if writer is None else 'a', header=writer is None)
+            writer = True
+        rows += len(batch)
+    if writer is None:
+        write_table(pd.DataFrame(columns=columns or list(schema)), path, schema)
+    elif writer is not True:
+        writer.close()
+    return rows
+
+
+def merge_sorted_tables(paths, schema, key, batch_size=100000):
+    """
+    K-way merge of tables that are each sorted by key (external merge sort). Every table is read in
+    chunks of batch_size / len(paths) rows, so at most about 2 * batch_size rows are in memory
+    :param key: function mapping a row (dict of column values) to its sort key
+    :return: generator of DataFrames of up to batch_size merged rows
+    """
+    chunk_size = max(batch_size // max(len(paths), 1), 1)
+
+    def rows(path):
+        for chunk in iter_table(path, schema, chunk_size):
+            columns = list(chunk.columns)
+            for values in chunk.astype(object).itertuples(index=False, name=None):
+                yield dict(zip(columns, values))
+
+    batch = []
+    for row in heapq.merge(*[rows(path) for path in paths], key=key):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield pd.DataFrame(batch)
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch)